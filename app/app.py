@@ -1,19 +1,23 @@
+import time
+_boot_started = time.perf_counter()
+
 from flask import Flask, request, send_file, Response, send_from_directory, after_this_request
 from flask_cors import CORS
-import yt_dlp
 import os
 import sys
 import tempfile
 import logging
 import argparse
+import importlib
 import json
 import re
 import base64
 import uuid
+import random
 import threading
-import time
 import shutil
 from pathlib import Path
+from contextlib import contextmanager
 
 app = Flask(__name__, static_folder='static', static_url_path='')
 CORS(app)  # 允许跨域请求
@@ -22,6 +26,64 @@ CORS(app)  # 允许跨域请求
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ================ 启动耗时 ================
+# scale-to-zero 部署中首个请求要等待容器和 worker 启动，启动路径上的每一步都需要计时：
+#   - 各启动阶段的耗时在模块加载完成时输出到日志
+#   - yt_dlp（连同所有提取器模块）延迟到首次使用或预热时才导入，/health 不依赖它
+#   - gunicorn 预加载（APP_PRELOAD=1，见 gunicorn.conf.py）时在 master 进程中预热，worker fork 后共享
+#   - 设置 BOOT_IMPORT_PROFILE=1 时 entrypoint.sh 开启 python -X importtime，输出每个模块的导入耗时
+
+# 启动阶段耗时: [(阶段名称, 毫秒)]
+BOOT_PHASES = []
+_boot_phase_started = _boot_started
+
+def boot_phase(name):
+    """记录从上一个阶段结束到现在的耗时"""
+    global _boot_phase_started
+    now = time.perf_counter()
+    BOOT_PHASES.append((name, round((now - _boot_phase_started) * 1000, 1)))
+    _boot_phase_started = now
+
+def get_process_age():
+    """进程启动至今的秒数（包括解释器启动和 gunicorn 自身的导入），无法获取时返回 None"""
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class LazyModule:
+    """首次访问属性时才导入的模块（导入过程加锁，多个线程同时使用时只导入一次）"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    logger.info(f'已导入 {self._name}, 耗时 {(time.perf_counter() - started) * 1000:.0f}ms')
+                    self._module = module
+        return self._module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+yt_dlp = LazyModule('yt_dlp')
+
+boot_phase('导入依赖')
+
 def json_response(data, status=200):
     """返回 JSON 响应，支持中文"""
     return Response(
@@ -33,6 +95,21 @@ def json_response(data, status=200):
 # 视频质量优先级：720p > 480p > 360p > 1080p > 4K
 QUALITY_PRIORITY = ['720', '480', '360', '1080', '2160']
 
+def write_cookies_file(path, content):
+    """原子地写入 cookies 文件（先写临时文件再替换），读取方不会读到写了一半的文件"""
+    cookies_dir = os.path.dirname(path)
+    if cookies_dir:
+        os.makedirs(cookies_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=cookies_dir or None, prefix='.cookies-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
 def ensure_cookies():
     """
     从环境变量恢复 cookies（如果存在）
@@ -60,14 +137,13 @@ def ensure_cookies():
                           if line.strip() and not line.strip().startswith('#')]
             cookie_count = len(cookie_lines)
 
-            # 确保目录存在
-            cookies_dir = os.path.dirname(default_cookies_path)
-            if cookies_dir and not os.path.exists(cookies_dir):
-                os.makedirs(cookies_dir, exist_ok=True)
-
-            # 写入文件
-            with open(default_cookies_path, 'w', encoding='utf-8') as f:
-                f.write(cookies_content)
+            # 每个 worker 启动时都会执行：内容相同时不重写，避免文件修改时间变化让其他 worker 重新解析
+            existing = None
+            if os.path.exists(default_cookies_path):
+                with open(default_cookies_path, 'r', encoding='utf-8', errors='replace') as f:
+                    existing = f.read()
+            if existing != cookies_content:
+                write_cookies_file(default_cookies_path, cookies_content)
 
             logger.info(f'✅ Cookies 已从环境变量恢复到 {default_cookies_path}')
             logger.info(f'📊 共 {cookie_count} 个 cookies')
@@ -90,196 +166,796 @@ def ensure_cookies():
 # 全局变量：cookies 文件路径
 # 优先从环境变量读取，用于 gunicorn 启动
 # 启动时尝试从环境变量恢复 cookies
-COOKIES_FILE = ensure_cookies()
+# 没有 cookies 时也保留默认路径：之后通过管理接口写入的 cookies 会被所有 worker 使用
+COOKIES_FILE = ensure_cookies() or os.environ.get('COOKIES_FILE') or '/app/cookies.txt'
+boot_phase('恢复 cookies')
+
+# ================ Cookies 管理 ================
+# cookies 文件在每个进程中只解析一次，YoutubeDL 不再自己读取（也不再写回）cookies 文件；
+# 解析得到的 cookie jar 只读，每次借出 YoutubeDL 实例时用公开接口把其中的 cookies 复制到新的 jar，
+# 经参数 cookiejar 交给实例；请求过程中源站返回的 Set-Cookie 只写入这个 jar，不会影响其他请求
+# 重新解析时创建新的 jar 整体替换，不修改正在使用的旧 jar
+# 以下情况会重新解析：文件修改时间变化（最多每 COOKIES_CHECK_INTERVAL 秒检查一次）、
+# 进程收到 SIGHUP、或通过 /api/admin/cookies 写入了新的 cookies
+
+import hmac
+import signal
+
+# 检查 cookies 文件修改时间的间隔（秒）
+COOKIES_CHECK_INTERVAL = float(os.environ.get('COOKIES_CHECK_INTERVAL', '2'))
+
+# 管理接口的访问令牌（请求头 Authorization: Bearer <token>），未设置时管理接口不可用
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+_cookie_jar_lock = threading.Lock()
+_cookie_reload_event = threading.Event()
+_cookie_jar_state = {
+    'path': None,
+    'jar': None,
+    'mtime': None,
+    'version': 0,
+    'checked_at': 0,
+    'loaded_at': None,
+    'count': 0,
+    'parse_ms': None,
+    'reloads': 0,
+}
+
+def parse_cookie_file(path):
+    """解析 Netscape 格式的 cookies 文件"""
+    jar = yt_dlp.cookies.YoutubeDLCookieJar(path)
+    jar.load()
+    return jar
+
+def copy_cookie_jar(source=None):
+    """
+    新建一个 cookie jar 并复制 source 中的 cookies（Cookie 对象创建后不会被修改，可以共用）
+    2000 个 cookies 约 3ms，远小于重新解析文件
+    """
+    jar = yt_dlp.cookies.YoutubeDLCookieJar()
+    if source is not None:
+        for cookie in source:
+            jar.set_cookie(cookie)
+    return jar
 
-# 全局变量：代理设置
-# 优先从环境变量读取，用于 gunicorn 启动
-PROXY_URL = os.environ.get('PROXY_URL', None)
+def get_cookie_jar(cookiefile):
+    """
+    返回 (解析得到的 cookie jar, 版本号)；没有 cookies 文件时返回 (None, None)
+    返回的 jar 只读，使用时用 copy_cookie_jar 复制
+    版本号在每次重新解析后递增，实例池按版本号区分使用新旧 cookies 的实例
+    """
+    if not cookiefile:
+        return None, None
 
-# 初始化时检查代理设置
-if PROXY_URL:
-    logger.info(f'已配置代理: {PROXY_URL}')
-else:
-    logger.info('未配置代理，将直接连接')
+    state = _cookie_jar_state
+    now = time.monotonic()
+    with _cookie_jar_lock:
+        if (state['path'] == cookiefile and not _cookie_reload_event.is_set()
+                and now - state['checked_at'] < COOKIES_CHECK_INTERVAL):
+            return state['jar'], state['version']
+        state['checked_at'] = now
+
+        try:
+            mtime = os.stat(cookiefile).st_mtime_ns
+        except OSError:
+            mtime = None
+        reload_requested = _cookie_reload_event.is_set()
+        if state['path'] == cookiefile and state['mtime'] == mtime and not reload_requested:
+            return state['jar'], state['version']
+        _cookie_reload_event.clear()
+
+        jar = None
+        if mtime is not None:
+            started = time.perf_counter()
+            try:
+                jar = parse_cookie_file(cookiefile)
+            except Exception as e:
+                # 文件内容有误时继续使用之前的 cookies
+                logger.error(f'解析 cookies 文件失败: {cookiefile}, 错误: {e}')
+                return state['jar'], state['version']
+            state['parse_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+        if state['path'] is not None:
+            state['reloads'] += 1
+        state.update(path=cookiefile, jar=jar, mtime=mtime, version=state['version'] + 1,
+                     loaded_at=time.time(), count=len(jar) if jar is not None else 0)
+        version = state['version']
+
+    if jar is not None:
+        logger.info(f'已加载 cookies: {cookiefile}, 共 {len(jar)} 个, 解析耗时 {state["parse_ms"]}ms'
+                    f'{"（手动重新加载）" if reload_requested else ""}')
+    # 使用旧 cookies 的空闲实例不会再被借出，直接关闭
+    clear_ydl_pool()
+    return jar, version
+
+def request_cookie_reload(signum=None, frame=None):
+    """要求下次使用时重新解析 cookies（SIGHUP 处理函数，只设置标记）"""
+    _cookie_reload_event.set()
+
+def get_cookie_stats():
+    """当前进程的 cookies 状态"""
+    with _cookie_jar_lock:
+        state = dict(_cookie_jar_state)
+    return {
+        'path': state['path'] or COOKIES_FILE,
+        'loaded': state['jar'] is not None,
+        'count': state['count'],
+        'version': state['version'],
+        'loaded_at': state['loaded_at'],
+        'parse_ms': state['parse_ms'],
+        'reloads': state['reloads'],
+        'pid': os.getpid(),
+    }
+
+def is_admin_request(req):
+    """校验管理接口的访问令牌"""
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(req.headers.get('Authorization', ''), f'Bearer {ADMIN_TOKEN}')
+
+@app.route('/api/admin/cookies', methods=['GET', 'POST'])
+def admin_cookies():
+    """
+    查看（GET）或写入（POST）cookies，需要 ADMIN_TOKEN
+    POST 请求体: Netscape 格式文本，或 {"cookies": "文本"} / {"cookies_base64": "Base64 编码"}
+    新文件原子替换后，本进程立即重新解析，其他 worker 在 COOKIES_CHECK_INTERVAL 内发现文件变化
+    """
+    if not ADMIN_TOKEN:
+        return json_response({'error': '未配置 ADMIN_TOKEN，管理接口不可用'}, 403)
+    if not is_admin_request(request):
+        return json_response({'error': '访问令牌无效'}, 401)
+
+    if request.method == 'GET':
+        get_cookie_jar(COOKIES_FILE)
+        return json_response(get_cookie_stats())
+
+    try:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict) and data.get('cookies_base64'):
+            content = base64.b64decode(data['cookies_base64']).decode('utf-8')
+        elif isinstance(data, dict) and data.get('cookies'):
+            content = data['cookies']
+        else:
+            content = request.get_data(as_text=True)
+    except Exception as e:
+        return json_response({'error': f'无法解码 cookies: {e}'}, 400)
+
+    # 先解析校验，有效后才替换正在使用的文件
+    fd, check_path = tempfile.mkstemp(prefix='cookies-check-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        count = len(parse_cookie_file(check_path))
+    except Exception as e:
+        return json_response({'error': f'cookies 格式无效: {e}'}, 400)
+    finally:
+        os.remove(check_path)
+    if count == 0:
+        return json_response({'error': '没有有效的 cookies'}, 400)
+
+    try:
+        write_cookies_file(COOKIES_FILE, content)
+    except Exception as e:
+        logger.error(f'写入 cookies 文件失败: {e}')
+        return json_response({'error': f'写入 cookies 文件失败: {e}'}, 500)
+
+    request_cookie_reload()
+    get_cookie_jar(COOKIES_FILE)
+    logger.info(f'已通过管理接口更新 cookies: {count} 个')
+    return json_response(get_cookie_stats())
+
+def install_cookie_signal_handler():
+    """kill -HUP <worker pid> 让该进程重新解析 cookies（非主线程中无法注册信号）"""
+    try:
+        signal.signal(signal.SIGHUP, request_cookie_reload)
+    except ValueError:
+        pass
 
 # ================ 下载任务管理 ================
-# 使用基于文件的任务存储，解决多 worker 进程间数据共享问题
-# 每个任务存储为独立的 JSON 文件：/tmp/yt-dlp-tasks/{task_id}.json
+# 使用 SQLite（WAL 模式）作为任务注册表，解决多 worker 进程间数据共享问题
+# 所有任务存储在同一个数据库文件中：{CACHE_DIR}/tasks.db
+# status 和 expires_at 两列单独建索引，清理线程只需查询已过期的任务
+
+import sqlite3
 
 # 缓存目录
 CACHE_DIR = os.environ.get('CACHE_DIR', '/tmp/yt-dlp-cache')
 os.makedirs(CACHE_DIR, exist_ok=True)
 
-# 任务文件目录
-TASKS_DIR = os.path.join(CACHE_DIR, 'tasks')
-os.makedirs(TASKS_DIR, exist_ok=True)
+# 任务数据库路径
+TASKS_DB = os.path.join(CACHE_DIR, 'tasks.db')
 
 # 文件过期时间（秒）
 FILE_EXPIRE_TIME = 10 * 60  # 10分钟
 
-# 文件锁目录
-LOCKS_DIR = os.path.join(CACHE_DIR, 'locks')
-os.makedirs(LOCKS_DIR, exist_ok=True)
+# 文件完整送达后仍允许断点续传的时间（秒），之后任务过期
+FILE_DELIVERY_GRACE = int(os.environ.get('FILE_DELIVERY_GRACE', '60'))
+
+# 每个线程持有独立的数据库连接（sqlite3 连接不能跨线程/跨进程共享）
+_db_local = threading.local()
+
+def get_db():
+    """获取当前线程的数据库连接（fork 后自动重建）"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and _db_local.pid == os.getpid():
+        return conn
+
+    # isolation_level=None：自动提交，需要事务时显式 BEGIN
+    conn = sqlite3.connect(TASKS_DB, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    _db_local.conn = conn
+    _db_local.pid = os.getpid()
+    return conn
+
+def init_task_db():
+    """初始化任务表和索引"""
+    conn = get_db()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            expires_at REAL,
+            data TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_expires_at ON tasks (expires_at)')
+    # 跨 worker 共享的计数器（缓存命中率等统计）
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0
+        )
+    ''')
+
+init_task_db()
 
-import fcntl
+def increment_counter(name, amount=1):
+    """累加共享计数器"""
+    try:
+        get_db().execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            (name, amount)
+        )
+    except Exception as e:
+        logger.error(f'更新计数器失败: {name}, 错误: {e}')
 
-def get_task_file_path(task_id):
-    """获取任务文件路径"""
-    return os.path.join(TASKS_DIR, f'{task_id}.json')
+def get_counters(prefix=''):
+    """读取以 prefix 开头的共享计数器"""
+    try:
+        return dict(get_db().execute(
+            'SELECT name, value FROM counters WHERE name LIKE ?', (prefix + '%',)
+        ).fetchall())
+    except Exception as e:
+        logger.error(f'读取计数器失败: {e}')
+        return {}
 
-def get_lock_file_path(task_id):
-    """获取锁文件路径"""
-    return os.path.join(LOCKS_DIR, f'{task_id}.lock')
+def get_task_expires_at(task_data):
+    """
+    根据任务状态计算过期时间，None 表示不会过期（仍在进行中）
 
-def save_task(task_id, task_data):
-    """保存任务数据到文件"""
-    task_file = get_task_file_path(task_id)
-    lock_file = get_lock_file_path(task_id)
+    - 已完成且文件已完整送达：送达后 FILE_DELIVERY_GRACE 过期
+    - 已完成未被下载：完成后 FILE_EXPIRE_TIME 过期
+    - 失败：创建后 FILE_EXPIRE_TIME 过期
+    - 已取消：取消后 FILE_DELIVERY_GRACE 过期（保留一段时间供客户端查询到取消状态）
+    """
+    status = task_data.get('status')
+    if status == 'completed':
+        if task_data.get('download_count', 0) > 0:
+            return task_data.get('delivered_at', 0) + FILE_DELIVERY_GRACE
+        if task_data.get('downloaded_at'):
+            return task_data['downloaded_at'] + FILE_EXPIRE_TIME
+    elif status == 'failed':
+        return task_data.get('created_at', 0) + FILE_EXPIRE_TIME
+    elif status == 'cancelled':
+        return task_data.get('cancelled_at', 0) + FILE_DELIVERY_GRACE
+    return None
 
+def _write_task(conn, task_id, task_data):
+    """写入整条任务记录，同时刷新索引列，并通知清理线程新的过期时间"""
+    expires_at = get_task_expires_at(task_data)
+    conn.execute(
+        'INSERT OR REPLACE INTO tasks (task_id, status, expires_at, data) VALUES (?, ?, ?, ?)',
+        (task_id, task_data.get('status', 'pending'), expires_at,
+         json.dumps(task_data, ensure_ascii=False))
+    )
+    schedule_expiry('task', task_id, expires_at)
+
+def _read_task(conn, task_id):
+    """读取任务记录（可在调用方的事务中使用）"""
+    row = conn.execute('SELECT data FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def save_task(task_id, task_data):
+    """保存任务数据"""
     try:
-        with open(lock_file, 'w') as lf:
-            fcntl.flock(lf.fileno(), fcntl.LOCK_EX)
-            try:
-                with open(task_file, 'w', encoding='utf-8') as f:
-                    json.dump(task_data, f, ensure_ascii=False)
-            finally:
-                fcntl.flock(lf.fileno(), fcntl.LOCK_UN)
+        with metrics_timer('task_store_seconds', op='save'):
+            _write_task(get_db(), task_id, task_data)
     except Exception as e:
         logger.error(f'保存任务数据失败: {task_id}, 错误: {e}')
 
 def load_task(task_id):
-    """从文件加载任务数据"""
-    task_file = get_task_file_path(task_id)
-    lock_file = get_lock_file_path(task_id)
-
-    if not os.path.exists(task_file):
-        return None
-
+    """加载任务数据"""
     try:
-        with open(lock_file, 'w') as lf:
-            fcntl.flock(lf.fileno(), fcntl.LOCK_SH)
-            try:
-                with open(task_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            finally:
-                fcntl.flock(lf.fileno(), fcntl.LOCK_UN)
+        with metrics_timer('task_store_seconds', op='load'):
+            return _read_task(get_db(), task_id)
     except Exception as e:
         logger.error(f'加载任务数据失败: {task_id}, 错误: {e}')
         return None
 
 def update_task(task_id, updates):
-    """更新任务数据"""
-    task_file = get_task_file_path(task_id)
-    lock_file = get_lock_file_path(task_id)
-
+    """更新任务数据（在同一个写事务中读-改-写，保证原子性）"""
+    conn = get_db()
     try:
-        with open(lock_file, 'w') as lf:
-            fcntl.flock(lf.fileno(), fcntl.LOCK_EX)
+        with metrics_timer('task_store_seconds', op='update'):
+            conn.execute('BEGIN IMMEDIATE')
             try:
-                task_data = {}
-                if os.path.exists(task_file):
-                    with open(task_file, 'r', encoding='utf-8') as f:
-                        task_data = json.load(f)
-
+                task_data = _read_task(conn, task_id) or {}
                 task_data.update(updates)
-
-                with open(task_file, 'w', encoding='utf-8') as f:
-                    json.dump(task_data, f, ensure_ascii=False)
-            finally:
-                fcntl.flock(lf.fileno(), fcntl.LOCK_UN)
+                _write_task(conn, task_id, task_data)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
     except Exception as e:
         logger.error(f'更新任务数据失败: {task_id}, 错误: {e}')
 
 def delete_task(task_id):
-    """删除任务文件"""
-    task_file = get_task_file_path(task_id)
-    lock_file = get_lock_file_path(task_id)
-
+    """删除任务记录"""
     try:
-        if os.path.exists(task_file):
-            os.remove(task_file)
-        if os.path.exists(lock_file):
-            os.remove(lock_file)
+        with metrics_timer('task_store_seconds', op='delete'):
+            get_db().execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
     except Exception as e:
-        logger.error(f'删除任务文件失败: {task_id}, 错误: {e}')
+        logger.error(f'删除任务记录失败: {task_id}, 错误: {e}')
 
 def get_all_task_ids():
     """获取所有任务ID"""
     try:
-        task_files = os.listdir(TASKS_DIR)
-        return [f[:-5] for f in task_files if f.endswith('.json')]
+        return [row[0] for row in get_db().execute('SELECT task_id FROM tasks')]
     except Exception as e:
         logger.error(f'获取任务列表失败: {e}')
         return []
 
-def cleanup_expired_files():
-    """清理过期的下载文件"""
+def get_task_ids_by_status(status):
+    """获取指定状态的任务ID（走 status 索引）"""
+    try:
+        return [row[0] for row in get_db().execute('SELECT task_id FROM tasks WHERE status = ?', (status,))]
+    except Exception as e:
+        logger.error(f'按状态获取任务列表失败: {e}')
+        return []
+
+def get_expired_task_ids(now=None):
+    """获取已过期的任务ID（走 expires_at 索引）"""
+    if now is None:
+        now = time.time()
+    try:
+        return [row[0] for row in get_db().execute(
+            'SELECT task_id FROM tasks WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,)
+        )]
+    except Exception as e:
+        logger.error(f'获取过期任务列表失败: {e}')
+        return []
+
+def remove_task_files(filepath, temp_dir):
+    """删除下载文件和临时目录"""
+    # 删除文件
+    if filepath and os.path.exists(filepath):
+        try:
+            os.remove(filepath)
+            logger.info(f'已删除文件: {filepath}')
+        except Exception as e:
+            logger.error(f'删除文件失败: {e}')
+
+    # 删除临时目录
+    if temp_dir and os.path.exists(temp_dir):
+        try:
+            shutil.rmtree(temp_dir)
+            logger.info(f'已删除临时目录: {temp_dir}')
+        except Exception as e:
+            logger.error(f'删除临时目录失败: {e}')
+
+# ================ 监控指标 ================
+# /metrics 以 Prometheus 文本格式输出各阶段耗时直方图、字节数、任务数和缓存命中率
+# 观测只累加到本进程内存，不访问数据库；后台线程定期把增量合并写入共享的 counters 表
+# （metrics. 前缀），因此任意一个 gunicorn worker 返回的都是所有 worker 的汇总值
+
+import atexit
+
+# 指标增量写入共享计数器的间隔（秒）
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+# 直方图的桶上限（秒），覆盖毫秒级的数据库操作到几分钟的下载
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# 累积型指标: 名称 -> (类型, 说明)
+METRICS = {
+    'ytdl_extract_seconds': ('histogram', 'yt-dlp 提取视频信息耗时'),
+    'ytdl_download_seconds': ('histogram', '下载各路流耗时（不含后处理）'),
+    'ytdl_postprocess_seconds': ('histogram', 'ffmpeg 合并等后处理耗时'),
+    'zip_build_seconds': ('histogram', '生成字幕打包清单（CRC 计算、字幕压缩）耗时'),
+    'file_serve_seconds': ('histogram', '/api/file 单次发送耗时'),
+    'task_store_seconds': ('histogram', '任务注册表操作耗时'),
+    'cleanup_pass_seconds': ('histogram', '清理进程单轮清理耗时'),
+    'downloaded_bytes_total': ('counter', '从视频源下载的字节数'),
+    'served_bytes_total': ('counter', '/api/file 实际送达客户端的字节数'),
+    'download_tasks_total': ('counter', '提交的下载任务数（按处理方式）'),
+    'download_tasks_cancelled_total': ('counter', '取消的下载任务数（按原因）'),
+    'bandwidth_throttled_seconds_total': ('counter', '下载任务因带宽调度限速而等待的时间'),
+    'proxy_requests_total': ('counter', '经代理池发出的请求数（按代理和结果）'),
+    'proxy_failovers_total': ('counter', '换用其他代理重试的次数（按原因）'),
+    'upstream_retries_total': ('counter', '上游暂时性错误退避重试的次数（按错误类型）'),
+    'breaker_rejected_total': ('counter', '上游熔断中直接拒绝的请求数'),
+    'breaker_transitions_total': ('counter', '上游熔断器状态切换次数（按切换后的状态）'),
+}
+
+_metrics_pending = {}
+_metrics_lock = threading.Lock()
+_metrics_histogram_keys = {}
+
+def format_metric_labels(labels):
+    """把标签格式化为 key="value",...（不含花括号）"""
+    return ','.join(f'{key}="{value}"' for key, value in labels.items())
+
+def metrics_inc(name, amount=1, **labels):
+    """累加计数器"""
+    series = f'{name}{{{format_metric_labels(labels)}}}' if labels else name
+    with _metrics_lock:
+        _metrics_pending[series] = _metrics_pending.get(series, 0) + amount
+
+def get_histogram_keys(name, labels):
+    """直方图各个序列名（各桶、+Inf、_sum、_count），按名称和标签缓存"""
+    label_text = format_metric_labels(labels)
+    keys = _metrics_histogram_keys.get((name, label_text))
+    if keys is None:
+        prefix = f'{label_text},' if label_text else ''
+        suffix = f'{{{label_text}}}' if label_text else ''
+        buckets = [f'{name}_bucket{{{prefix}le="{le}"}}' for le in METRICS_BUCKETS]
+        keys = (buckets, f'{name}_bucket{{{prefix}le="+Inf"}}', f'{name}_sum{suffix}', f'{name}_count{suffix}')
+        _metrics_histogram_keys[(name, label_text)] = keys
+    return keys
+
+def metrics_observe(name, value, **labels):
+    """记录一次直方图观测（桶为累积计数）"""
+    buckets, inf_key, sum_key, count_key = get_histogram_keys(name, labels)
+    with _metrics_lock:
+        # 未落入的桶也写入 0，保证导出的直方图桶是完整的
+        for le, key in zip(METRICS_BUCKETS, buckets):
+            _metrics_pending[key] = _metrics_pending.get(key, 0) + (1 if value <= le else 0)
+        for key, amount in ((inf_key, 1), (sum_key, value), (count_key, 1)):
+            _metrics_pending[key] = _metrics_pending.get(key, 0) + amount
+
+@contextmanager
+def metrics_timer(name, **labels):
+    """记录代码块耗时（出错时也记录）"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics_observe(name, time.perf_counter() - started, **labels)
+
+class PostprocessTimer:
+    """yt-dlp 后处理回调：记录每个后处理器（Merger、FixupM3u8 等）的耗时，在下载任务中同时记入时间线"""
+
+    def __init__(self):
+        self.total = 0
+        self._started = {}
+
+    def __call__(self, d):
+        name = d.get('postprocessor')
+        if d['status'] == 'started':
+            self._started[name] = time.perf_counter()
+            trace_enter('postprocess', postprocessor=name)
+        elif d['status'] == 'finished' and name in self._started:
+            elapsed = time.perf_counter() - self._started.pop(name)
+            self.total += elapsed
+            metrics_observe('ytdl_postprocess_seconds', elapsed, postprocessor=name)
+            trace_leave()
+
+def record_file_served(kind, sent, started):
+    """记录一次 /api/file 发送的耗时和实际送达的字节数（kind: file / zip）"""
+    metrics_observe('file_serve_seconds', time.perf_counter() - started, kind=kind)
+    if sent > 0:
+        metrics_inc('served_bytes_total', sent, kind=kind)
+
+def flush_metrics():
+    """把本进程累加的增量写入共享计数器，写入失败时放回下次再写"""
+    with _metrics_lock:
+        if not _metrics_pending:
+            return
+        pending = dict(_metrics_pending)
+        _metrics_pending.clear()
+
+    conn = get_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT INTO counters (name, value) VALUES (?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                [(f'metrics.{series}', amount) for series, amount in pending.items()]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception as e:
+        logger.error(f'写入监控指标失败: {e}')
+        with _metrics_lock:
+            for series, amount in pending.items():
+                _metrics_pending[series] = _metrics_pending.get(series, 0) + amount
+
+def metrics_flush_loop():
+    """后台线程：定期写入指标增量"""
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush_metrics()
+
+def get_metric_family(series):
+    """序列名对应的指标名（去掉标签和直方图的 _bucket/_sum/_count 后缀）"""
+    name = series.split('{', 1)[0]
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+def metric_sort_key(series):
+    """同一指标内按标签分组，直方图的桶按上限从小到大排列，_sum/_count 在桶之后"""
+    name, _, labels = series.partition('{')
+    le = re.search(r'le="([^"]+)"', labels)
+    labels = re.sub(r',?le="[^"]+"', '', labels).rstrip('}')
+    return (labels, name, float(le.group(1)) if le else 0)
+
+def format_metric_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def render_metrics():
+    """生成 Prometheus 文本格式的指标"""
+    flush_metrics()
+    families = {}
+    for name, value in get_counters('metrics.').items():
+        series = name[len('metrics.'):]
+        families.setdefault(get_metric_family(series), []).append((series, value))
+
+    lines = []
+    for family, (kind, help_text) in METRICS.items():
+        lines.append(f'# HELP {family} {help_text}')
+        lines.append(f'# TYPE {family} {kind}')
+        for series, value in sorted(families.get(family, []), key=lambda item: metric_sort_key(item[0])):
+            lines.append(f'{series} {format_metric_value(value)}')
+
+    def add(name, kind, help_text, value):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'{name} {format_metric_value(value)}')
+
+    # 任务数（实时查询）
+    conn = get_db()
+    add('download_tasks_active', 'gauge', '正在下载或后处理的任务数', count_active_tasks(conn))
+    add('download_tasks_queued', 'gauge', '排队中的任务数',
+        conn.execute("SELECT COUNT(*) FROM tasks WHERE status = 'pending'").fetchone()[0])
+
+    # 缓存命中率（视频信息缓存 / 下载产物复用）
+    counters = get_counters('info_cache.')
+    hits = counters.get('info_cache.hits', 0)
+    misses = counters.get('info_cache.misses', 0)
+    add('info_cache_hits_total', 'counter', '视频信息缓存命中次数', hits)
+    add('info_cache_misses_total', 'counter', '视频信息缓存未命中次数', misses)
+    add('info_cache_hit_ratio', 'gauge', '视频信息缓存命中率', hits / (hits + misses) if hits + misses else 0)
+
+    submitted = {series: value for series, value in families.get('download_tasks_total', [])}
+    reused = sum(submitted.get(f'download_tasks_total{{mode="{mode}"}}', 0) for mode in ('reused', 'following'))
+    downloaded = submitted.get('download_tasks_total{mode="queued"}', 0)
+    add('artifact_reuse_ratio', 'gauge', '下载任务复用已完成或进行中的相同下载的比例',
+        reused / (reused + downloaded) if reused + downloaded else 0)
+
+    # 磁盘缓存淘汰
+    counters = get_counters('disk_cache.')
+    add('disk_cache_evictions_total', 'counter', '磁盘缓存淘汰的文件数', counters.get('disk_cache.evictions', 0))
+    add('disk_cache_evicted_bytes_total', 'counter', '磁盘缓存淘汰的字节数', counters.get('disk_cache.evicted_bytes', 0))
+    add('disk_cache_rejections_total', 'counter', '因磁盘空间不足拒绝的下载数', counters.get('disk_cache.rejections', 0))
+
+    # 上游熔断器
+    add('upstream_breaker_open', 'gauge', '上游熔断器是否处于熔断（open / half_open）状态',
+        int(_read_breaker(conn)['state'] != 'closed'))
+
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 指标（所有 worker 的汇总值，本进程最近的增量会先写入）"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# 进程退出时写入剩余的增量（写入线程由 start_background_threads 启动）
+atexit.register(flush_metrics)
+
+# ================ 进度写入合并 ================
+# yt-dlp 的进度回调每秒会触发很多次，如果每次都写任务注册表会大量占用 CPU
+# 回调只更新内存中的待写入数据，由后台线程按间隔（或状态变化时立即）批量写入
+
+# 进度写入间隔（秒）
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get('PROGRESS_FLUSH_INTERVAL', '1.0'))
+
+# 全局统计：回调总次数 / 实际写入次数
+PROGRESS_STATS = {'hook_calls': 0, 'flushes': 0}
+
+_progress_writers = {}
+_progress_writers_lock = threading.Lock()
+_progress_flush_event = threading.Event()
+_progress_flusher_thread = None
+
+class ProgressWriter:
+    """合并单个任务的进度更新，写入由后台刷新线程完成，回调永远不会等待数据库"""
+
+    def __init__(self, task_id, status=None):
+        self.task_id = task_id
+        self.hook_calls = 0   # 回调总次数
+        self.flushes = 0      # 实际写入次数
+        self._status = status
+        self._pending = {}
+        self._absorbed = 0    # 自上次写入以来被合并的回调次数
+        self._urgent = False  # 状态发生变化，需要尽快写入
+        self._last_flush = 0
+        self._lock = threading.Lock()        # 保护内存中的待写入数据
+        self._flush_lock = threading.Lock()  # 保证写入按顺序进行
+
+    def push(self, updates, hook=True):
+        """记录一次进度更新（只修改内存，不阻塞）；hook=False 表示不是进度回调（如时间线），不计入回调次数"""
+        with self._lock:
+            self._pending.update(updates)
+            if hook:
+                self.hook_calls += 1
+                self._absorbed += 1
+            status = updates.get('status')
+            if status is not None and status != self._status:
+                self._status = status
+                self._urgent = True
+        if self._urgent:
+            _progress_flush_event.set()
+
+    def is_due(self, now):
+        """是否需要写入"""
+        return bool(self._pending) and (self._urgent or now - self._last_flush >= PROGRESS_FLUSH_INTERVAL)
+
+    def flush(self):
+        """把合并后的更新写入任务注册表"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                updates = self._pending
+                absorbed = self._absorbed
+                self._pending = {}
+                self._absorbed = 0
+                self._urgent = False
+                self._last_flush = time.time()
+                self.flushes += 1
+                updates['progress_stats'] = {
+                    'hook_calls': self.hook_calls,
+                    'flushes': self.flushes,
+                    'last_flush_absorbed': absorbed,
+                }
+
+            update_task(self.task_id, updates)
+
+            with _progress_writers_lock:
+                PROGRESS_STATS['hook_calls'] += absorbed
+                PROGRESS_STATS['flushes'] += 1
+
+def progress_flush_loop():
+    """后台刷新线程：定期把所有任务的待写入进度写入任务注册表"""
     while True:
         try:
-            time.sleep(30)  # 每30秒检查一次
-            current_time = time.time()
-            tasks_to_remove = []
-
-            # 遍历所有任务文件
-            for task_id in get_all_task_ids():
-                task = load_task(task_id)
-                if not task:
-                    continue
+            _progress_flush_event.wait(PROGRESS_FLUSH_INTERVAL)
+            _progress_flush_event.clear()
+
+            now = time.time()
+            with _progress_writers_lock:
+                writers = list(_progress_writers.values())
+            for writer in writers:
+                if writer.is_due(now):
+                    writer.flush()
+        except Exception as e:
+            logger.error(f'进度刷新线程错误: {e}')
+
+def open_progress_writer(task_id, status=None):
+    """为任务创建进度合并器（首次调用时启动刷新线程）"""
+    global _progress_flusher_thread
+
+    writer = ProgressWriter(task_id, status)
+    with _progress_writers_lock:
+        _progress_writers[task_id] = writer
+        if _progress_flusher_thread is None:
+            _progress_flusher_thread = threading.Thread(target=progress_flush_loop, daemon=True)
+            _progress_flusher_thread.start()
+    return writer
+
+def close_progress_writer(writer):
+    """注销进度合并器，并同步写入剩余的更新"""
+    with _progress_writers_lock:
+        _progress_writers.pop(writer.task_id, None)
+    writer.flush()
+    logger.info(f'任务 {writer.task_id} 进度回调 {writer.hook_calls} 次，合并为 {writer.flushes} 次写入')
+
+class StreamProgress:
+    """
+    yt-dlp 进度回调：按各路流（视频流 / 音频流）分别记录字节数，汇总后写入进度合并器
+    两路并行下载时总进度 = 已下载字节合计 / 总字节合计，全部下载完才进入 processing
+    cancelled 被设置后，下一次回调抛出 DownloadCancelled 中止下载（包括分片下载线程）
+    limiter 为任务的带宽限速器：回调在下载线程中同步执行，按新下载的字节数在这里等待即可限速
+    """
 
-                # 跳过正在下载的任务
-                if task['status'] == 'downloading':
-                    continue
+    def __init__(self, writer, cancelled=None, limiter=None):
+        self.writer = writer
+        self.cancelled = cancelled
+        self.limiter = limiter
+        self.format_ids = None  # 需要统计的格式 ID；None 表示统计全部回调
+        self.streams = {}
+        self._lock = threading.Lock()
+
+    def check_cancelled(self):
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise yt_dlp.utils.DownloadCancelled('任务已取消')
+
+    def expect(self, formats):
+        """设置需要统计的各路流（字幕等其他文件的回调会被忽略）"""
+        with self._lock:
+            self.format_ids = {fmt.get('format_id') for fmt in formats}
+
+    def __call__(self, d):
+        self.check_cancelled()
+        key = (d.get('info_dict') or {}).get('format_id')
+        with self._lock:
+            if self.format_ids is not None and key not in self.format_ids:
+                return
+            stream = self.streams.setdefault(key, {'downloaded': 0, 'total': 0, 'speed': 0, 'eta': 0, 'finished': False})
 
-                # 检查是否过期（下载完成后5分钟未被下载，或已被下载过）
-                if task['status'] == 'completed':
-                    # 已被下载过，删除文件和任务
-                    if task.get('download_count', 0) > 0:
-                        tasks_to_remove.append(task_id)
-                        logger.info(f'任务 {task_id} 已被下载，准备清理')
-                    # 超过5分钟未下载
-                    elif task.get('downloaded_at') and (current_time - task['downloaded_at'] > FILE_EXPIRE_TIME):
-                        tasks_to_remove.append(task_id)
-                        logger.info(f'任务 {task_id} 已过期（5分钟未下载），准备清理')
-
-                # 失败的任务也清理
-                elif task['status'] == 'failed':
-                    if current_time - task.get('created_at', 0) > FILE_EXPIRE_TIME:
-                        tasks_to_remove.append(task_id)
-
-            # 清理任务和文件
-            for task_id in tasks_to_remove:
-                task = load_task(task_id)
-                if task:
-                    filepath = task.get('filepath')
-                    temp_dir = task.get('temp_dir')
-
-                    # 删除文件
-                    if filepath and os.path.exists(filepath):
-                        try:
-                            os.remove(filepath)
-                            logger.info(f'已删除文件: {filepath}')
-                        except Exception as e:
-                            logger.error(f'删除文件失败: {e}')
-
-                    # 删除临时目录
-                    if temp_dir and os.path.exists(temp_dir):
-                        try:
-                            shutil.rmtree(temp_dir)
-                            logger.info(f'已删除临时目录: {temp_dir}')
-                        except Exception as e:
-                            logger.error(f'删除临时目录失败: {e}')
-
-                    # 删除任务文件
-                    delete_task(task_id)
-                    logger.info(f'已清理任务: {task_id}')
+            received = 0
+            if d['status'] == 'downloading':
+                received = d.get('downloaded_bytes', 0) - stream['downloaded']
+                stream['downloaded'] = d.get('downloaded_bytes', 0)
+                stream['total'] = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+                stream['speed'] = d.get('speed') or 0
+                stream['eta'] = d.get('eta') or 0
+            elif d['status'] == 'finished':
+                size = d.get('total_bytes') or d.get('downloaded_bytes') or stream['total']
+                stream.update(downloaded=size, total=size, speed=0, eta=0, finished=True)
+            else:
+                return
 
-        except Exception as e:
-            logger.error(f'清理线程错误: {e}')
+            streams = list(self.streams.values())
+            expected = len(self.format_ids) if self.format_ids is not None else len(streams)
+            finished = len(streams) >= expected and all(s['finished'] for s in streams)
+            downloaded = sum(s['downloaded'] for s in streams)
+            total = sum(s['total'] for s in streams)
+            speed = sum(s['speed'] for s in streams)
+            eta = max(s['eta'] for s in streams)
+
+        if finished:
+            self.writer.push({
+                'progress': 100,
+                'downloaded_bytes': downloaded,
+                'total_bytes': total,
+                'status': 'processing'
+            })
+        else:
+            updates = {
+                'progress': round(downloaded / total * 100, 1) if total > 0 else 0,
+                'downloaded_bytes': downloaded,
+                'total_bytes': total,
+                'speed': speed,
+                'eta': eta,
+            }
+            if self.limiter is not None:
+                # 供各 worker 的带宽调度读取
+                updates.update(bandwidth_limit=self.limiter.rate, bandwidth_demand=self.limiter.demand,
+                               throughput=self.limiter.throughput)
+            self.writer.push(updates)
 
-# 启动清理线程
-cleanup_thread = threading.Thread(target=cleanup_expired_files, daemon=True)
-cleanup_thread.start()
-logger.info('已启动文件清理线程')
+        if self.limiter is not None and received > 0:
+            self.limiter.consume(received)
+            self.check_cancelled()
 
 def sanitize_filename(filename, max_length=100):
     """
@@ -308,6 +984,1261 @@ def get_format_selector():
     # 优先选择已经包含音视频的格式，避免 ffmpeg 合并（速度提升 2-3 倍）
     return 'best[height<=720]/best[height<=480]/best[height<=360]/best[height<=1080]/best'
 
+# ================ 任务时间线与采样分析 ================
+# 每个下载任务按顺序记录经过的阶段及起止时间，和任务一起存入注册表，见 /api/task/<task_id>/timeline：
+#   queued（排队，由 created_at / started_at 得出）、upstream_wait（等待上游熔断恢复）、extract（提取信息）、
+#   download（下载各路流）、postprocess（ffmpeg 合并等，每个后处理器一段）、retry_wait（退避重试）、
+#   bundle（生成字幕打包清单）、transfer（每次 /api/file 发送，由发送文件的 worker 追加）
+# 进入新阶段时上一阶段结束；换代理等瞬时事件记为起止时间相同的条目
+# 时间线随进度一起由进度合并器写入，不增加写入次数
+#
+# PROFILE_SAMPLE_RATE > 0 时按该比例抽取下载任务，用 cProfile 分析任务线程（提取信息、下载循环、后处理调度），
+# 结果写入 {CACHE_DIR}/profiles/<task_id>.prof，可用 python -m pstats 或 snakeviz 离线查看；
+# 分片下载线程池中的线程不在分析范围内
+
+import cProfile
+
+# 抽样分析的下载任务比例（0~1），0 表示不分析
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.path.join(CACHE_DIR, 'profiles')
+# 最多保留的分析文件数，超过后删除最早的
+PROFILE_MAX_FILES = 50
+# 时间线中最多记录的发送次数（客户端分段下载时每个 Range 请求一次），超过后合并到最后一条
+TIMELINE_MAX_TRANSFERS = 20
+
+_trace_local = threading.local()
+
+class TaskTimeline:
+    """下载任务的阶段时间线，更新后推送到进度合并器"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.entries = []
+        self._current = None
+        self._lock = threading.Lock()
+
+    def _close(self, now, error=None):
+        if self._current is not None:
+            self._current['end'] = now
+            if error:
+                self._current['error'] = str(error)[:200]
+            self._current = None
+
+    def enter(self, phase, **fields):
+        """结束当前阶段，进入新阶段"""
+        now = round(time.time(), 3)
+        with self._lock:
+            self._close(now)
+            self._current = {'phase': phase, 'start': now, 'end': None, **fields}
+            self.entries.append(self._current)
+        self.publish()
+
+    def leave(self, error=None):
+        """结束当前阶段（失败时记录错误）"""
+        with self._lock:
+            self._close(round(time.time(), 3), error)
+        self.publish()
+
+    def event(self, phase, **fields):
+        """记录一个瞬时事件（不结束当前阶段）"""
+        now = round(time.time(), 3)
+        with self._lock:
+            self.entries.append({'phase': phase, 'start': now, 'end': now, **fields})
+        self.publish()
+
+    def snapshot(self):
+        with self._lock:
+            return [dict(entry) for entry in self.entries]
+
+    def publish(self):
+        if self.writer is not None:
+            self.writer.push({'timeline': self.snapshot()}, hook=False)
+
+def set_task_timeline(timeline):
+    """设置当前线程正在记录的任务时间线（None 表示清除）"""
+    _trace_local.timeline = timeline
+
+def get_task_timeline():
+    """当前线程正在记录的任务时间线，不在下载任务中时返回 None"""
+    return getattr(_trace_local, 'timeline', None)
+
+def trace_enter(phase, **fields):
+    """当前线程在下载任务中时进入新阶段"""
+    timeline = get_task_timeline()
+    if timeline is not None:
+        timeline.enter(phase, **fields)
+
+def trace_leave(error=None):
+    timeline = get_task_timeline()
+    if timeline is not None:
+        timeline.leave(error)
+
+def trace_event(phase, **fields):
+    timeline = get_task_timeline()
+    if timeline is not None:
+        timeline.event(phase, **fields)
+
+def append_transfer(task, start, sent, elapsed):
+    """在任务记录的时间线中追加一次发送（在调用方的写事务中修改 task）"""
+    now = round(time.time(), 3)
+    timeline = task.setdefault('timeline', [])
+    transfers = [entry for entry in timeline if entry['phase'] == 'transfer']
+    if len(transfers) >= TIMELINE_MAX_TRANSFERS:
+        last = transfers[-1]
+        last.update(end=now, bytes=last['bytes'] + sent, requests=last.get('requests', 1) + 1)
+        return
+    timeline.append({'phase': 'transfer', 'start': round(now - elapsed, 3), 'end': now, 'offset': start, 'bytes': sent})
+
+def build_timeline_report(task_id, task):
+    """
+    时间线接口的返回内容：各阶段（含耗时）、按阶段汇总的耗时，以及从提交到最后一个阶段结束的总耗时
+    进行中的阶段（end 为 null）按当前时间计算耗时
+    """
+    now = time.time()
+    phases = []
+    # 排队阶段：已开始下载或仍在排队的任务才有（复用已有下载的任务没有）
+    if task.get('created_at') and (task.get('started_at') or task.get('status') == 'pending'):
+        phases.append({'phase': 'queued', 'start': task['created_at'], 'end': task.get('started_at')})
+    phases.extend(dict(entry) for entry in task.get('timeline', []))
+
+    summary = {}
+    for entry in phases:
+        duration = (entry['end'] or now) - entry['start']
+        entry['duration'] = round(duration, 3)
+        summary[entry['phase']] = round(summary.get(entry['phase'], 0) + duration, 3)
+
+    last_end = max((entry['end'] or now for entry in phases), default=None)
+    report = {
+        'task_id': task_id,
+        'status': task.get('status'),
+        'phases': phases,
+        'summary': summary,
+        'total': round(last_end - task['created_at'], 3) if last_end and task.get('created_at') else None,
+    }
+    if task.get('leader_task_id'):
+        # 跟随相同下载的任务没有自己的下载阶段，见下载任务的时间线
+        report['leader_task_id'] = task['leader_task_id']
+    if task.get('profile'):
+        report['profile'] = task['profile']
+    return report
+
+@app.route('/api/task/<task_id>/timeline', methods=['GET'])
+def task_timeline(task_id):
+    """
+    任务的阶段时间线
+    返回: {"phases": [{"phase", "start", "end", "duration", ...}], "summary": {阶段: 合计秒数}, "total": 总耗时, ...}
+    """
+    task = load_task(task_id)
+    if not task:
+        return json_response({'error': '任务不存在或已过期'}, 404)
+    return json_response(build_timeline_report(task_id, task))
+
+def should_profile_task():
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def save_task_profile(task_id, profiler):
+    """写入任务的分析结果，返回文件名；超过 PROFILE_MAX_FILES 时删除最早的文件"""
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        filename = f'{task_id}.prof'
+        profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+
+        profiles = sorted((entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith('.prof')),
+                          key=lambda entry: entry.stat().st_mtime)
+        for entry in profiles[:-PROFILE_MAX_FILES]:
+            os.remove(entry.path)
+        logger.info(f'任务 {task_id} 的分析结果已写入 {os.path.join(PROFILE_DIR, filename)}')
+        return filename
+    except Exception as e:
+        logger.error(f'写入任务分析结果失败: {task_id}, 错误: {e}')
+        return None
+
+# ================ 下载参数调优 ================
+# 按选中格式的类型（单文件 / DASH 分片 / HLS 分片）选择分片并发数和分块大小，
+# 并根据当前同时下载的任务数分配全局分片并发预算，避免多个任务同时下载时互相挤占
+# 需要合并的格式（视频流 + 音频流）两路并行下载，下载完成后由 ffmpeg 直接复制流封装
+
+from concurrent.futures import ThreadPoolExecutor
+
+# 单个任务的最大分片并发数
+FRAGMENT_CONCURRENCY = int(os.environ.get('FRAGMENT_CONCURRENCY', '8'))
+# 所有任务共享的分片并发总预算
+FRAGMENT_CONCURRENCY_BUDGET = int(os.environ.get('FRAGMENT_CONCURRENCY_BUDGET', '16'))
+# 单文件格式按该大小分块请求（字节），可以绕过 YouTube 对单个长连接的限速
+HTTP_CHUNK_SIZE = int(os.environ.get('HTTP_CHUNK_SIZE', str(10 * 1024 * 1024)))
+# 合并格式的视频流和音频流是否并行下载（yt-dlp 默认逐个下载）
+PARALLEL_STREAMS = os.environ.get('PARALLEL_STREAMS', 'true').lower() == 'true'
+
+# 协议 -> 格式类型
+FORMAT_TYPES = {
+    'http': 'progressive',
+    'https': 'progressive',
+    'http_dash_segments': 'dash',
+    'http_dash_segments_generator': 'dash',
+    'm3u8_native': 'hls',
+    'm3u8': 'hls',
+}
+
+# 各格式类型的下载参数；fragmented 表示按分片下载，需要分配并发预算
+DOWNLOAD_PROFILES = {
+    'progressive': {'fragmented': False, 'http_chunk_size': HTTP_CHUNK_SIZE},
+    'dash': {'fragmented': True, 'http_chunk_size': None},
+    'hls': {'fragmented': True, 'http_chunk_size': None},
+}
+
+def get_format_type(info):
+    """判断选中格式的类型；合并下载时只要有一路是分片格式就按分片处理"""
+    formats = info.get('requested_formats') or [info]
+    types = [FORMAT_TYPES.get((fmt.get('protocol') or '').split('+')[0], 'progressive') for fmt in formats]
+    for format_type in ('dash', 'hls'):
+        if format_type in types:
+            return format_type
+    return 'progressive'
+
+def get_download_profile(info, active_downloads=None):
+    """
+    根据格式类型和当前负载生成 yt-dlp 下载参数
+    分片并发数 = min(单任务上限, 全局预算 / 同时下载的任务数)，至少为 1
+    """
+    format_type = get_format_type(info)
+    profile = DOWNLOAD_PROFILES[format_type]
+
+    concurrency = 1
+    if profile['fragmented']:
+        if active_downloads is None:
+            active_downloads = count_active_tasks()
+        share = FRAGMENT_CONCURRENCY_BUDGET // max(active_downloads, 1)
+        concurrency = max(1, min(FRAGMENT_CONCURRENCY, share))
+
+    return format_type, {
+        'concurrent_fragment_downloads': concurrency,
+        'http_chunk_size': profile['http_chunk_size'],
+    }
+
+def get_requested_formats(info):
+    """返回需要下载的各路流；单一格式时只有一路"""
+    return info.get('requested_formats') or [info]
+
+def can_fetch_streams_parallel(ydl, info, formats):
+    """
+    是否可以预先并行下载合并格式的各路流
+    yt-dlp 能用一个下载器同时下载各路流时（如 dash_segments_generator 用 DashSegmentsFD、ffmpeg 直接合并），
+    不会复用预先下载的分段文件，并行下载只会让带宽翻倍；只有逐路下载且每路都有自己的地址和协议时才并行
+    """
+    if len(formats) < 2 or any(not fmt.get('url') or not fmt.get('protocol') for fmt in formats):
+        return False
+    # 与 yt-dlp 的 process_info 相同的判断（get_suitable_downloader 会修改传入的字典，传副本）
+    return yt_dlp.downloader.get_suitable_downloader(dict(info), ydl.params) is None
+
+def download_streams_parallel(ydl, info):
+    """
+    并行下载合并格式的各路流
+    分段文件名与 yt-dlp 逐个下载时使用的一致（如 标题.f137.mp4 / 标题.f140.m4a），
+    随后的 process_ie_result 会把它们当作已下载的分段，直接进入合并步骤
+    某一路失败时不抛出，交给 process_ie_result 按原流程重试（.part 文件会续传）
+    """
+    formats = info['requested_formats']
+    base = os.path.splitext(ydl.prepare_filename(info, 'temp'))[0]
+
+    def fetch(fmt):
+        stream_info = dict(info)
+        del stream_info['requested_formats']
+        stream_info.update(fmt)
+        filename = yt_dlp.utils.prepend_extension(f'{base}.{fmt["ext"]}', f'f{fmt["format_id"]}', fmt['ext'])
+        started = time.time()
+        success, _ = ydl.dl(filename, stream_info)
+        return fmt['format_id'], success, time.time() - started
+
+    with ThreadPoolExecutor(max_workers=len(formats), thread_name_prefix='stream') as pool:
+        futures = [pool.submit(fetch, fmt) for fmt in formats]
+
+    for future in futures:
+        try:
+            format_id, success, elapsed = future.result()
+            logger.info(f'分段 {format_id} 下载{"完成" if success else "未完成"}, 耗时 {elapsed:.1f}s')
+        except yt_dlp.utils.DownloadCancelled:
+            raise
+        except Exception as e:
+            logger.warning(f'分段并行下载失败，改为逐个下载: {e}')
+
+def download_with_profile(ydl, video_url, on_formats=None, info=None):
+    """
+    先提取信息确定格式类型，套用调优参数后再下载
+    on_formats: 确定要下载的各路流后回调（用于汇总进度）
+    info: 已经用同样的参数提取过的信息（如流式直传判断时提取的），传入时不再重复提取
+    """
+    if info is None:
+        trace_enter('extract')
+        with metrics_timer('ytdl_extract_seconds', source='download'):
+            info = ydl.extract_info(video_url, download=False)
+    format_type, params = get_download_profile(info)
+    formats = get_requested_formats(info)
+    # 没有 ffmpeg 时无法合并，交给 yt-dlp 按原流程报错，不浪费时间先下载
+    parallel = (PARALLEL_STREAMS and info.get('_type', 'video') == 'video'
+                and can_fetch_streams_parallel(ydl, info, formats)
+                and yt_dlp.postprocessor.FFmpegMergerPP(ydl).available)
+    if parallel:
+        # 两路流同时下载，分片并发预算按路数平分
+        params['concurrent_fragment_downloads'] = max(1, params['concurrent_fragment_downloads'] // len(formats))
+    ydl.params.update(params)
+    logger.info(f'下载参数: 格式类型 {format_type}, 分片并发 {params["concurrent_fragment_downloads"]}, '
+                f'分块大小 {params["http_chunk_size"]}, 并行流 {len(formats) if parallel else 1}')
+
+    if on_formats:
+        on_formats(formats)
+
+    # 后处理（合并等）单独计时，下载耗时扣除后处理部分；
+    # 回调注册在本次借出的实例上，归还实例池时随请求参数一起清除
+    postprocess_timer = PostprocessTimer()
+    ydl.add_postprocessor_hook(postprocess_timer)
+    trace_enter('download', format_type=format_type, streams=len(formats) if parallel else 1)
+    started = time.perf_counter()
+    if parallel:
+        download_streams_parallel(ydl, info)
+    info = ydl.process_ie_result(info, download=True)
+    metrics_observe('ytdl_download_seconds', time.perf_counter() - started - postprocess_timer.total,
+                    format_type=format_type)
+    return info
+
+def get_downloaded_file(ydl, info):
+    """下载完成后视频文件的路径"""
+    if 'requested_downloads' in info:
+        return info['requested_downloads'][0]['filepath']
+    return ydl.prepare_filename(info)
+
+# ================ YoutubeDL 实例池 ================
+# 创建 YoutubeDL 需要初始化提取器、网络栈并解析 cookies 文件，开销较大
+# 按“影响初始化的选项”（cookies、代理、输出级别等）的指纹缓存已初始化的实例，
+# 每次请求借出一个实例，只替换输出模板、进度回调、格式等与请求相关的参数
+# 复用实例需要重置 yt-dlp 的几个私有属性（下载计数、播放列表递归记录等），全部集中在 reset_ydl_state 中，
+# 并在重置前检查这些属性；yt-dlp 升级后不再符合预期时停用实例池，每次请求新建实例
+
+from collections import OrderedDict
+
+# 每个指纹最多保留的空闲实例数
+YDL_POOL_SIZE = int(os.environ.get('YDL_POOL_SIZE', '4'))
+# 最多保留的指纹数（超过时关闭最久未使用的指纹下的实例）
+YDL_POOL_MAX_KEYS = int(os.environ.get('YDL_POOL_MAX_KEYS', '8'))
+
+# 每次请求单独设置的参数（借出时覆盖，不参与指纹计算）
+YDL_REQUEST_OPTS = (
+    'outtmpl',
+    'progress_hooks',
+    'postprocessor_hooks',
+    'format',
+    'merge_output_format',
+    'writesubtitles',
+    'writeautomaticsub',
+    'allsubtitles',
+    'subtitleslangs',
+    'concurrent_fragment_downloads',
+    'http_chunk_size',
+    'buffersize',
+    'noresizebuffer',
+    'cookiejar',
+)
+
+# 复用实例时需要重置的 YoutubeDL 私有属性及其类型（按 yt-dlp 2025.x 的实现）
+YDL_RESET_STATE = {
+    '_progress_hooks': list,
+    '_postprocessor_hooks': list,
+    '_num_downloads': int,
+    '_download_retcode': int,
+    '_playlist_level': int,
+    '_playlist_urls': set,
+}
+
+_ydl_pool = OrderedDict()
+_ydl_pool_lock = threading.Lock()
+# 实例池是否可用：reset_ydl_state 发现 yt-dlp 的内部状态与预期不符时关闭
+_ydl_pool_enabled = True
+
+# 实例池统计：新建 / 复用 / 丢弃次数
+YDL_POOL_STATS = {'created': 0, 'reused': 0, 'discarded': 0}
+
+def get_ydl_fingerprint(base_opts, cookie_version=None):
+    """计算实例指纹；cookies 的版本号也计入，重新解析后自动使用新实例"""
+    return json.dumps([sorted(base_opts.items()), cookie_version], default=str)
+
+_pooled_ydl_class = None
+
+def get_pooled_ydl_class():
+    """
+    实例池使用的 YoutubeDL 子类：cookie jar 由参数 cookiejar 传入（每次借出新建，见 copy_cookie_jar），
+    不再读取 cookies 文件；没有传入时与 YoutubeDL 相同
+    """
+    global _pooled_ydl_class
+    if _pooled_ydl_class is None:
+        class PooledYoutubeDL(yt_dlp.YoutubeDL):
+            @property
+            def cookiejar(self):
+                jar = self.params.get('cookiejar')
+                return jar if jar is not None else super().cookiejar
+
+        _pooled_ydl_class = PooledYoutubeDL
+    return _pooled_ydl_class
+
+def ydl_state_resettable(ydl):
+    """实例是否具有 reset_ydl_state 需要重置的全部私有属性（类型相符）"""
+    return (all(isinstance(getattr(ydl, name, None), kind) for name, kind in YDL_RESET_STATE.items())
+            and callable(getattr(ydl, '_parse_outtmpl', None)))
+
+def reset_ydl_state(ydl, ydl_opts):
+    """
+    把复用的实例恢复到与用 ydl_opts 新建时相同的状态（归还时传入空参数，清掉请求相关的回调）
+    只有这里访问 yt-dlp 的私有属性；属性不符合预期时不做任何修改并返回 False，调用方改为新建实例
+    """
+    if not ydl_state_resettable(ydl):
+        return False
+
+    for key in YDL_REQUEST_OPTS:
+        if key in ydl_opts:
+            ydl.params[key] = ydl_opts[key]
+        else:
+            ydl.params.pop(key, None)
+
+    ydl._parse_outtmpl()
+    fmt = ydl.params.get('format')
+    ydl.format_selector = fmt if fmt in (None, '-') else ydl.build_format_selector(fmt)
+    ydl._progress_hooks = list(ydl_opts.get('progress_hooks', []))
+    ydl._postprocessor_hooks = list(ydl_opts.get('postprocessor_hooks', []))
+
+    ydl._num_downloads = 0
+    ydl._download_retcode = 0
+    ydl._playlist_level = 0
+    ydl._playlist_urls = set()
+    return True
+
+def disable_ydl_pool():
+    """yt-dlp 的内部状态与预期不符：停用实例池（只记录一次日志）"""
+    global _ydl_pool_enabled
+    if not _ydl_pool_enabled:
+        return
+    _ydl_pool_enabled = False
+    logger.warning(f'yt-dlp {yt_dlp.version.__version__} 的 YoutubeDL 内部状态与预期不符，停用实例池，每次请求新建实例')
+    clear_ydl_pool()
+
+def close_ydl(ydl):
+    """关闭实例（释放网络连接）"""
+    try:
+        ydl.close()
+    except Exception as e:
+        logger.warning(f'关闭 YoutubeDL 实例失败: {e}')
+
+def clear_ydl_pool():
+    """关闭所有空闲实例（cookies 更新后调用）"""
+    with _ydl_pool_lock:
+        evicted = [ydl for idle in _ydl_pool.values() for ydl in idle]
+        _ydl_pool.clear()
+        YDL_POOL_STATS['discarded'] += len(evicted)
+    for ydl in evicted:
+        close_ydl(ydl)
+
+def checkout_youtube_dl(ydl_opts):
+    """
+    从实例池借出一个 YoutubeDL，返回 (实例, 借出凭据)，用完后必须调用 release_youtube_dl 归还
+    借出期间实例不在池中，清空实例池（cookies 更新、指纹数超限）不会关闭它
+    cookiefile 不交给 YoutubeDL 解析：每次借出时把进程内解析好的 cookies 复制到新的 jar，经参数 cookiejar 传入
+    （上一次请求收到的 Set-Cookie 随之丢弃）
+    """
+    base_opts = {k: v for k, v in ydl_opts.items() if k not in YDL_REQUEST_OPTS}
+    cookie_jar, cookie_version = get_cookie_jar(base_opts.pop('cookiefile', None))
+    fingerprint = get_ydl_fingerprint(base_opts, cookie_version)
+    ydl_opts = {k: v for k, v in ydl_opts.items() if k != 'cookiefile'}
+    ydl_opts['cookiejar'] = copy_cookie_jar(cookie_jar)
+
+    ydl = None
+    with _ydl_pool_lock:
+        idle = _ydl_pool.get(fingerprint)
+        if idle:
+            _ydl_pool.move_to_end(fingerprint)
+            ydl = idle.pop()
+            YDL_POOL_STATS['reused'] += 1
+
+    if ydl is not None and not reset_ydl_state(ydl, ydl_opts):
+        with _ydl_pool_lock:
+            YDL_POOL_STATS['discarded'] += 1
+        close_ydl(ydl)
+        disable_ydl_pool()
+        ydl = None
+
+    if ydl is None:
+        # 新建的实例直接使用完整参数（包括请求相关参数），不需要重置
+        ydl = get_pooled_ydl_class()(ydl_opts)
+        with _ydl_pool_lock:
+            YDL_POOL_STATS['created'] += 1
+    return ydl, (fingerprint, cookie_version)
+
+def release_youtube_dl(ydl, lease, failed=False):
+    """归还 checkout_youtube_dl 借出的实例；failed 表示使用过程中出错，实例直接关闭，不放回池中"""
+    if failed:
+        with _ydl_pool_lock:
+            YDL_POOL_STATS['discarded'] += 1
+        close_ydl(ydl)
+        return
+
+    fingerprint, cookie_version = lease
+    # 网络层创建时引用了本次的 cookie jar：关闭网络连接，下次借出时按新的 jar 重新创建
+    close_ydl(ydl)
+    # 去掉本次请求的回调，避免实例在池中持有请求相关的闭包；无法重置的实例不放回
+    reusable = _ydl_pool_enabled and reset_ydl_state(ydl, {})
+    if _ydl_pool_enabled and not reusable:
+        disable_ydl_pool()
+
+    evicted = []
+    with _ydl_pool_lock:
+        idle = _ydl_pool.setdefault(fingerprint, [])
+        _ydl_pool.move_to_end(fingerprint)
+        # 借出期间 cookies 已重新解析的实例不再放回
+        stale = cookie_version is not None and cookie_version != _cookie_jar_state['version']
+        if len(idle) < YDL_POOL_SIZE and not stale and reusable:
+            idle.append(ydl)
+        else:
+            evicted.append(ydl)
+        while len(_ydl_pool) > YDL_POOL_MAX_KEYS:
+            _, old_idle = _ydl_pool.popitem(last=False)
+            evicted.extend(old_idle)
+        YDL_POOL_STATS['discarded'] += len(evicted)
+
+    for old in evicted:
+        close_ydl(old)
+
+@contextmanager
+def pooled_youtube_dl(ydl_opts):
+    """
+    从实例池借出一个 YoutubeDL，用法与 `with yt_dlp.YoutubeDL(ydl_opts) as ydl` 相同
+    执行过程中抛出异常的实例不会放回池中
+    """
+    ydl, lease = checkout_youtube_dl(ydl_opts)
+    try:
+        yield ydl
+    except BaseException:
+        release_youtube_dl(ydl, lease, failed=True)
+        raise
+    release_youtube_dl(ydl, lease)
+
+# ================ 代理池 ================
+# PROXY_URLS 配置多个代理（逗号或空白分隔，direct 表示直连），每次请求按健康度加权随机选择一个：
+#   - 健康度由观测到的提取耗时、下载速度、被封禁（403/429、人机验证）和连接失败的比例计算（指数滑动平均），
+#     还没有观测数据的项按满分处理，新加入的代理会先被试用
+#   - 被封禁、连接失败或速度过慢后进入冷却期（连续失败时加倍，最长 PROXY_COOLDOWN_MAX 秒），冷却期内不再选择
+#   - 健康度再低也保留 PROXY_MIN_WEIGHT 的权重，表现变差的代理仍会分到少量请求，恢复后能被重新发现
+# 代理统计保存在任务注册表数据库中，所有 worker 共享；只配置一个代理（或没有配置）时无需选择，不记录统计
+# 请求因代理被封禁、连接失败而出错时换一个代理重试；下载任务速度持续低于 PROXY_MIN_THROUGHPUT 时也换代理：
+# 换代理后重新提取（媒体地址可能绑定提取时的出口 IP），已下载的 .part 文件保留，从断点继续下载
+# 选中的代理参与 YoutubeDL 实例池的指纹，配置多个代理时可以相应调大 YDL_POOL_MAX_KEYS
+
+def parse_proxy_list(value):
+    """解析逗号或空白分隔的代理列表（去重，保持顺序）"""
+    return list(dict.fromkeys(proxy for proxy in re.split(r'[\s,]+', value or '') if proxy))
+
+def mask_proxy_url(proxy):
+    """隐藏代理地址中的用户名和密码（用于日志、统计接口和指标标签）"""
+    return re.sub(r'//[^/@]*@', '//***@', proxy)
+
+# 代理列表；兼容原来只配置一个代理的 PROXY_URL
+PROXY_POOL = parse_proxy_list(os.environ.get('PROXY_URLS') or os.environ.get('PROXY_URL'))
+# 代理列表中表示直连的项
+PROXY_DIRECT = 'direct'
+# 单次请求最多换几次代理
+PROXY_MAX_FAILOVERS = int(os.environ.get('PROXY_MAX_FAILOVERS', '2'))
+# 下载速度低于该值（字节/秒）持续 PROXY_SLOW_TIME 秒时换代理续传，0 表示不检查
+PROXY_MIN_THROUGHPUT = int(os.environ.get('PROXY_MIN_THROUGHPUT', str(64 * 1024)))
+PROXY_SLOW_TIME = int(os.environ.get('PROXY_SLOW_TIME', '15'))
+# 失败后的冷却时间（秒），连续失败时加倍
+PROXY_COOLDOWN = int(os.environ.get('PROXY_COOLDOWN', '30'))
+PROXY_COOLDOWN_MAX = 600
+# 最低选择权重
+PROXY_MIN_WEIGHT = 0.05
+# 提取耗时的参考值（秒）：耗时等于该值时延迟系数为 0.5
+PROXY_LATENCY_REF = 1.0
+# 指数滑动平均的系数（新观测值的占比）
+PROXY_EWMA_ALPHA = 0.3
+# 单次下载至少传输这么多字节才计入速度统计（续传时只剩一点的下载速度不可靠）
+PROXY_SAMPLE_BYTES = 1024 * 1024
+
+# 请求结果 -> 说明；ok 以外的结果都会使代理进入冷却期
+PROXY_OUTCOMES = {
+    'ok': '成功',
+    'blocked': '被封禁或限流',
+    'network': '连接失败',
+    'slow': '速度过慢',
+}
+
+# 计入代理统计、换代理重试的错误类型（见 classify_error）；源站 5xx 与代理无关
+PROXY_ERROR_TYPES = ('blocked', 'network', 'slow')
+
+# 判断被封禁的错误信息（异常链中没有 HTTPError 时按信息文本判断）
+PROXY_BLOCKED_PATTERN = re.compile(r'HTTP Error (403|429)|Sign in to confirm|not a bot|rate.?limit', re.IGNORECASE)
+
+if PROXY_POOL:
+    logger.info(f'已配置代理池: {", ".join(mask_proxy_url(proxy) for proxy in PROXY_POOL)}')
+else:
+    logger.info('未配置代理，将直接连接')
+
+def init_proxy_db():
+    """初始化代理统计表"""
+    get_db().execute('''
+        CREATE TABLE IF NOT EXISTS proxy_stats (
+            proxy TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    ''')
+
+init_proxy_db()
+
+def new_proxy_stats():
+    return {
+        'requests': 0, 'ok': 0, 'blocked': 0, 'network': 0, 'slow': 0,
+        'latency': None,        # 提取耗时（秒）
+        'throughput': None,     # 下载速度（字节/秒）
+        'blocked_rate': 0,      # 被封禁的比例
+        'error_rate': 0,        # 连接失败、速度过慢的比例
+        'failures': 0,          # 连续失败次数
+        'cooldown_until': 0,
+        'last_used': None,
+        'last_error': None,
+    }
+
+def ewma(previous, value):
+    return value if previous is None else previous + PROXY_EWMA_ALPHA * (value - previous)
+
+def update_proxy_stats(stats, outcome, latency=None, throughput=None, error=None, now=None):
+    """把一次请求的结果计入代理统计"""
+    if now is None:
+        now = time.time()
+    stats['requests'] += 1
+    stats[outcome] += 1
+    stats['blocked_rate'] = ewma(stats['blocked_rate'], outcome == 'blocked')
+    stats['error_rate'] = ewma(stats['error_rate'], outcome in ('network', 'slow'))
+    if latency is not None:
+        stats['latency'] = ewma(stats['latency'], latency)
+    if throughput:
+        stats['throughput'] = ewma(stats['throughput'], throughput)
+    if outcome == 'ok':
+        stats['failures'] = 0
+    else:
+        stats['failures'] += 1
+        stats['cooldown_until'] = now + min(PROXY_COOLDOWN * 2 ** (stats['failures'] - 1), PROXY_COOLDOWN_MAX)
+        stats['last_error'] = str(error)[:200] if error is not None else PROXY_OUTCOMES[outcome]
+    stats['last_used'] = now
+    return stats
+
+def record_proxy_result(proxy, outcome, latency=None, throughput=None, error=None):
+    """记录一次经代理发出的请求的结果（在同一个写事务中读-改-写）"""
+    metrics_inc('proxy_requests_total', proxy=mask_proxy_url(proxy), outcome=outcome)
+    # 统计只用于在多个代理之间选择，池中不足两个代理时省掉这次写事务
+    if len(PROXY_POOL) < 2:
+        return
+    conn = get_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM proxy_stats WHERE proxy = ?', (proxy,)).fetchone()
+            stats = json.loads(row[0]) if row else new_proxy_stats()
+            update_proxy_stats(stats, outcome, latency, throughput, error)
+            conn.execute('INSERT OR REPLACE INTO proxy_stats (proxy, data) VALUES (?, ?)',
+                         (proxy, json.dumps(stats, ensure_ascii=False)))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception as e:
+        logger.error(f'更新代理统计失败: {mask_proxy_url(proxy)}, 错误: {e}')
+
+def load_proxy_stats():
+    """读取代理池中各代理的统计 {代理: 统计}"""
+    try:
+        rows = get_db().execute('SELECT proxy, data FROM proxy_stats').fetchall()
+    except Exception as e:
+        logger.error(f'读取代理统计失败: {e}')
+        return {}
+    return {proxy: json.loads(data) for proxy, data in rows if proxy in PROXY_POOL}
+
+def get_proxy_score(stats, best_throughput):
+    """
+    健康度（0~1）= 成功系数 × 延迟系数 × 速度系数
+    被封禁比被拖慢更糟，封禁比例按平方计；速度相对池中最快的代理计算
+    """
+    score = (1 - stats['blocked_rate']) ** 2 * (1 - stats['error_rate'])
+    if stats['latency'] is not None:
+        score *= PROXY_LATENCY_REF / (PROXY_LATENCY_REF + stats['latency'])
+    if stats['throughput'] and best_throughput:
+        score *= (stats['throughput'] / best_throughput) ** 0.5
+    return score
+
+def get_proxy_weights(candidates, all_stats, now):
+    """各候选代理的选择权重；冷却期内为 0"""
+    best_throughput = max((stats['throughput'] or 0 for stats in all_stats.values()), default=0)
+    weights = []
+    for proxy in candidates:
+        stats = all_stats.get(proxy) or new_proxy_stats()
+        if stats['cooldown_until'] > now:
+            weights.append(0)
+        else:
+            weights.append(max(get_proxy_score(stats, best_throughput), PROXY_MIN_WEIGHT))
+    return weights
+
+def select_proxy(exclude=()):
+    """
+    按健康度加权随机选择一个代理；没有配置代理或候选都已排除时返回 None
+    候选全部在冷却期时选最早结束冷却的一个
+    """
+    candidates = [proxy for proxy in PROXY_POOL if proxy not in exclude]
+    if len(candidates) <= 1:
+        return candidates[0] if candidates else None
+
+    all_stats = load_proxy_stats()
+    weights = get_proxy_weights(candidates, all_stats, time.time())
+    if not any(weights):
+        return min(candidates, key=lambda proxy: all_stats[proxy]['cooldown_until'])
+    return random.choices(candidates, weights)[0]
+
+def apply_proxy(ydl_opts, proxy):
+    """把选中的代理写入 yt-dlp 参数；direct 显式直连（不使用环境变量中的代理）"""
+    if proxy is None:
+        ydl_opts.pop('proxy', None)
+    else:
+        ydl_opts['proxy'] = '' if proxy == PROXY_DIRECT else proxy
+
+def classify_error(error):
+    """
+    错误分类（沿 yt-dlp 的 DownloadError / ExtractorError 包装的原始异常查找）：
+      blocked  被封禁或限流（403/429、人机验证）
+      network  连接代理或源站失败、超时
+      server   源站 5xx
+    视频不存在、格式不可用等重试也不会成功的错误返回 None
+    """
+    message = str(error)
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, yt_dlp.networking.exceptions.HTTPError):
+            if error.status in (403, 429):
+                return 'blocked'
+            if error.status >= 500:
+                return 'server'
+        elif isinstance(error, (yt_dlp.networking.exceptions.TransportError, TimeoutError, ConnectionError)):
+            return 'network'
+        exc_info = getattr(error, 'exc_info', None)
+        error = (getattr(error, 'cause', None) or (exc_info[1] if exc_info else None)
+                 or error.__cause__ or error.__context__)
+    return 'blocked' if PROXY_BLOCKED_PATTERN.search(message) else None
+
+class ProxyWatchdog:
+    """
+    yt-dlp 进度回调：统计本次尝试经代理下载的字节数和速度
+    armed 时速度连续 PROXY_SLOW_TIME 秒低于 PROXY_MIN_THROUGHPUT 则抛出 DownloadCancelled 中止本次下载，
+    由 run_with_proxy 换代理续传；带宽调度分配的速率本身就低时不判断
+    """
+
+    def __init__(self, limiter=None):
+        self.limiter = limiter
+        self._lock = threading.Lock()
+        self.reset(False)
+
+    def reset(self, armed):
+        """开始新的一次尝试"""
+        with self._lock:
+            self.armed = armed
+            self.tripped = False
+            self._offsets = {}
+            self._bytes = 0
+            self._first_at = None
+            self._window_start = None
+            self._window_bytes = 0
+            self._slow_since = None
+
+    def throughput(self):
+        """本次尝试的平均速度（字节/秒）；传输量太少时统计不可靠，返回 None"""
+        with self._lock:
+            if self._first_at is None or self._bytes < PROXY_SAMPLE_BYTES:
+                return None
+            return round(self._bytes / max(time.monotonic() - self._first_at, 0.001))
+
+    def __call__(self, d):
+        if d['status'] not in ('downloading', 'finished'):
+            return
+        key = d.get('tmpfilename') or d.get('filename')
+        downloaded = d.get('downloaded_bytes') or 0
+        now = time.monotonic()
+        with self._lock:
+            # 第一次看到某个文件时以当前字节数为起点，续传前已下载的部分不计入
+            received = max(downloaded - self._offsets.get(key, downloaded), 0)
+            self._offsets[key] = downloaded
+            self._bytes += received
+            self._window_bytes += received
+            if self._first_at is None:
+                self._first_at = self._window_start = now
+
+            elapsed = now - self._window_start
+            if not self.armed or not PROXY_MIN_THROUGHPUT or d['status'] != 'downloading' or elapsed < 1:
+                return
+            speed = self._window_bytes / elapsed
+            self._window_start = now
+            self._window_bytes = 0
+            rate = self.limiter.rate if self.limiter is not None else None
+            if speed >= PROXY_MIN_THROUGHPUT or (rate and rate < PROXY_MIN_THROUGHPUT * 2):
+                self._slow_since = None
+                return
+            if self._slow_since is None:
+                self._slow_since = now - elapsed
+            if now - self._slow_since < PROXY_SLOW_TIME:
+                return
+            self.tripped = True
+        raise yt_dlp.utils.DownloadCancelled(f'代理下载速度过慢: {speed / 1024:.0f} KB/s')
+
+def run_with_proxy(ydl_opts, fn, watchdog=None, cancelled=None):
+    """
+    按代理池选择代理，借出 YoutubeDL 执行 fn(ydl) 并返回其结果，按结果更新代理统计
+    - 开始前先经过上游熔断器：熔断中时下载任务（有 cancelled）等待恢复，其他请求抛出 CircuitOpenError
+    - 代理被封禁、连接失败或（有 watchdog 时）速度过慢时换一个没试过的代理重试，最多 PROXY_MAX_FAILOVERS 次
+    - 连接失败、源站 5xx 等暂时性错误没有代理可换时，按带随机抖动的指数退避重试，最多 UPSTREAM_RETRIES 次
+    - 最终结果（成功或无法重试的错误）计入熔断器的错误率；作为探测请求却没有结果（被取消）时释放探测名额
+    选中的代理写入 ydl_opts，调用方之后用同一组参数发出的请求（如流式直传）走同一个代理
+    没有 watchdog 时记录 fn 的耗时（提取耗时），有 watchdog 时记录下载速度
+    """
+    probe_id = admit_upstream(cancelled)
+    try:
+        tried = []
+        failovers = 0
+        retries = 0
+        while True:
+            proxy = select_proxy(exclude=tried)
+            apply_proxy(ydl_opts, proxy)
+            can_failover = failovers < PROXY_MAX_FAILOVERS and len(tried) + 1 < len(PROXY_POOL)
+            if watchdog is not None:
+                watchdog.reset(can_failover)
+            started = time.perf_counter()
+            try:
+                with pooled_youtube_dl(ydl_opts) as ydl:
+                    result = fn(ydl)
+            except Exception as e:
+                trace_leave(e)
+                error_type = 'slow' if watchdog is not None and watchdog.tripped else classify_error(e)
+                if proxy is not None and error_type in PROXY_ERROR_TYPES:
+                    throughput = watchdog.throughput() if watchdog is not None else None
+                    record_proxy_result(proxy, error_type, throughput=throughput, error=e)
+                if cancelled is not None and cancelled.is_set():
+                    raise
+
+                if proxy is not None and error_type in PROXY_ERROR_TYPES and can_failover:
+                    logger.warning(f'代理 {mask_proxy_url(proxy)} {PROXY_OUTCOMES[error_type]}，换一个代理重试: {e}')
+                    metrics_inc('proxy_failovers_total', reason=error_type)
+                    trace_event('failover', proxy=mask_proxy_url(proxy), reason=error_type)
+                    tried.append(proxy)
+                    failovers += 1
+                    continue
+
+                if error_type in UPSTREAM_RETRY_ERRORS and retries < UPSTREAM_RETRIES:
+                    delay = get_retry_delay(retries)
+                    retries += 1
+                    logger.warning(f'上游暂时性错误（{error_type}），{delay:.1f}s 后第 {retries} 次重试: {e}')
+                    metrics_inc('upstream_retries_total', error_type=error_type)
+                    trace_enter('retry_wait', error_type=error_type)
+                    # 退避后所有代理重新参与选择（冷却期内的代理仍不会被选中）
+                    tried = []
+                    if cancelled is not None:
+                        if cancelled.wait(delay):
+                            raise
+                    else:
+                        time.sleep(delay)
+                    continue
+
+                record_upstream_result(error_type, e, probe_id)
+                probe_id = None
+                raise
+
+            if proxy is not None:
+                if watchdog is not None:
+                    record_proxy_result(proxy, 'ok', throughput=watchdog.throughput())
+                else:
+                    record_proxy_result(proxy, 'ok', latency=time.perf_counter() - started)
+            record_upstream_result(None, probe_id=probe_id)
+            probe_id = None
+            return result
+    finally:
+        # 探测请求没有留下结果（任务被取消等）：释放探测名额，让下一个请求立即探测
+        if probe_id is not None:
+            release_upstream_probe(probe_id)
+
+def extract_with_proxy(ydl_opts, video_url, source):
+    """经代理池提取信息（不下载），记录提取耗时"""
+    def extract(ydl):
+        with metrics_timer('ytdl_extract_seconds', source=source):
+            return ydl.extract_info(video_url, download=False)
+    return run_with_proxy(ydl_opts, extract)
+
+def get_proxy_report():
+    """代理池中各代理的健康度、当前选择概率和统计"""
+    now = time.time()
+    all_stats = load_proxy_stats()
+    weights = get_proxy_weights(PROXY_POOL, all_stats, now)
+    total_weight = sum(weights)
+    best_throughput = max((stats['throughput'] or 0 for stats in all_stats.values()), default=0)
+
+    proxies = []
+    for proxy, weight in zip(PROXY_POOL, weights):
+        stats = all_stats.get(proxy) or new_proxy_stats()
+        cooldown_until = stats.pop('cooldown_until')
+        if stats['latency'] is not None:
+            stats['latency'] = round(stats['latency'], 3)
+        if stats['throughput'] is not None:
+            stats['throughput'] = round(stats['throughput'])
+        proxies.append({
+            'proxy': mask_proxy_url(proxy),
+            'score': round(get_proxy_score(stats, best_throughput), 3),
+            'share': round(weight / total_weight, 3) if total_weight else 0,
+            'cooldown': round(max(cooldown_until - now, 0), 1),
+            **stats,
+        })
+    return {'proxies': proxies, 'max_failovers': PROXY_MAX_FAILOVERS}
+
+@app.route('/api/proxies', methods=['GET'])
+def proxy_stats():
+    """代理池健康状况"""
+    return json_response(get_proxy_report())
+
+# ================ 上游熔断 ================
+# YouTube 限流（429、“Sign in to confirm”）时，新请求只会撞上同一堵墙，继续请求还会延长封禁
+# 所有 worker 共享一个熔断器，按每个上游请求（换代理、重试之后）的最终结果统计最近 BREAKER_WINDOW 秒的错误率：
+#   - closed：正常放行；请求数达到 BREAKER_MIN_REQUESTS 且错误率达到 BREAKER_ERROR_RATE 时打开
+#   - open：熔断 BREAKER_OPEN_TIME 秒（连续熔断时加倍，最长 BREAKER_OPEN_TIME_MAX 秒）；
+#     /api/info、/api/download 等直接返回 503 + Retry-After，调度线程暂停领取排队任务，已开始的任务等待恢复
+#   - half_open：熔断时间结束后只放行一个探测请求，成功则关闭，失败则重新熔断；
+#     探测请求带有写入熔断器的 probe_id，只有它的结果能切换状态，其他请求的结果只计入统计
+# 只有被封禁、连接失败、源站 5xx 计为错误；视频不存在等错误说明上游工作正常，计为成功
+# 熔断关闭时的成功结果先在内存中按时间桶累计，由后台线程每 BREAKER_FLUSH_INTERVAL 秒合并写入一次；
+# 错误和其他状态下的结果立即写入（同时带上已累计的成功数，保证错误率按完整的计数判断）
+
+# 暂时性错误（连接失败、源站 5xx）的重试次数和退避基数（秒），第 n 次重试前等待 0~基数×2^n 秒（随机抖动）
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', '2'))
+UPSTREAM_RETRY_DELAY = float(os.environ.get('UPSTREAM_RETRY_DELAY', '1'))
+UPSTREAM_RETRY_MAX_DELAY = 10
+# 可以退避重试的错误类型（被封禁时立即重试没有意义，交给换代理和熔断处理）
+UPSTREAM_RETRY_ERRORS = ('network', 'server')
+# 计入熔断错误率的错误类型
+BREAKER_ERROR_TYPES = ('blocked', 'network', 'server')
+
+# 打开熔断的错误率和最少请求数，0 表示不熔断
+BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', '0.5'))
+BREAKER_MIN_REQUESTS = int(os.environ.get('BREAKER_MIN_REQUESTS', '10'))
+# 统计窗口（秒），按 BREAKER_BUCKETS 个时间桶滚动
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', '60'))
+BREAKER_BUCKETS = 6
+# 熔断时间（秒），连续熔断时加倍
+BREAKER_OPEN_TIME = int(os.environ.get('BREAKER_OPEN_TIME', '30'))
+BREAKER_OPEN_TIME_MAX = 300
+# 探测请求的最长等待时间（秒），超时没有结果时放行下一个探测请求
+BREAKER_PROBE_TIMEOUT = 60
+# 成功结果的合并写入间隔（秒）
+BREAKER_FLUSH_INTERVAL = 5
+
+# 本进程还没有写入的成功数：时间桶起点 -> 成功数
+_breaker_pending = {}
+_breaker_pending_lock = threading.Lock()
+_breaker_flusher_thread = None
+
+class CircuitOpenError(Exception):
+    """上游熔断中，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'视频源暂时不可用（限流或连接失败过多），请 {retry_after:.0f} 秒后重试')
+        self.retry_after = retry_after
+
+def init_breaker_db():
+    """初始化熔断器状态表"""
+    get_db().execute('''
+        CREATE TABLE IF NOT EXISTS breakers (
+            name TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    ''')
+
+init_breaker_db()
+
+def new_breaker():
+    return {
+        'state': 'closed',
+        'buckets': {},         # 时间桶起点 -> [成功数, 错误数]
+        'open_until': 0,
+        'probe_until': 0,
+        'probe_id': None,      # 当前探测请求的标识
+        'trips': 0,            # 连续熔断次数
+        'opened_at': None,
+        'last_error': None,
+    }
+
+# 本进程最近一次读到的熔断器状态，/health 直接返回它，不访问数据库（调度线程每轮都会刷新）
+_breaker_snapshot = new_breaker()
+
+def _read_breaker(conn):
+    global _breaker_snapshot
+    row = conn.execute("SELECT data FROM breakers WHERE name = 'upstream'").fetchone()
+    _breaker_snapshot = json.loads(row[0]) if row else new_breaker()
+    return _breaker_snapshot
+
+def _write_breaker(conn, breaker):
+    global _breaker_snapshot
+    conn.execute("INSERT OR REPLACE INTO breakers (name, data) VALUES ('upstream', ?)",
+                 (json.dumps(breaker, ensure_ascii=False),))
+    _breaker_snapshot = breaker
+
+def get_breaker_counts(breaker, now):
+    """去掉窗口外的时间桶，返回窗口内的 (请求数, 错误数)"""
+    oldest = now - BREAKER_WINDOW
+    breaker['buckets'] = {start: counts for start, counts in breaker['buckets'].items() if float(start) > oldest}
+    successes = sum(counts[0] for counts in breaker['buckets'].values())
+    errors = sum(counts[1] for counts in breaker['buckets'].values())
+    return successes + errors, errors
+
+def set_breaker_state(breaker, state, now, error=None):
+    """切换熔断器状态并记录日志和指标"""
+    if state == 'open':
+        breaker['trips'] += 1
+        open_time = min(BREAKER_OPEN_TIME * 2 ** (breaker['trips'] - 1), BREAKER_OPEN_TIME_MAX)
+        breaker.update(open_until=now + open_time, opened_at=now, last_error=str(error)[:200] if error else None)
+        logger.warning(f'上游熔断 {open_time}s（第 {breaker["trips"]} 次）: {breaker["last_error"]}')
+    elif state == 'half_open':
+        breaker.update(probe_until=now + BREAKER_PROBE_TIMEOUT, probe_id=uuid.uuid4().hex)
+        logger.info('上游熔断时间结束，放行探测请求')
+    else:
+        breaker.update(trips=0, buckets={})
+        logger.info('上游已恢复，关闭熔断')
+    if state != 'half_open':
+        breaker['probe_id'] = None
+    breaker['state'] = state
+    metrics_inc('breaker_transitions_total', state=state)
+
+def get_breaker_bucket(now):
+    """时间所在的时间桶起点"""
+    size = BREAKER_WINDOW / BREAKER_BUCKETS
+    return str(int(now // size * size))
+
+def take_pending_successes():
+    """取出本进程累计的成功数（写入失败时用 restore_pending_successes 放回）"""
+    global _breaker_pending
+    with _breaker_pending_lock:
+        pending, _breaker_pending = _breaker_pending, {}
+    return pending
+
+def restore_pending_successes(pending):
+    with _breaker_pending_lock:
+        for bucket, count in pending.items():
+            _breaker_pending[bucket] = _breaker_pending.get(bucket, 0) + count
+
+def merge_pending_successes(breaker, pending):
+    for bucket, count in pending.items():
+        breaker['buckets'].setdefault(bucket, [0, 0])[0] += count
+
+def flush_breaker_successes():
+    """把本进程累计的成功数合并写入熔断器"""
+    pending = take_pending_successes()
+    if not pending:
+        return
+    conn = get_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            breaker = _read_breaker(conn)
+            merge_pending_successes(breaker, pending)
+            get_breaker_counts(breaker, time.time())
+            _write_breaker(conn, breaker)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception as e:
+        restore_pending_successes(pending)
+        logger.error(f'写入熔断器统计失败: {e}')
+
+def breaker_flush_loop():
+    """后台刷新线程：定期写入累计的成功数"""
+    while True:
+        time.sleep(BREAKER_FLUSH_INTERVAL)
+        flush_breaker_successes()
+
+def add_pending_success(now):
+    """在内存中累计一次成功（首次调用时启动刷新线程）"""
+    global _breaker_flusher_thread
+    with _breaker_pending_lock:
+        bucket = get_breaker_bucket(now)
+        _breaker_pending[bucket] = _breaker_pending.get(bucket, 0) + 1
+        if _breaker_flusher_thread is None:
+            _breaker_flusher_thread = threading.Thread(target=breaker_flush_loop, daemon=True)
+            _breaker_flusher_thread.start()
+
+atexit.register(flush_breaker_successes)
+
+def record_upstream_result(error_type, error=None, probe_id=None):
+    """
+    记录一个上游请求的最终结果，按错误率打开熔断，或根据探测请求的结果关闭 / 重新打开
+    probe_id 为 try_admit_upstream 放行探测请求时返回的标识，只有当前探测请求的结果能切换 half_open 状态
+    熔断关闭（本进程最近读到的状态）时的成功结果只在内存中累计，不写数据库
+    """
+    failed = error_type in BREAKER_ERROR_TYPES
+    now = time.time()
+    if not failed and probe_id is None and _breaker_snapshot['state'] == 'closed':
+        add_pending_success(now)
+        return
+
+    pending = take_pending_successes()
+    conn = get_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            breaker = _read_breaker(conn)
+            merge_pending_successes(breaker, pending)
+            breaker['buckets'].setdefault(get_breaker_bucket(now), [0, 0])[1 if failed else 0] += 1
+            requests, errors = get_breaker_counts(breaker, now)
+
+            if breaker['state'] == 'half_open':
+                if probe_id is not None and probe_id == breaker.get('probe_id'):
+                    set_breaker_state(breaker, 'open' if failed else 'closed', now, error)
+            elif (breaker['state'] == 'closed' and failed and BREAKER_ERROR_RATE > 0
+                  and requests >= BREAKER_MIN_REQUESTS and errors / requests >= BREAKER_ERROR_RATE):
+                set_breaker_state(breaker, 'open', now, error)
+            _write_breaker(conn, breaker)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception as e:
+        restore_pending_successes(pending)
+        logger.error(f'更新熔断器状态失败: {e}')
+
+def release_upstream_probe(probe_id):
+    """探测请求没有结果就结束时释放探测名额（不计入成功或失败），下一个请求可以立即发出新的探测"""
+    conn = get_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            breaker = _read_breaker(conn)
+            if breaker['state'] == 'half_open' and breaker.get('probe_id') == probe_id:
+                breaker.update(probe_id=None, probe_until=time.time())
+                _write_breaker(conn, breaker)
+                logger.info('探测请求未完成，释放探测名额')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception as e:
+        logger.error(f'释放探测名额失败: {e}')
+
+def get_breaker_wait(breaker, now):
+    """距离可以发出新请求还要等待的秒数；0 表示正常放行或可以发出探测请求"""
+    if breaker['state'] == 'open':
+        return max(breaker['open_until'] - now, 0)
+    if breaker['state'] == 'half_open':
+        return max(breaker['probe_until'] - now, 0)
+    return 0
+
+def try_admit_upstream():
+    """
+    是否允许发出新的上游请求，返回 (是否允许, 需要等待的秒数, 探测请求标识)
+    熔断时间结束后（或上一个探测请求超时后）在写事务中抢占探测名额，保证只有一个请求去探测；
+    抢到名额时返回写入熔断器的 probe_id，其余情况为 None
+    """
+    conn = get_db()
+    now = time.time()
+    breaker = _read_breaker(conn)
+    if breaker['state'] == 'closed':
+        return True, 0, None
+    wait = get_breaker_wait(breaker, now)
+    if wait > 0:
+        return False, wait, None
+
+    probe_id = None
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        breaker = _read_breaker(conn)
+        wait = get_breaker_wait(breaker, now)
+        if breaker['state'] != 'closed' and wait == 0:
+            set_breaker_state(breaker, 'half_open', now)
+            _write_breaker(conn, breaker)
+            probe_id = breaker['probe_id']
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return wait == 0, wait, probe_id
+
+def admit_upstream(cancelled=None):
+    """
+    熔断中时：下载任务（有 cancelled）等待恢复，取消时抛出 DownloadCancelled；其他请求抛出 CircuitOpenError
+    放行时返回探测请求标识（不是探测请求时为 None），结果需要传给 record_upstream_result
+    """
+    waiting = False
+    while True:
+        allowed, wait, probe_id = try_admit_upstream()
+        if allowed:
+            if waiting:
+                trace_leave()
+            return probe_id
+        if cancelled is None:
+            metrics_inc('breaker_rejected_total')
+            raise CircuitOpenError(wait)
+        if not waiting:
+            waiting = True
+            trace_enter('upstream_wait')
+        if cancelled.wait(min(wait, DOWNLOAD_DISPATCH_INTERVAL * 5)):
+            raise yt_dlp.utils.DownloadCancelled('任务已取消')
+
+def upstream_accepts_work():
+    """调度线程领取新任务前检查：熔断中（探测请求还没有结果）时暂不领取"""
+    breaker = _read_breaker(get_db())
+    return breaker['state'] == 'closed' or get_breaker_wait(breaker, time.time()) == 0
+
+def get_retry_delay(attempt):
+    """第 attempt 次（从 0 开始）重试前的等待秒数：指数退避 + 全随机抖动，避免多个请求同时重试"""
+    return random.uniform(0, min(UPSTREAM_RETRY_DELAY * 2 ** attempt, UPSTREAM_RETRY_MAX_DELAY))
+
+def get_breaker_status():
+    """熔断器状态（本进程最近读到的），用于 /health"""
+    breaker = dict(_breaker_snapshot)
+    now = time.time()
+    requests, errors = get_breaker_counts(breaker, now)
+    return {
+        'state': breaker['state'],
+        'retry_after': round(get_breaker_wait(breaker, now), 1) if breaker['state'] != 'closed' else 0,
+        'requests': requests,
+        'error_rate': round(errors / requests, 3) if requests else 0,
+        'trips': breaker['trips'],
+        'last_error': breaker['last_error'],
+    }
+
+def get_upstream_error_type(error):
+    """错误分类：circuit_open（熔断中）、blocked、network、server，其余返回 None"""
+    if isinstance(error, CircuitOpenError):
+        return 'circuit_open'
+    return classify_error(error)
+
+def describe_upstream_error(error, prefix):
+    """
+    按错误分类生成错误响应，返回 (响应内容, HTTP 状态码, 响应头)：
+    熔断中、被限流返回 503 + Retry-After，连接失败、源站错误返回 502，其余（视频不存在等）返回 400
+    """
+    if isinstance(error, CircuitOpenError):
+        return ({'error': str(error), 'error_type': 'circuit_open'}, 503,
+                {'Retry-After': str(max(1, round(error.retry_after)))})
+    error_type = get_upstream_error_type(error)
+    payload = {'error': f'{prefix}: {error}'}
+    if error_type:
+        payload['error_type'] = error_type
+    if error_type == 'blocked':
+        return payload, 503, {'Retry-After': str(BREAKER_OPEN_TIME)}
+    if error_type in ('network', 'server'):
+        return payload, 502, {}
+    return payload, 400, {}
+
+def upstream_error_response(error, prefix):
+    """describe_upstream_error 的 Flask 响应"""
+    payload, status, headers = describe_upstream_error(error, prefix)
+    response = json_response(payload, status)
+    response.headers.update(headers)
+    return response
+
+
 @app.route('/')
 def index():
     """返回前端页面"""
@@ -315,8 +2246,357 @@ def index():
 
 @app.route('/health')
 def health():
-    """Koyeb 健康检查"""
-    return json_response({'status': 'healthy'})
+    """Koyeb 健康检查，附带上游熔断器状态（熔断不影响实例健康，始终返回 200）"""
+    return json_response({'status': 'healthy', 'upstream': get_breaker_status()})
+
+# ================ 流式直传 ================
+# 选中的格式是单个 http(s) 文件（不需要合并、不需要字幕/后处理）时，
+# /api/download 不再先下载到临时目录，而是边从源站读取边写给客户端：
+#   - 首字节时间约等于信息提取时间，不占用磁盘
+#   - 每次只在内存中持有一个 STREAM_CHUNK_SIZE 大小的块
+#   - 按 STREAM_RANGE_SIZE 分段发起 Range 请求，避免源站对单个长连接限速
+
+from urllib.parse import quote
+
+# 是否对符合条件的 /api/download 请求启用流式直传（请求体中的 stream 参数可以覆盖）
+STREAM_DOWNLOADS = os.environ.get('STREAM_DOWNLOADS', '1') == '1'
+# 每次读取和写出的字节数
+STREAM_CHUNK_SIZE = 256 * 1024
+# 每个 Range 请求的字节数
+STREAM_RANGE_SIZE = 10 * 1024 * 1024
+# 可以直接流式读取的协议
+STREAMABLE_PROTOCOLS = ('http', 'https')
+
+# 视频扩展名对应的 MIME 类型
+VIDEO_MIMETYPES = {
+    'mp4': 'video/mp4',
+    'webm': 'video/webm',
+    'mkv': 'video/x-matroska',
+    'avi': 'video/x-msvideo',
+    'mov': 'video/quicktime',
+}
+
+def content_disposition(filename):
+    """生成附件下载的 Content-Disposition 头（兼容非 ASCII 文件名）"""
+    ascii_name = filename.encode('ascii', 'ignore').decode('ascii').replace('"', '') or 'video'
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+def get_streamable_format(info):
+    """
+    返回可以直接流式传输的单文件格式，不符合条件返回 None
+    选择结果需要合并时，如果视频流本身已含音频，则直接使用视频流
+    """
+    fmt = info
+    if info.get('requested_formats'):
+        video_fmt = info['requested_formats'][0]
+        if video_fmt.get('acodec') in (None, 'none'):
+            return None
+        fmt = video_fmt
+
+    if fmt.get('protocol') not in STREAMABLE_PROTOCOLS or not fmt.get('url'):
+        return None
+    return fmt
+
+def open_media_range(ydl, media_url, http_headers, start):
+    """请求媒体文件从 start 开始的一段（STREAM_RANGE_SIZE 字节）"""
+    headers = dict(http_headers or {})
+    headers['Range'] = f'bytes={start}-{start + STREAM_RANGE_SIZE - 1}'
+    return ydl.urlopen(yt_dlp.networking.Request(media_url, headers=headers))
+
+def get_media_size(response):
+    """
+    由源站响应头得到文件总长度：206 取 Content-Range 中的总长度，
+    200（源站不支持 Range，返回完整文件）取 Content-Length；无法确定时返回 None
+    """
+    if response.status == 206:
+        match = re.match(r'bytes \d+-\d+/(\d+)', response.headers.get('Content-Range', ''))
+        return int(match.group(1)) if match else None
+    length = response.headers.get('Content-Length', '')
+    return int(length) if length.isdigit() else None
+
+def iter_media_chunks(ydl, media_url, http_headers, response=None):
+    """分段读取媒体文件，逐块产出数据；response 为已经打开的第一段"""
+    start = 0
+    total = None
+
+    while total is None or start < total:
+        if response is None:
+            try:
+                response = open_media_range(ydl, media_url, http_headers, start)
+            except yt_dlp.networking.exceptions.HTTPError as e:
+                # 总长度未知时，越界请求表示已经读完
+                if e.status == 416 and total is None and start > 0:
+                    return
+                raise
+
+        with response:
+            received = 0
+            while True:
+                chunk = response.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+                yield chunk
+
+            # 源站不支持 Range，已经一次性返回了完整文件
+            if response.status != 206:
+                return
+
+            total = get_media_size(response)
+            if total is None and received < STREAM_RANGE_SIZE:
+                return
+
+        response = None
+        if not received:
+            return
+        start += received
+
+def stream_download(video_url, ydl_opts):
+    """
+    尝试以流式直传方式响应 /api/download，返回 (响应, 提取到的信息)
+    选中的格式不适合直传时响应为 None，由调用方用提取到的信息退回到先下载再发送的方式（不再重复提取）
+    """
+    # 媒体地址可能绑定提取时的出口 IP，之后的流式读取使用同一个代理（已写入 ydl_opts）
+    info = extract_with_proxy(ydl_opts, video_url, 'stream')
+
+    fmt = get_streamable_format(info)
+    if not fmt:
+        return None, info
+
+    video_ext = fmt.get('ext') or info.get('ext', 'mp4')
+    final_filename = f'{sanitize_filename(info.get("title", "video"))}.{video_ext}'
+    media_url = fmt['url']
+    http_headers = fmt.get('http_headers') or {}
+
+    # 第一段和之后的分段使用同一个借出的实例（第一段的连接属于它），直到传输结束才归还：
+    # 归还后实例可能被实例池关闭，正在读取的连接会随之中断
+    ydl, lease = checkout_youtube_dl(ydl_opts)
+    released = False
+
+    def release(failed=False):
+        nonlocal released
+        if not released:
+            released = True
+            release_youtube_dl(ydl, lease, failed)
+
+    # 先打开第一段：提取结果中的 filesize 可能只是估计值，Content-Length 以源站响应为准
+    try:
+        first_range = open_media_range(ydl, media_url, http_headers, 0)
+    except BaseException:
+        release(failed=True)
+        raise
+    total = get_media_size(first_range)
+
+    def generate():
+        sent = 0
+        chunks = iter_media_chunks(ydl, media_url, http_headers, first_range)
+        try:
+            for chunk in chunks:
+                sent += len(chunk)
+                yield chunk
+        except GeneratorExit:
+            # 客户端断开连接，实例仍然可以放回池中
+            logger.info(f'客户端中断流式下载: {final_filename}, 已发送 {sent / 1024 / 1024:.2f} MB')
+            return
+        except BaseException:
+            release(failed=True)
+            raise
+        finally:
+            chunks.close()
+            release()
+        logger.info(f'流式下载完成: {final_filename}, 大小: {sent / 1024 / 1024:.2f} MB')
+
+    headers = {'Content-Disposition': content_disposition(final_filename)}
+    if total is not None:
+        headers['Content-Length'] = str(total)
+
+    logger.info(f'流式下载: {info.get("title")}, 格式: {fmt.get("format_id")}')
+    response = Response(
+        generate(),
+        mimetype=VIDEO_MIMETYPES.get(video_ext, 'application/octet-stream'),
+        headers=headers,
+        direct_passthrough=True,
+    )
+    # 客户端在开始读取前断开时，生成器不会执行，由这里关闭第一段的连接并归还实例
+    response.call_on_close(first_range.close)
+    response.call_on_close(release)
+    return response, info
+
+
+# ================ 流式 ZIP 打包 ================
+# 视频 + 字幕打包下载时不再在磁盘上生成 zip 文件：
+#   - 下载完成时只生成清单（文件路径、大小、CRC32），视频按 stored 方式存入，字幕在内存中 deflate
+#   - 请求 /api/file 时按清单实时生成 zip 字节流，总长度可以预先算出，因此能返回 Content-Length
+#   - 文件或偏移超过 4GB 时自动使用 ZIP64 扩展
+
+import zlib
+import struct
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+# 超过该值的大小/偏移使用 ZIP64 扩展（与 Python zipfile 一致，留出有符号 32 位的余量）
+ZIP64_LIMIT = (1 << 31) - 1
+# ZIP64 条目中 32 位字段填写的占位值
+ZIP64_MARKER = 0xFFFFFFFF
+# 文件名使用 UTF-8 编码（通用标志位 11）
+ZIP_FLAG_UTF8 = 0x0800
+
+def _file_crc32(path):
+    """分块计算文件的 CRC32"""
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+
+def _deflate_file(path):
+    """以 raw deflate 方式压缩文件（结果是确定的，每次压缩得到相同字节）"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return data, compressor.compress(data) + compressor.flush()
+
+def build_bundle_manifest(files):
+    """
+    生成打包清单
+    files: [(文件路径, 压缩包内文件名, 是否压缩)]
+    """
+    started = time.perf_counter()
+    entries = []
+    for path, arcname, compress in files:
+        entry = {
+            'path': path,
+            'arcname': arcname,
+            'method': ZIP_DEFLATED if compress else ZIP_STORED,
+            'mtime': os.path.getmtime(path),
+        }
+        if compress:
+            data, compressed = _deflate_file(path)
+            entry.update({'size': len(data), 'compressed_size': len(compressed), 'crc32': zlib.crc32(data)})
+        else:
+            size = os.path.getsize(path)
+            entry.update({'size': size, 'compressed_size': size, 'crc32': _file_crc32(path)})
+        entries.append(entry)
+    metrics_observe('zip_build_seconds', time.perf_counter() - started)
+    return {'entries': entries}
+
+def _dos_datetime(timestamp):
+    """转换为 zip 使用的 DOS 日期和时间"""
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+class StreamingZip:
+    """按清单生成 zip 字节流；布局在构造时确定，size 即最终文件大小"""
+
+    def __init__(self, manifest):
+        self.segments = []  # 依次输出的片段：bytes 或 (entry, 数据长度)
+        central = []
+        offset = 0
+
+        for entry in manifest['entries']:
+            name = entry['arcname'].encode('utf-8')
+            dos_time, dos_date = _dos_datetime(entry['mtime'])
+            size, csize = entry['size'], entry['compressed_size']
+            zip64 = size >= ZIP64_LIMIT or csize >= ZIP64_LIMIT or offset >= ZIP64_LIMIT
+            version = 45 if zip64 else 20
+
+            if zip64:
+                local_extra = struct.pack('<HHQQ', 0x0001, 16, size, csize)
+                local_sizes = (ZIP64_MARKER, ZIP64_MARKER)
+            else:
+                local_extra = b''
+                local_sizes = (csize, size)
+            local_header = struct.pack(
+                '<IHHHHHIIIHH', 0x04034b50, version, ZIP_FLAG_UTF8, entry['method'],
+                dos_time, dos_date, entry['crc32'], local_sizes[0], local_sizes[1],
+                len(name), len(local_extra)
+            ) + name + local_extra
+
+            if zip64:
+                central_extra = struct.pack('<HHQQQ', 0x0001, 24, size, csize, offset)
+                central_fields = (ZIP64_MARKER, ZIP64_MARKER, ZIP64_MARKER)
+            else:
+                central_extra = b''
+                central_fields = (csize, size, offset)
+            central.append(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, ZIP_FLAG_UTF8,
+                entry['method'], dos_time, dos_date, entry['crc32'], central_fields[0], central_fields[1],
+                len(name), len(central_extra), 0, 0, 0, 0o100644 << 16, central_fields[2]
+            ) + name + central_extra)
+
+            self.segments.append(local_header)
+            self.segments.append((entry, csize))
+            offset += len(local_header) + csize
+
+        central_dir = b''.join(central)
+        count = len(central)
+        end = b''
+        if offset >= ZIP64_LIMIT or len(central_dir) >= ZIP64_LIMIT or count >= 0xFFFF:
+            zip64_end_offset = offset + len(central_dir)
+            end += struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, len(central_dir), offset
+            )
+            end += struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+            end += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, ZIP64_MARKER, ZIP64_MARKER, 0)
+        else:
+            end += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, len(central_dir), offset, 0)
+
+        self.segments.append(central_dir + end)
+        self.size = offset + len(central_dir) + len(end)
+
+    @staticmethod
+    def _iter_entry_data(entry, start, end):
+        """产出单个条目数据中 [start, end) 的部分（stored 直接读文件，deflated 重新压缩）"""
+        if entry['method'] == ZIP_DEFLATED:
+            yield _deflate_file(entry['path'])[1][start:end]
+            return
+        with open(entry['path'], 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    def iter_range(self, start, end):
+        """产出 zip 文件中 [start, end) 范围的字节"""
+        offset = 0
+        for segment in self.segments:
+            length = len(segment) if isinstance(segment, bytes) else segment[1]
+            seg_start, seg_end = max(start - offset, 0), min(end - offset, length)
+            if seg_start < seg_end:
+                if isinstance(segment, bytes):
+                    yield segment[seg_start:seg_end]
+                else:
+                    yield from self._iter_entry_data(segment[0], seg_start, seg_end)
+            offset += length
+            if offset >= end:
+                return
+
+    def __iter__(self):
+        return self.iter_range(0, self.size)
+
+def bundle_response(manifest, filename):
+    """以流式 zip 响应返回打包文件"""
+    bundle = StreamingZip(manifest)
+    return Response(
+        iter(bundle),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': content_disposition(filename),
+            'Content-Length': str(bundle.size),
+        },
+        direct_passthrough=True,
+    )
+
 
 @app.route('/api/download', methods=['POST'])
 def download_video():
@@ -325,8 +2605,10 @@ def download_video():
     请求体: {
         "url": "YouTube视频URL",
         "format_id": "格式ID（可选，不传则自动选择最佳）",
-        "subtitle": "字幕语言代码（可选）"
+        "subtitle": "字幕语言代码（可选）",
+        "stream": "是否允许流式直传（可选，默认由 STREAM_DOWNLOADS 决定）"
     }
+    不需要字幕、选中的格式是单个文件时，边下载边返回，不落盘
     """
     try:
         data = request.get_json()
@@ -338,15 +2620,12 @@ def download_video():
         format_id = data.get('format_id')
         subtitle_lang = data.get('subtitle')
 
-        logger.info(f'开始下载视频: {video_url}, 格式: {format_id}, 字幕: {subtitle_lang}')
+        use_stream = data.get('stream', STREAM_DOWNLOADS)
 
-        # 创建临时目录
-        temp_dir = tempfile.mkdtemp()
-        output_template = os.path.join(temp_dir, '%(title)s.%(ext)s')
+        logger.info(f'开始下载视频: {video_url}, 格式: {format_id}, 字幕: {subtitle_lang}')
 
         # 配置 yt-dlp 选项
         ydl_opts = {
-            'outtmpl': output_template,
             'quiet': False,
             'no_warnings': False,
             'extract_flat': False,
@@ -373,82 +2652,82 @@ def download_video():
         else:
             logger.warning('未配置或未找到 cookies.txt 文件')
 
-        if PROXY_URL:
-            ydl_opts['proxy'] = PROXY_URL
-            logger.info(f'使用代理: {PROXY_URL}')
-
-        # 下载视频
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
-
-            # 获取下载的文件路径
-            if 'requested_downloads' in info:
-                video_file = info['requested_downloads'][0]['filepath']
-            else:
-                video_file = ydl.prepare_filename(info)
-
-            if not os.path.exists(video_file):
-                logger.error(f'视频文件不存在: {video_file}')
-                return json_response({'error': '视频下载失败'}, 500)
-
-            video_title = info.get('title', 'video')
-            video_ext = info.get('ext', 'mp4')
-            file_size = os.path.getsize(video_file)
-
-            clean_title = sanitize_filename(video_title)
-            final_filename = f'{clean_title}.{video_ext}'
-
-            logger.info(f'视频下载成功: {video_title}, 大小: {file_size / 1024 / 1024:.2f} MB')
-
-            # 检查是否有字幕文件需要打包
-            subtitle_file = None
-            if subtitle_lang:
-                # 查找字幕文件
-                for ext in ['vtt', 'srt', 'ass']:
-                    sub_path = os.path.join(temp_dir, f'{os.path.splitext(os.path.basename(video_file))[0]}.{subtitle_lang}.{ext}')
-                    if os.path.exists(sub_path):
-                        subtitle_file = sub_path
-                        break
-
-            # 如果有字幕，打包成 zip
-            if subtitle_file:
-                import zipfile
-                zip_filename = f'{clean_title}.zip'
-                zip_path = os.path.join(temp_dir, zip_filename)
-
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-                    zf.write(video_file, final_filename)
-                    sub_ext = os.path.splitext(subtitle_file)[1]
-                    zf.write(subtitle_file, f'{clean_title}.{subtitle_lang}{sub_ext}')
-
-                logger.info(f'打包视频和字幕: {zip_filename}')
-                return send_file(
-                    zip_path,
-                    as_attachment=True,
-                    download_name=zip_filename,
-                    mimetype='application/zip'
-                )
+        # 不需要字幕时优先流式直传；不适合直传时沿用已经提取的信息
+        extracted = None
+        if use_stream and not subtitle_lang:
+            response, extracted = stream_download(video_url, ydl_opts)
+            if response is not None:
+                return response
+        extracted_proxy = ydl_opts.get('proxy')
 
-            # 没有字幕，直接返回视频
-            mimetype_map = {
-                'mp4': 'video/mp4',
-                'webm': 'video/webm',
-                'mkv': 'video/x-matroska',
-                'avi': 'video/x-msvideo',
-                'mov': 'video/quicktime',
-            }
-            mimetype = mimetype_map.get(video_ext, 'application/octet-stream')
-
-            return send_file(
-                video_file,
-                as_attachment=True,
-                download_name=final_filename,
-                mimetype=mimetype
-            )
+        # 创建临时目录
+        temp_dir = tempfile.mkdtemp()
+        ydl_opts['outtmpl'] = os.path.join(temp_dir, '%(title)s.%(ext)s')
+
+        # 下载视频（按格式类型和当前负载套用分片并发等参数；代理出问题时换代理续传）
+        watchdog = ProxyWatchdog()
+        ydl_opts['progress_hooks'] = [watchdog]
+        if len(PROXY_POOL) > 1:
+            ydl_opts['buffersize'] = BANDWIDTH_BLOCK_SIZE
+            ydl_opts['noresizebuffer'] = True
+
+        def download(ydl):
+            nonlocal extracted
+            # 只有第一次尝试、且与提取时使用同一个代理时才沿用（媒体地址可能绑定出口 IP）
+            info = extracted if ydl.params.get('proxy') == extracted_proxy else None
+            extracted = None
+            info = download_with_profile(ydl, video_url, info=info)
+            return info, get_downloaded_file(ydl, info)
+
+        info, video_file = run_with_proxy(ydl_opts, download, watchdog)
+        if not os.path.exists(video_file):
+            logger.error(f'视频文件不存在: {video_file}')
+            return json_response({'error': '视频下载失败'}, 500)
+
+        video_title = info.get('title', 'video')
+        video_ext = info.get('ext', 'mp4')
+        file_size = os.path.getsize(video_file)
+
+        clean_title = sanitize_filename(video_title)
+        final_filename = f'{clean_title}.{video_ext}'
+
+        logger.info(f'视频下载成功: {video_title}, 大小: {file_size / 1024 / 1024:.2f} MB')
+
+        # 检查是否有字幕文件需要打包
+        subtitle_file = None
+        if subtitle_lang:
+            # 查找字幕文件
+            for ext in ['vtt', 'srt', 'ass']:
+                sub_path = os.path.join(temp_dir, f'{os.path.splitext(os.path.basename(video_file))[0]}.{subtitle_lang}.{ext}')
+                if os.path.exists(sub_path):
+                    subtitle_file = sub_path
+                    break
+
+        # 如果有字幕，流式打包成 zip（视频不压缩，字幕 deflate）
+        if subtitle_file:
+            zip_filename = f'{clean_title}.zip'
+            sub_ext = os.path.splitext(subtitle_file)[1]
+            manifest = build_bundle_manifest([
+                (video_file, final_filename, False),
+                (subtitle_file, f'{clean_title}.{subtitle_lang}{sub_ext}', True),
+            ])
+
+            logger.info(f'打包视频和字幕: {zip_filename}')
+            return bundle_response(manifest, zip_filename)
+
+        # 没有字幕，直接返回视频
+        mimetype = VIDEO_MIMETYPES.get(video_ext, 'application/octet-stream')
+
+        return send_file(
+            video_file,
+            as_attachment=True,
+            download_name=final_filename,
+            mimetype=mimetype
+        )
 
-    except yt_dlp.utils.DownloadError as e:
+    except (yt_dlp.utils.DownloadError, CircuitOpenError) as e:
         logger.error(f'下载错误: {str(e)}')
-        return json_response({'error': f'下载失败: {str(e)}'}, 400)
+        return upstream_error_response(e, '下载失败')
     except Exception as e:
         logger.error(f'服务器错误: {str(e)}')
         return json_response({'error': f'服务器错误: {str(e)}'}, 500)
@@ -456,9 +2735,14 @@ def download_video():
 
 # ================ 异步下载相关接口 ================
 
-def download_video_task(task_id, video_url, format_id, subtitle_lang):
-    """后台下载视频的任务函数"""
+def download_video_task(task_id, video_url, format_id, subtitle_lang, cancelled=None, limiter=None):
+    """
+    后台下载视频的任务函数
+    cancelled 被设置后中止下载（见取消任务），limiter 按带宽调度分配的速率限速（见带宽调度）
+    """
     temp_dir = None
+    progress_writer = None
+    timeline = None
     try:
         # 创建临时目录
         temp_dir = tempfile.mkdtemp(dir=CACHE_DIR)
@@ -470,33 +2754,12 @@ def download_video_task(task_id, video_url, format_id, subtitle_lang):
             'status': 'downloading'
         })
 
-        # 进度回调函数
-        def progress_hook(d):
-            task = load_task(task_id)
-            if not task:
-                return
-
-            if d['status'] == 'downloading':
-                total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
-                downloaded = d.get('downloaded_bytes', 0)
-
-                if total > 0:
-                    progress = (downloaded / total) * 100
-                else:
-                    progress = 0
-
-                update_task(task_id, {
-                    'progress': round(progress, 1),
-                    'downloaded_bytes': downloaded,
-                    'total_bytes': total,
-                    'speed': d.get('speed', 0),
-                    'eta': d.get('eta', 0),
-                })
-            elif d['status'] == 'finished':
-                update_task(task_id, {
-                    'progress': 100,
-                    'status': 'processing'
-                })
+        # 进度回调（按视频流 / 音频流汇总，只写内存，由 progress_writer 合并后写入）
+        progress_writer = open_progress_writer(task_id, 'downloading')
+        timeline = TaskTimeline(progress_writer)
+        set_task_timeline(timeline)
+        progress_hook = StreamProgress(progress_writer, cancelled, limiter)
+        watchdog = ProxyWatchdog(limiter)
 
         # 配置 yt-dlp 选项
         ydl_opts = {
@@ -505,7 +2768,7 @@ def download_video_task(task_id, video_url, format_id, subtitle_lang):
             'no_warnings': True,
             'extract_flat': False,
             'nocheckcertificate': True,
-            'progress_hooks': [progress_hook],
+            'progress_hooks': [progress_hook, watchdog],
         }
 
         # 设置格式
@@ -524,83 +2787,975 @@ def download_video_task(task_id, video_url, format_id, subtitle_lang):
         if COOKIES_FILE and os.path.exists(COOKIES_FILE):
             ydl_opts['cookiefile'] = COOKIES_FILE
 
-        if PROXY_URL:
-            ydl_opts['proxy'] = PROXY_URL
+        # 带宽调度限速或代理池需要检测速度时使用固定的读取块大小：yt-dlp 默认会把块增大到几 MB，
+        # 限速不平滑；代理突然变慢时一个块要读很久，期间没有进度回调，无法及时发现
+        if BANDWIDTH_LIMIT > 0 or len(PROXY_POOL) > 1:
+            ydl_opts['buffersize'] = BANDWIDTH_BLOCK_SIZE
+            ydl_opts['noresizebuffer'] = True
+
+        # 下载视频（按格式类型和当前负载套用分片并发等参数）
+        # 确定要下载的各路流后：设置进度汇总，并检查缓存空间是否足够
+        def on_formats(formats):
+            progress_hook.check_cancelled()
+            progress_hook.expect(formats)
+            ensure_cache_space(task_id, formats)
+
+        # 代理被封禁、连接失败或速度过慢时换代理重新提取，从 .part 文件断点续传
+        def download(ydl):
+            info = download_with_profile(ydl, video_url, on_formats=on_formats)
+            return info, get_downloaded_file(ydl, info)
+
+        info, video_file = run_with_proxy(ydl_opts, download, watchdog, cancelled)
+        metrics_inc('downloaded_bytes_total', sum(stream['downloaded'] for stream in progress_hook.streams.values()))
+        if not os.path.exists(video_file):
+            raise Exception('视频文件不存在')
+
+        video_title = info.get('title', 'video')
+        video_ext = info.get('ext', 'mp4')
+        file_size = os.path.getsize(video_file)
+
+        clean_title = sanitize_filename(video_title)
+        final_filename = f'{clean_title}.{video_ext}'
+        final_filepath = video_file
+        final_mimetype = 'video/mp4'
+
+        # 检查是否有字幕文件需要打包
+        subtitle_file = None
+        if subtitle_lang:
+            for ext in ['vtt', 'srt', 'ass']:
+                sub_path = os.path.join(temp_dir, f'{os.path.splitext(os.path.basename(video_file))[0]}.{subtitle_lang}.{ext}')
+                if os.path.exists(sub_path):
+                    subtitle_file = sub_path
+                    break
+
+        # 如果有字幕，只生成打包清单，/api/file 下载时再流式生成 zip
+        bundle = None
+        if subtitle_file:
+            timeline.enter('bundle')
+            sub_ext = os.path.splitext(subtitle_file)[1]
+            bundle = build_bundle_manifest([
+                (video_file, final_filename, False),
+                (subtitle_file, f'{clean_title}.{subtitle_lang}{sub_ext}', True),
+            ])
+
+            final_filename = f'{clean_title}.zip'
+            final_mimetype = 'application/zip'
+            file_size = StreamingZip(bundle).size
+
+        # 先写入剩余的进度（和时间线），再更新任务状态为完成
+        timeline.leave()
+        close_progress_writer(progress_writer)
+        progress_writer = None
+
+        update_task(task_id, {
+            'status': 'completed',
+            'progress': 100,
+            'filename': final_filename,
+            'filepath': final_filepath,
+            'filesize': file_size,
+            'mimetype': final_mimetype,
+            'bundle': bundle,
+            'downloaded_at': time.time(),
+            'download_count': 0,
+        })
+
+        logger.info(f'任务 {task_id} 下载完成: {final_filename}, 大小: {file_size / 1024 / 1024:.2f} MB')
+
+    except Exception as e:
+        if timeline is not None:
+            timeline.leave(e)
+        if progress_writer:
+            close_progress_writer(progress_writer)
+        # 取消后 ffmpeg 被结束、临时目录被删除引起的错误都按取消处理
+        if cancelled is not None and cancelled.is_set():
+            logger.info(f'任务 {task_id} 已中止下载')
+            update_task(task_id, {'status': 'cancelled'})
+        else:
+            logger.error(f'任务 {task_id} 下载失败: {str(e)}')
+            update_task(task_id, {
+                'status': 'failed',
+                'error': str(e),
+                'error_type': get_upstream_error_type(e),
+            })
+        # 清理临时目录
+        if temp_dir and os.path.exists(temp_dir):
+            try:
+                shutil.rmtree(temp_dir)
+            except:
+                pass
+    finally:
+        set_task_timeline(None)
+
+
+# ================ 下载调度 ================
+# 所有 worker 进程共享任务注册表中的同一个队列：
+#   - start_download 只把任务以 pending 状态写入注册表（队列满时直接拒绝）
+#   - 每个 worker 的调度线程在全局并发数未满时，原子地领取优先级最高、最早提交的任务
+
+# 全局最大同时下载数
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', '2'))
+# 最大排队任务数，超过后 /api/start-download 返回 429
+MAX_QUEUED_DOWNLOADS = int(os.environ.get('MAX_QUEUED_DOWNLOADS', '20'))
+# 调度线程轮询间隔（秒），用于领取其他 worker 提交的任务
+DOWNLOAD_DISPATCH_INTERVAL = 1.0
+
+# 正在占用下载名额的状态
+ACTIVE_STATUSES = ('downloading', 'processing')
+
+_dispatch_event = threading.Event()
+
+# 本进程正在执行的下载: task_id -> RunningDownload
+_running_downloads = {}
+_running_downloads_lock = threading.Lock()
+
+def queue_sort_key(task_data):
+    """排队顺序：优先级高的在前，同优先级先提交的在前"""
+    return (-task_data.get('priority', 0), task_data.get('created_at', 0))
+
+def get_pending_tasks(conn=None):
+    """获取所有排队中的任务（按排队顺序）"""
+    conn = conn or get_db()
+    rows = conn.execute("SELECT task_id, data FROM tasks WHERE status = 'pending'").fetchall()
+    tasks = [(task_id, json.loads(data)) for task_id, data in rows]
+    tasks.sort(key=lambda item: queue_sort_key(item[1]))
+    return tasks
+
+def count_active_tasks(conn=None):
+    """统计正在占用下载名额的任务数"""
+    conn = conn or get_db()
+    return conn.execute(
+        'SELECT COUNT(*) FROM tasks WHERE status IN (?, ?)', ACTIVE_STATUSES
+    ).fetchone()[0]
+
+def get_queue_position(task_id):
+    """获取任务的排队位置（从 1 开始），不在队列中返回 None"""
+    try:
+        for position, (pending_id, _) in enumerate(get_pending_tasks(), start=1):
+            if pending_id == task_id:
+                return position
+    except Exception as e:
+        logger.error(f'获取排队位置失败: {task_id}, 错误: {e}')
+    return None
+
+def _enqueue_task(conn, task_id, task_data):
+    """在调用方的写事务中把任务加入队列，队列已满返回 False"""
+    queued = conn.execute("SELECT COUNT(*) FROM tasks WHERE status = 'pending'").fetchone()[0]
+    if queued >= MAX_QUEUED_DOWNLOADS:
+        return False
+    _write_task(conn, task_id, task_data)
+    return True
+
+def claim_next_task():
+    """
+    在全局并发数未满时领取下一个排队任务
+    返回 (task_id, task_data)，没有可领取的任务返回 None
+    """
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        claimed = None
+        if count_active_tasks(conn) < MAX_CONCURRENT_DOWNLOADS:
+            pending = get_pending_tasks(conn)
+            if pending:
+                task_id, task_data = pending[0]
+                task_data.update({
+                    'status': 'downloading',
+                    'started_at': time.time(),
+                    'worker_pid': os.getpid(),
+                })
+                _write_task(conn, task_id, task_data)
+                claimed = (task_id, task_data)
+        conn.execute('COMMIT')
+        return claimed
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+def release_orphaned_tasks():
+    """把所属 worker 进程已退出的下载任务标记为失败，释放下载名额"""
+    for status in ACTIVE_STATUSES:
+        for task_id in get_task_ids_by_status(status):
+            task = load_task(task_id)
+            pid = task.get('worker_pid') if task else None
+            if not pid:
+                continue
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                logger.warning(f'任务 {task_id} 所属 worker 进程 {pid} 已退出，标记为失败')
+                update_task(task_id, {'status': 'failed', 'error': '下载进程已退出'})
+                if task.get('artifact_key'):
+                    fail_artifact(task['artifact_key'], '下载进程已退出', task_id)
+            except PermissionError:
+                pass
+
+def run_download_task(task_id, task_data):
+    """执行下载任务，结束后把结果同步给共享同一产物的任务，并唤醒调度线程领取下一个任务"""
+    running = RunningDownload()
+    with _running_downloads_lock:
+        _running_downloads[task_id] = running
+    # 新任务加入后立即重新分配带宽，不等下一轮调度
+    _dispatch_event.set()
+    try:
+        args = (task_id, task_data['url'], task_data.get('format_id'), task_data.get('subtitle'),
+                running.cancelled, running.limiter)
+        if should_profile_task():
+            profiler = cProfile.Profile()
+            profiler.runcall(download_video_task, *args)
+            update_task(task_id, {'profile': save_task_profile(task_id, profiler)})
+        else:
+            download_video_task(*args)
+
+        task = load_task(task_id) or {}
+        artifact_key = task_data.get('artifact_key')
+        kept = False
+        if artifact_key:
+            if task.get('status') == 'completed':
+                try:
+                    kept = complete_artifact(artifact_key, task_id, task)
+                except Exception:
+                    # 产物没能接管文件：按下载失败处理并立即删除文件（失败的任务不会再被清理进程删除文件），
+                    # 跟随的任务一起失败，之后的相同请求重新下载
+                    task.update({'status': 'failed', 'error': '保存下载结果失败'})
+                    update_task(task_id, {'status': 'failed', 'error': task['error']})
+                    fail_artifact(artifact_key, task['error'], task_id)
+                    remove_task_files(task.get('filepath'), task.get('temp_dir'))
+            else:
+                fail_artifact(artifact_key, task.get('error') or '下载失败', task_id)
+
+        # 客户端已取消（下载仍为挂在上面的其他任务继续进行，或在中止前已经完成）：
+        # 任务本身以取消结束，没有被产物接管的文件立即删除
+        if task.get('cancelled_at') and task.get('status') != 'cancelled':
+            update_task(task_id, {'status': 'cancelled'})
+            if not kept:
+                remove_task_files(task.get('filepath'), task.get('temp_dir'))
+    finally:
+        with _running_downloads_lock:
+            _running_downloads.pop(task_id, None)
+        _dispatch_event.set()
+
+def download_dispatch_loop():
+    """调度线程：有空闲名额时领取排队任务并启动下载"""
+    while True:
+        try:
+            _dispatch_event.wait(DOWNLOAD_DISPATCH_INTERVAL)
+            _dispatch_event.clear()
+
+            release_orphaned_tasks()
+            check_cancelled_downloads()
+            rebalance_bandwidth()
+
+            # 上游熔断中不领取新任务，任务留在队列中，恢复后按原顺序执行
+            while upstream_accepts_work():
+                claimed = claim_next_task()
+                if not claimed:
+                    break
+                logger.info(f'开始执行下载任务: {claimed[0]}')
+                threading.Thread(target=run_download_task, args=claimed, daemon=True).start()
+        except Exception as e:
+            logger.error(f'下载调度线程错误: {e}')
+
+
+
+# ================ 带宽调度 ================
+# BANDWIDTH_LIMIT 设置本节点所有下载任务共享的下载带宽上限（字节/秒），由调度在任务间分配：
+#   - 加权公平分配（water-filling）：按权重分配剩余带宽，用不满分配额的任务（源站限速等）
+#     只分配它实际能用到的速率，多出的部分继续分给其他任务
+#   - 权重偏向剩余字节少的任务（按剩余字节排名，第 n 名权重 1/n），再乘以任务优先级系数，
+#     小文件先下载完，降低平均完成时间；大任务始终保留一部分带宽，不会饿死
+# 各 worker 的调度线程每轮根据任务注册表中所有下载中任务的进度各自计算同一份分配，只应用到本进程的任务，
+# 任务开始、结束时立即重新计算
+# 限速在进度回调中进行（令牌桶，回调在下载线程中同步执行）：yt-dlp 的 ratelimit 参数按整个下载的平均速度计算，
+# 并且在每个分片开始时复制，下载过程中修改无法及时生效
+
+# 本节点下载带宽上限（字节/秒），0 表示不限制（不进行调度）
+BANDWIDTH_LIMIT = int(os.environ.get('BANDWIDTH_LIMIT', '0'))
+# 分配策略：srpt（偏向剩余字节少的任务）或 fair（平均分配）
+BANDWIDTH_POLICY = os.environ.get('BANDWIDTH_POLICY', 'srpt')
+# 单个任务的最低速率（字节/秒）
+BANDWIDTH_MIN_RATE = 64 * 1024
+# 任务开始后多久才根据实际速率判断是否用不满分配额（秒）
+BANDWIDTH_PROBE_TIME = 3
+# 令牌桶最多积累的空闲额度（秒），避免任务停顿后突发占满带宽
+BANDWIDTH_BURST = 0.5
+# 限速时每次读取的块大小（字节）
+BANDWIDTH_BLOCK_SIZE = 256 * 1024
+
+class BandwidthLimiter:
+    """
+    单个任务的令牌桶限速器，rate 为 None 时不限速；多个分片线程可以同时调用 consume
+    按约 1 秒的窗口统计实际速率：窗口内没有因限速等待过、速率仍低于分配额，说明瓶颈在源站或网络，
+    demand 记为实际速率的 1.5 倍，否则为 None（需求不受限）
+    """
+
+    def __init__(self, cancelled=None):
+        self.rate = None
+        self.throughput = 0   # 最近一个统计窗口的实际速率（字节/秒）
+        self.demand = None    # 估计能用到的速率，None 表示不受限
+        self.cancelled = cancelled
+        self._next_free = 0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_throttled = False
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """设置新的速率；速率变化时清除按旧速率累积的等待，立即按新速率限速"""
+        with self._lock:
+            if rate != self.rate:
+                self.rate = rate
+                self._next_free = min(self._next_free, time.monotonic())
+
+    def consume(self, nbytes):
+        """记录新下载的字节数，超出分配速率时等待（取消时立即返回）"""
+        with self._lock:
+            now = time.monotonic()
+            self._window_bytes += nbytes
+            if now - self._window_start >= 1:
+                self.throughput = round(self._window_bytes / (now - self._window_start))
+                limited = self._window_throttled or not self.rate or self.throughput >= self.rate * 0.8
+                self.demand = None if limited else round(self.throughput * 1.5)
+                self._window_start = now
+                self._window_bytes = 0
+                self._window_throttled = False
+
+            rate = self.rate
+            if not rate:
+                return
+            self._next_free = max(self._next_free, now - BANDWIDTH_BURST) + nbytes / rate
+            delay = self._next_free - now
+            if delay > 0:
+                self._window_throttled = True
+
+        if delay > 0:
+            metrics_inc('bandwidth_throttled_seconds_total', delay)
+            if self.cancelled is not None:
+                self.cancelled.wait(delay)
+            else:
+                time.sleep(delay)
+
+class RunningDownload:
+    """本进程正在执行的一个下载：取消事件（见取消任务）和带宽限速器"""
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.limiter = BandwidthLimiter(self.cancelled)
+
+def get_bandwidth_demand(task, now):
+    """任务能用到的速率（见 BandwidthLimiter.demand）；刚开始下载的任务还没有可靠的统计，认为不受限"""
+    demand = task.get('bandwidth_demand')
+    if not demand or now - task.get('started_at', now) < BANDWIDTH_PROBE_TIME:
+        return float('inf')
+    return max(demand, BANDWIDTH_MIN_RATE)
+
+def allocate_bandwidth(capacity, tasks, now=None):
+    """
+    按加权公平分配计算各任务的速率
+    tasks: [(task_id, task_data)]，返回 {task_id: 速率（字节/秒）}
+    """
+    if now is None:
+        now = time.time()
+
+    def remaining(item):
+        task = item[1]
+        total = task.get('total_bytes') or 0
+        # 总大小未知的任务排在最后
+        return (max(total - task.get('downloaded_bytes', 0), 0) if total > 0 else float('inf'),
+                task.get('started_at', 0))
+
+    entries = []
+    for rank, (task_id, task) in enumerate(sorted(tasks, key=remaining), start=1):
+        weight = 1 / rank if BANDWIDTH_POLICY == 'srpt' else 1
+        weight *= 2 ** max(-4, min(4, task.get('priority', 0)))
+        entries.append((task_id, weight, get_bandwidth_demand(task, now)))
+
+    # water-filling：需求低于按权重分得的份额的任务只分配需求，剩余带宽在其他任务间重新分配
+    allocation = {}
+    while entries:
+        total_weight = sum(weight for _, weight, _ in entries)
+        satisfied = [entry for entry in entries if entry[2] <= capacity * entry[1] / total_weight]
+        if not satisfied:
+            for task_id, weight, _ in entries:
+                allocation[task_id] = capacity * weight / total_weight
+            break
+        for entry in satisfied:
+            allocation[entry[0]] = entry[2]
+            capacity -= entry[2]
+            entries.remove(entry)
+
+    return {task_id: max(int(rate), BANDWIDTH_MIN_RATE) for task_id, rate in allocation.items()}
+
+def rebalance_bandwidth():
+    """根据所有下载中的任务重新分配带宽，并应用到本进程的任务"""
+    with _running_downloads_lock:
+        running = dict(_running_downloads)
+    if BANDWIDTH_LIMIT <= 0 or not running:
+        return
+
+    rows = get_db().execute("SELECT task_id, data FROM tasks WHERE status = 'downloading'").fetchall()
+    tasks = [(task_id, json.loads(data)) for task_id, data in rows]
+    allocation = allocate_bandwidth(BANDWIDTH_LIMIT, tasks)
+    for task_id, download in running.items():
+        # 不在下载中的任务（正在合并等）不限速
+        download.limiter.set_rate(allocation.get(task_id))
+
+# ================ 下载产物复用 ================
+# 相同视频（规范视频 ID）+ format_id + 字幕 的请求共享同一个下载产物：
+#   - 已有任务正在下载：新任务挂到该任务上（following），共用同一份进度和文件
+#   - 已有下载完成的产物：新任务直接完成
+# 产物按引用计数管理生命周期：每个使用它的任务持有一个引用，任务被清理时释放，
+# 引用归零后最多再保留 ARTIFACT_RETAIN_TIME 秒供后续请求复用（磁盘超出预算时会被提前淘汰，见磁盘缓存管理）
+
+import hashlib
+
+# 引用归零后产物的最长保留时间（秒）
+ARTIFACT_RETAIN_TIME = int(os.environ.get('ARTIFACT_RETAIN_TIME', str(6 * 60 * 60)))
+
+# 从产物复制到任务上的文件信息
+ARTIFACT_FILE_FIELDS = ('filename', 'filepath', 'filesize', 'mimetype', 'bundle', 'temp_dir')
+
+def init_artifact_db():
+    """初始化下载产物表"""
+    conn = get_db()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS artifacts (
+            artifact_key TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            expires_at REAL,
+            data TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_artifacts_expires_at ON artifacts (expires_at)')
+
+init_artifact_db()
+
+def get_artifact_key(video_url, format_id, subtitle_lang):
+    """根据规范视频 ID、格式和字幕语言生成产物键"""
+    raw = json.dumps([get_info_cache_key(video_url), format_id or '', subtitle_lang or ''])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def _read_artifact(conn, artifact_key):
+    row = conn.execute('SELECT data FROM artifacts WHERE artifact_key = ?', (artifact_key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def _write_artifact(conn, artifact_key, artifact):
+    """写入产物记录：已完成且没有引用的产物在 last_used + ARTIFACT_RETAIN_TIME 后过期"""
+    expires_at = None
+    if artifact['status'] == 'completed' and artifact.get('refcount', 0) <= 0:
+        expires_at = artifact.get('last_used', 0) + ARTIFACT_RETAIN_TIME
+    conn.execute(
+        'INSERT OR REPLACE INTO artifacts (artifact_key, status, expires_at, data) VALUES (?, ?, ?, ?)',
+        (artifact_key, artifact['status'], expires_at, json.dumps(artifact, ensure_ascii=False))
+    )
+    schedule_expiry('artifact', artifact_key, expires_at)
+
+def submit_download(task_id, task_data):
+    """
+    提交下载任务，在同一个写事务中决定如何处理，保证相同请求只会真正下载一次
+    返回:
+        'reused'    复用已完成的产物，任务直接完成
+        'following' 挂到正在进行的相同下载上
+        'queued'    新建下载并加入队列
+        'rejected'  队列已满
+    """
+    artifact_key = task_data['artifact_key']
+    now = time.time()
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        artifact = _read_artifact(conn, artifact_key)
+        filepath = artifact.get('filepath') if artifact else None
+
+        if artifact and artifact['status'] == 'completed' and filepath and os.path.exists(filepath):
+            artifact['refcount'] += 1
+            artifact['last_used'] = now
+            task_data.update({field: artifact.get(field) for field in ARTIFACT_FILE_FIELDS})
+            task_data.update({'status': 'completed', 'progress': 100, 'downloaded_at': now})
+            _write_artifact(conn, artifact_key, artifact)
+            _write_task(conn, task_id, task_data)
+            mode = 'reused'
+        elif artifact and artifact['status'] == 'downloading':
+            artifact['followers'].append(task_id)
+            task_data.update({'status': 'following', 'leader_task_id': artifact['leader_task_id']})
+            _write_artifact(conn, artifact_key, artifact)
+            _write_task(conn, task_id, task_data)
+            mode = 'following'
+        elif _enqueue_task(conn, task_id, task_data):
+            _write_artifact(conn, artifact_key, {
+                'status': 'downloading',
+                'leader_task_id': task_id,
+                'followers': [],
+                'refcount': 0,
+                'created_at': now,
+                'last_used': now,
+            })
+            mode = 'queued'
+        else:
+            mode = 'rejected'
+
+        conn.execute('ROLLBACK' if mode == 'rejected' else 'COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+    if mode == 'queued':
+        _dispatch_event.set()
+    return mode
+
+def complete_artifact(artifact_key, leader_task_id, leader_task):
+    """
+    下载完成：记录产物文件，并把所有挂在上面的任务标记为完成
+    返回产物是否接管了文件（产物记录已因取消被删除时返回 False，由调用方删除文件）
+    写入失败（数据库错误等）时抛出异常，由调用方按下载失败处理
+    """
+    now = time.time()
+    # 产物实际占用的磁盘空间（整个临时目录，包括字幕等附带文件），用于缓存淘汰
+    temp_dir = leader_task.get('temp_dir')
+    disk_bytes = get_dir_size(temp_dir) if temp_dir else leader_task.get('filesize', 0)
+
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        artifact = _read_artifact(conn, artifact_key)
+        if not artifact or artifact.get('leader_task_id') != leader_task_id:
+            conn.execute('ROLLBACK')
+            return False
+
+        # 已取消的下载任务不持有引用
+        refcount = 0 if leader_task.get('cancelled_at') else 1
+        file_info = {field: leader_task.get(field) for field in ARTIFACT_FILE_FIELDS}
+        artifact.update(file_info)
+        artifact.update({'status': 'completed', 'refcount': refcount, 'last_used': now, 'disk_bytes': disk_bytes})
+
+        for follower_id in artifact.pop('followers', []):
+            follower = _read_task(conn, follower_id)
+            if not follower or follower.get('status') != 'following':
+                continue
+            follower.update(file_info)
+            follower.update({
+                'status': 'completed',
+                'progress': 100,
+                'downloaded_at': now,
+                'download_count': 0,
+            })
+            _write_task(conn, follower_id, follower)
+            artifact['refcount'] += 1
+
+        _write_artifact(conn, artifact_key, artifact)
+        conn.execute('COMMIT')
+        logger.info(f'产物 {artifact_key[:12]} 下载完成，引用数: {artifact["refcount"]}')
+        return True
+    except Exception as e:
+        conn.execute('ROLLBACK')
+        logger.error(f'更新下载产物失败: {artifact_key}, 错误: {e}')
+        raise
+
+def fail_artifact(artifact_key, error, leader_task_id):
+    """下载失败：把所有挂在上面的任务标记为失败，并删除产物记录以便重新下载"""
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        artifact = _read_artifact(conn, artifact_key)
+        # 产物记录已因取消被删除，或已属于之后重新提交的下载
+        if not artifact or artifact['status'] != 'downloading' or artifact.get('leader_task_id') != leader_task_id:
+            conn.execute('ROLLBACK')
+            return
+
+        for follower_id in artifact.get('followers', []):
+            follower = _read_task(conn, follower_id)
+            if follower and follower.get('status') == 'following':
+                follower.update({'status': 'failed', 'error': error})
+                _write_task(conn, follower_id, follower)
+
+        conn.execute('DELETE FROM artifacts WHERE artifact_key = ?', (artifact_key,))
+        conn.execute('COMMIT')
+    except Exception as e:
+        conn.execute('ROLLBACK')
+        logger.error(f'更新下载产物失败: {artifact_key}, 错误: {e}')
+
+def release_artifact(artifact_key):
+    """释放任务持有的产物引用"""
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        artifact = _read_artifact(conn, artifact_key)
+        if artifact and artifact['status'] == 'completed':
+            artifact['refcount'] = max(artifact.get('refcount', 0) - 1, 0)
+            artifact['last_used'] = time.time()
+            _write_artifact(conn, artifact_key, artifact)
+        conn.execute('COMMIT')
+    except Exception as e:
+        conn.execute('ROLLBACK')
+        logger.error(f'释放下载产物失败: {artifact_key}, 错误: {e}')
+
+def expire_artifact(artifact_key, now):
+    """删除到期的产物（以数据库中的过期时间为准，产物被重新引用后不会过期）"""
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute(
+            'SELECT data FROM artifacts WHERE artifact_key = ? AND expires_at IS NOT NULL AND expires_at <= ?',
+            (artifact_key, now)
+        ).fetchone()
+        if row:
+            conn.execute('DELETE FROM artifacts WHERE artifact_key = ?', (artifact_key,))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+    # 记录已删除，不会再被复用，可以在事务外删除文件
+    if row:
+        artifact = json.loads(row[0])
+        remove_task_files(artifact.get('filepath'), artifact.get('temp_dir'))
+        logger.info(f'已清理下载产物: {artifact_key[:12]}')
+
+# ================ 磁盘缓存管理 ================
+# CACHE_DIR 按字节预算管理，而不只是按固定时间过期：
+#   - 下载开始前按格式的 filesize / filesize_approx 估算所需空间，
+#     超出预算或磁盘剩余空间不足时先淘汰产物，仍不足则拒绝下载
+#   - 清理线程定期检查，超出预算时淘汰产物
+#   - 只淘汰引用归零的产物（仍被任务引用、正在下载的文件不会被删除），
+#     按 闲置秒数 × 占用字节 从大到小淘汰，久未使用的大文件先被淘汰，小文件不会被一次大下载挤掉
+
+# CACHE_DIR 的字节预算，0 表示不限制（只检查磁盘剩余空间）
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(4 * 1024 * 1024 * 1024)))
+# 磁盘至少保留的剩余空间（字节）
+CACHE_MIN_FREE_BYTES = int(os.environ.get('CACHE_MIN_FREE_BYTES', str(512 * 1024 * 1024)))
+
+# 同一进程内的空间检查串行进行，避免两个任务同时通过检查
+_cache_space_lock = threading.Lock()
+
+def get_dir_size(path):
+    """目录（或文件）占用的字节数"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass  # 文件在统计过程中被删除
+    return total
 
-        # 下载视频
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
+def estimate_download_bytes(formats):
+    """
+    根据格式信息估算下载所需空间，无法估算时返回 0
+    需要合并的格式按 2 倍计算：合并时分段文件和合并后的文件会同时存在
+    """
+    total = sum(fmt.get('filesize') or fmt.get('filesize_approx') or 0 for fmt in formats)
+    return total * 2 if len(formats) > 1 else total
+
+def get_reserved_bytes(exclude_task_id=None):
+    """正在下载的任务还需要的空间（预计大小 - 已下载字节数）"""
+    reserved = 0
+    for task_id in get_task_ids_by_status('downloading'):
+        if task_id == exclude_task_id:
+            continue
+        task = load_task(task_id)
+        if task:
+            reserved += max(task.get('estimated_bytes', 0) - task.get('downloaded_bytes', 0), 0)
+    return reserved
+
+def get_space_shortfall(needed, exclude_task_id=None):
+    """再写入 needed 字节后，超出预算或低于最小剩余空间的字节数（0 表示空间足够）"""
+    pending = needed + get_reserved_bytes(exclude_task_id)
+    shortfall = pending + CACHE_MIN_FREE_BYTES - shutil.disk_usage(CACHE_DIR).free
+    if CACHE_MAX_BYTES:
+        shortfall = max(shortfall, get_dir_size(CACHE_DIR) + pending - CACHE_MAX_BYTES)
+    return max(shortfall, 0)
+
+def get_evictable_artifacts():
+    """可以淘汰的产物数量和占用字节数（expires_at 不为空的都是已完成且引用归零的产物）"""
+    count, total = 0, 0
+    for (data,) in get_db().execute('SELECT data FROM artifacts WHERE expires_at IS NOT NULL').fetchall():
+        artifact = json.loads(data)
+        count += 1
+        total += artifact.get('disk_bytes') or artifact.get('filesize') or 0
+    return count, total
+
+def evict_artifacts(bytes_needed):
+    """淘汰引用归零的产物，直到释放 bytes_needed 字节或没有可淘汰的产物，返回释放的字节数"""
+    now = time.time()
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        candidates = []
+        for artifact_key, data in conn.execute(
+            'SELECT artifact_key, data FROM artifacts WHERE expires_at IS NOT NULL'
+        ).fetchall():
+            artifact = json.loads(data)
+            size = artifact.get('disk_bytes') or artifact.get('filesize') or 0
+            score = (now - artifact.get('last_used', 0)) * size
+            candidates.append((score, size, artifact_key, artifact))
+        candidates.sort(key=lambda c: c[0], reverse=True)
+
+        evicted = []
+        freed = 0
+        for _, size, artifact_key, artifact in candidates:
+            if freed >= bytes_needed:
+                break
+            conn.execute('DELETE FROM artifacts WHERE artifact_key = ?', (artifact_key,))
+            evicted.append((artifact_key, artifact))
+            freed += size
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+    # 记录已删除，不会再被复用，可以在事务外删除文件
+    for artifact_key, artifact in evicted:
+        remove_task_files(artifact.get('filepath'), artifact.get('temp_dir'))
+        logger.info(f'磁盘缓存淘汰产物: {artifact_key[:12]}')
+    if evicted:
+        increment_counter('disk_cache.evictions', len(evicted))
+        increment_counter('disk_cache.evicted_bytes', freed)
+    return freed
+
+def ensure_cache_space(task_id, formats):
+    """
+    下载开始前检查空间，空间不足时先淘汰产物，仍不足时抛出异常
+    通过检查后把预计大小记到任务上，之后其他任务检查时会把这部分空间算作已占用
+    """
+    needed = estimate_download_bytes(formats)
+    if not needed:
+        return
+
+    with _cache_space_lock:
+        shortfall = get_space_shortfall(needed, task_id)
+        # 全部淘汰也不够时直接拒绝，不白白删除可复用的产物
+        if shortfall and shortfall <= get_evictable_artifacts()[1]:
+            evict_artifacts(shortfall)
+            shortfall = get_space_shortfall(needed, task_id)
+        if shortfall:
+            increment_counter('disk_cache.rejections')
+            raise Exception(f'缓存空间不足：预计需要 {needed / 1024 / 1024:.0f} MB，'
+                            f'还差 {shortfall / 1024 / 1024:.0f} MB')
+        update_task(task_id, {'estimated_bytes': needed})
+
+def enforce_cache_budget():
+    """清理线程调用：超出预算或磁盘剩余空间不足时淘汰产物"""
+    shortfall = get_space_shortfall(0)
+    if shortfall:
+        freed = evict_artifacts(shortfall)
+        logger.info(f'磁盘缓存超出预算 {shortfall / 1024 / 1024:.1f} MB，已释放 {freed / 1024 / 1024:.1f} MB')
+
+def get_cache_usage():
+    """磁盘缓存使用情况"""
+    disk = shutil.disk_usage(CACHE_DIR)
+    evictable_count, evictable_bytes = get_evictable_artifacts()
+    counters = get_counters('disk_cache.')
+    return {
+        'used_bytes': get_dir_size(CACHE_DIR),
+        'max_bytes': CACHE_MAX_BYTES,
+        'reserved_bytes': get_reserved_bytes(),
+        'disk_free_bytes': disk.free,
+        'disk_total_bytes': disk.total,
+        'min_free_bytes': CACHE_MIN_FREE_BYTES,
+        'evictable_artifacts': evictable_count,
+        'evictable_bytes': evictable_bytes,
+        'evictions': int(counters.get('disk_cache.evictions', 0)),
+        'evicted_bytes': int(counters.get('disk_cache.evicted_bytes', 0)),
+        'rejections': int(counters.get('disk_cache.rejections', 0)),
+    }
 
-            # 获取下载的文件路径
-            if 'requested_downloads' in info:
-                video_file = info['requested_downloads'][0]['filepath']
-            else:
-                video_file = ydl.prepare_filename(info)
-
-            if not os.path.exists(video_file):
-                raise Exception('视频文件不存在')
-
-            video_title = info.get('title', 'video')
-            video_ext = info.get('ext', 'mp4')
-            file_size = os.path.getsize(video_file)
-
-            clean_title = sanitize_filename(video_title)
-            final_filename = f'{clean_title}.{video_ext}'
-            final_filepath = video_file
-            final_mimetype = 'video/mp4'
-
-            # 检查是否有字幕文件需要打包
-            subtitle_file = None
-            if subtitle_lang:
-                for ext in ['vtt', 'srt', 'ass']:
-                    sub_path = os.path.join(temp_dir, f'{os.path.splitext(os.path.basename(video_file))[0]}.{subtitle_lang}.{ext}')
-                    if os.path.exists(sub_path):
-                        subtitle_file = sub_path
-                        break
+@app.route('/api/cache/disk', methods=['GET'])
+def cache_disk_usage():
+    """磁盘缓存使用情况"""
+    return json_response(get_cache_usage())
 
-            # 如果有字幕，打包成 zip
-            if subtitle_file:
-                import zipfile
-                zip_filename = f'{clean_title}.zip'
-                zip_path = os.path.join(temp_dir, zip_filename)
 
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-                    zf.write(video_file, final_filename)
-                    sub_ext = os.path.splitext(subtitle_file)[1]
-                    zf.write(subtitle_file, f'{clean_title}.{subtitle_lang}{sub_ext}')
+# ================ 过期清理 ================
+# 每个节点只有一个清理进程：各 worker 启动时尝试对 {CACHE_DIR}/janitor.lock 加排他锁，
+# 拿到锁的 worker 负责清理，其他 worker 定期重试（持锁进程退出时锁由系统自动释放）
+# 清理进程用最小堆按过期时间排序待清理的任务和产物，睡到最近的过期时间：
+#   - 本进程写入任务/产物时直接把新的过期时间加入堆
+#   - 其他 worker 写入的过期时间通过定期查询 expires_at 索引补充（只读取即将到期的行）
+# 出堆时以数据库中的过期时间为准重新检查，状态已变化（过期时间推迟）的条目跳过
 
-                final_filename = zip_filename
-                final_filepath = zip_path
-                final_mimetype = 'application/zip'
-                file_size = os.path.getsize(zip_path)
+import fcntl
+import heapq
+
+# 清理进程锁文件
+JANITOR_LOCK_FILE = os.path.join(CACHE_DIR, 'janitor.lock')
+# 从数据库补充其他 worker 写入的过期时间的间隔（秒）
+JANITOR_REFRESH_INTERVAL = float(os.environ.get('JANITOR_REFRESH_INTERVAL', '5'))
+# 每次补充多少秒内到期的条目
+JANITOR_HORIZON = 60
+# 未当选的 worker 重试加锁的间隔（秒）
+JANITOR_ELECTION_INTERVAL = 10
+# 检查磁盘缓存预算的间隔（秒）
+CACHE_BUDGET_CHECK_INTERVAL = 30
+
+_expiry_heap = []        # (过期时间, 类型, 键)
+_expiry_scheduled = {}   # (类型, 键) -> 堆中最新的过期时间，用于跳过已被更新的旧条目
+_expiry_lock = threading.Lock()
+_janitor_event = threading.Event()
+_janitor_lock_file = None
+
+def try_become_janitor():
+    """尝试成为本节点的清理进程（非阻塞加锁）"""
+    global _janitor_lock_file
+    lock_file = open(JANITOR_LOCK_FILE, 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    _janitor_lock_file = lock_file
+    return True
+
+def schedule_expiry(kind, key, expires_at):
+    """把任务（kind='task'）或产物（kind='artifact'）的过期时间加入堆；非清理进程直接忽略"""
+    if _janitor_lock_file is None or expires_at is None:
+        return
+    with _expiry_lock:
+        if _expiry_scheduled.get((kind, key)) == expires_at:
+            return
+        _expiry_scheduled[(kind, key)] = expires_at
+        heapq.heappush(_expiry_heap, (expires_at, kind, key))
+        is_next = _expiry_heap[0][0] == expires_at
+    # 新条目比原来最近的过期时间更早，唤醒清理线程重新计算睡眠时间
+    if is_next:
+        _janitor_event.set()
+
+def load_upcoming_expiries(now):
+    """从数据库补充即将到期的任务和产物（其他 worker 写入的过期时间）"""
+    conn = get_db()
+    horizon = now + JANITOR_HORIZON
+    for task_id, expires_at in conn.execute(
+        'SELECT task_id, expires_at FROM tasks WHERE expires_at IS NOT NULL AND expires_at <= ?', (horizon,)
+    ).fetchall():
+        schedule_expiry('task', task_id, expires_at)
+    for artifact_key, expires_at in conn.execute(
+        'SELECT artifact_key, expires_at FROM artifacts WHERE expires_at IS NOT NULL AND expires_at <= ?', (horizon,)
+    ).fetchall():
+        schedule_expiry('artifact', artifact_key, expires_at)
+
+def expire_task(task_id, now):
+    """清理到期的任务（以数据库中的任务状态为准）"""
+    task = load_task(task_id)
+    if not task:
+        return
+    expires_at = get_task_expires_at(task)
+    if expires_at is None or expires_at > now:
+        return
+
+    # 文件属于共享的下载产物，只释放引用（只有已完成的任务持有引用）；
+    # 产物在引用归零后单独清理
+    if task.get('artifact_key'):
+        if task['status'] == 'completed':
+            release_artifact(task['artifact_key'])
+    else:
+        remove_task_files(task.get('filepath'), task.get('temp_dir'))
+
+    delete_task(task_id)
+    logger.info(f'已清理任务: {task_id}')
+
+def pop_due_expiry(now):
+    """弹出一个已到期的条目，没有时返回 None"""
+    with _expiry_lock:
+        while _expiry_heap and _expiry_heap[0][0] <= now:
+            expires_at, kind, key = heapq.heappop(_expiry_heap)
+            if _expiry_scheduled.get((kind, key)) == expires_at:
+                del _expiry_scheduled[(kind, key)]
+                return kind, key
+    return None
 
-            # 更新任务状态为完成
-            update_task(task_id, {
-                'status': 'completed',
-                'progress': 100,
-                'filename': final_filename,
-                'filepath': final_filepath,
-                'filesize': file_size,
-                'mimetype': final_mimetype,
-                'downloaded_at': time.time(),
-                'download_count': 0,
-            })
+def janitor_loop():
+    """清理线程：当选后按过期时间清理任务和产物，并定期检查磁盘缓存预算"""
+    while not try_become_janitor():
+        time.sleep(JANITOR_ELECTION_INTERVAL)
+    logger.info(f'进程 {os.getpid()} 成为清理进程')
 
-            logger.info(f'任务 {task_id} 下载完成: {final_filename}, 大小: {file_size / 1024 / 1024:.2f} MB')
+    last_refresh = 0
+    last_budget_check = 0
+    while True:
+        try:
+            now = time.time()
+            if now - last_refresh >= JANITOR_REFRESH_INTERVAL:
+                with metrics_timer('cleanup_pass_seconds', kind='refresh'):
+                    load_upcoming_expiries(now)
+                with metrics_timer('cleanup_pass_seconds', kind='idle'):
+                    cancel_idle_tasks(now)
+                last_refresh = now
+            if now - last_budget_check >= CACHE_BUDGET_CHECK_INTERVAL:
+                with metrics_timer('cleanup_pass_seconds', kind='budget'):
+                    enforce_cache_budget()
+                last_budget_check = now
+
+            # 只统计实际清理了条目的轮次
+            started = time.perf_counter()
+            expired = 0
+            while True:
+                due = pop_due_expiry(now)
+                if not due:
+                    break
+                kind, key = due
+                if kind == 'task':
+                    expire_task(key, now)
+                else:
+                    expire_artifact(key, now)
+                expired += 1
+            if expired:
+                metrics_observe('cleanup_pass_seconds', time.perf_counter() - started, kind='expiry')
+
+            # 睡到最近的过期时间，最多睡到下一次补充
+            with _expiry_lock:
+                next_expiry = _expiry_heap[0][0] if _expiry_heap else float('inf')
+            timeout = min(next_expiry, last_refresh + JANITOR_REFRESH_INTERVAL) - time.time()
+            if timeout > 0:
+                _janitor_event.wait(timeout)
+            _janitor_event.clear()
+        except Exception as e:
+            logger.error(f'清理线程错误: {e}')
+            time.sleep(1)
 
-    except Exception as e:
-        logger.error(f'任务 {task_id} 下载失败: {str(e)}')
-        update_task(task_id, {
-            'status': 'failed',
-            'error': str(e),
-        })
-        # 清理临时目录
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir)
-            except:
-                pass
 
+def create_download_task(video_url, format_id=None, subtitle_lang=None, priority=0, batch=False):
+    """
+    创建下载任务并提交：复用已完成的产物、挂到相同的下载上，或加入队列由调度线程领取执行
+    batch 标记批量创建的任务（不会因客户端长时间不查询进度被自动取消）
+    返回 (task_id, mode)，mode 见 submit_download
+    """
+    task_id = str(uuid.uuid4())
+    mode = submit_download(task_id, {
+        'status': 'pending',
+        'progress': 0,
+        'downloaded_bytes': 0,
+        'total_bytes': 0,
+        'speed': 0,
+        'eta': 0,
+        'filename': None,
+        'filepath': None,
+        'error': None,
+        'created_at': time.time(),
+        'downloaded_at': None,
+        'download_count': 0,
+        'temp_dir': None,
+        'url': video_url,
+        'format_id': format_id,
+        'subtitle': subtitle_lang,
+        'priority': priority,
+        'batch': batch,
+        'artifact_key': get_artifact_key(video_url, format_id, subtitle_lang),
+    })
+
+    metrics_inc('download_tasks_total', mode=mode)
+    if mode == 'rejected':
+        logger.warning(f'下载队列已满，拒绝任务: {video_url}')
+    elif mode == 'reused':
+        logger.info(f'下载任务复用已完成的文件: {task_id}, URL: {video_url}')
+    elif mode == 'following':
+        logger.info(f'下载任务合并到进行中的相同下载: {task_id}, URL: {video_url}')
+    else:
+        logger.info(f'下载任务已排队: {task_id}, URL: {video_url}')
+    return task_id, mode
 
 @app.route('/api/start-download', methods=['POST'])
 def start_download():
@@ -609,9 +3764,11 @@ def start_download():
     请求体: {
         "url": "YouTube视频URL",
         "format_id": "格式ID（可选）",
-        "subtitle": "字幕语言代码（可选）"
+        "subtitle": "字幕语言代码（可选）",
+        "priority": "排队优先级（可选，数字越大越优先，默认 0）"
     }
-    返回: { "task_id": "任务ID" }
+    返回: { "task_id": "任务ID", "queue_position": 排队位置 }
+    队列已满时返回 429
     """
     try:
         data = request.get_json()
@@ -623,75 +3780,59 @@ def start_download():
         format_id = data.get('format_id')
         subtitle_lang = data.get('subtitle')
 
-        # 生成任务ID
-        task_id = str(uuid.uuid4())
-
-        # 初始化任务状态（保存到文件）
-        save_task(task_id, {
-            'status': 'pending',
-            'progress': 0,
-            'downloaded_bytes': 0,
-            'total_bytes': 0,
-            'speed': 0,
-            'eta': 0,
-            'filename': None,
-            'filepath': None,
-            'error': None,
-            'created_at': time.time(),
-            'downloaded_at': None,
-            'download_count': 0,
-            'temp_dir': None,
-        })
+        try:
+            priority = int(data.get('priority') or 0)
+        except (TypeError, ValueError):
+            return json_response({'error': 'priority 参数必须是整数'}, 400)
 
-        # 启动下载线程
-        thread = threading.Thread(
-            target=download_video_task,
-            args=(task_id, video_url, format_id, subtitle_lang),
-            daemon=True
-        )
-        thread.start()
+        task_id, mode = create_download_task(video_url, format_id, subtitle_lang, priority)
 
-        logger.info(f'启动下载任务: {task_id}, URL: {video_url}')
+        if mode == 'rejected':
+            response = json_response({'error': '服务器繁忙，下载队列已满，请稍后重试'}, 429)
+            response.headers['Retry-After'] = '30'
+            return response
 
-        return json_response({'task_id': task_id})
+        return json_response({'task_id': task_id, 'queue_position': get_queue_position(task_id)})
 
     except Exception as e:
         logger.error(f'启动下载任务失败: {str(e)}')
         return json_response({'error': f'启动下载失败: {str(e)}'}, 500)
 
 
-@app.route('/api/progress/<task_id>', methods=['GET'])
-def get_progress(task_id):
-    """
-    获取下载进度
-    返回: {
-        "status": "pending|downloading|processing|completed|failed",
-        "progress": 0-100,
-        "speed": 下载速度(bytes/s),
-        "eta": 预计剩余时间(秒),
-        "filename": 文件名(完成时),
-        "filesize": 文件大小(完成时),
-        "error": 错误信息(失败时)
-    }
-    """
-    task = load_task(task_id)
-
+def build_progress_payload(task_id, task):
+    """根据任务数据生成进度响应内容，返回 (payload, HTTP 状态码)"""
     if not task:
-        return json_response({'error': '任务不存在或已过期'}, 404)
+        return {'error': '任务不存在或已过期'}, 404
+
+    # 已取消（下载可能仍在为其他相同请求继续进行）
+    if task['status'] == 'cancelled' or task.get('cancelled_at'):
+        return {'status': 'cancelled', 'progress': task.get('progress', 0)}, 200
 
     # 检查是否已被下载过
     if task['status'] == 'completed' and task.get('download_count', 0) > 0:
-        return json_response({
+        return {
             'status': 'expired',
             'error': '文件已被下载，不可重复下载'
-        })
+        }, 200
+
+    # 挂在其他下载上的任务，显示被跟随任务的进度
+    if task['status'] == 'following':
+        leader_id = task.get('leader_task_id')
+        leader = load_task(leader_id) if leader_id else None
+        if leader and leader['status'] in ('pending',) + ACTIVE_STATUSES:
+            # 被跟随的任务自己取消了，下载仍在继续，显示实际进度
+            leader.pop('cancelled_at', None)
+            return build_progress_payload(leader_id, leader)
+        return {'status': 'processing', 'progress': 100}, 200
 
     response = {
         'status': task['status'],
         'progress': task['progress'],
     }
 
-    if task['status'] == 'downloading':
+    if task['status'] == 'pending':
+        response['queue_position'] = get_queue_position(task_id)
+    elif task['status'] == 'downloading':
         response.update({
             'downloaded_bytes': task.get('downloaded_bytes', 0),
             'total_bytes': task.get('total_bytes', 0),
@@ -705,49 +3846,852 @@ def get_progress(task_id):
         })
     elif task['status'] == 'failed':
         response['error'] = task.get('error', '未知错误')
+        if task.get('error_type'):
+            response['error_type'] = task['error_type']
 
-    return json_response(response)
+    return response, 200
 
 
-@app.route('/api/file/<task_id>', methods=['GET'])
-def download_file(task_id):
+@app.route('/api/progress/<task_id>', methods=['GET'])
+def get_progress(task_id):
     """
-    下载已完成的文件
-    文件下载后会被标记，稍后自动清理
+    获取下载进度
+    返回: {
+        "status": "pending|downloading|processing|completed|failed|cancelled",
+        "progress": 0-100,
+        "queue_position": 排队位置(排队时),
+        "speed": 下载速度(bytes/s),
+        "eta": 预计剩余时间(秒),
+        "filename": 文件名(完成时),
+        "filesize": 文件大小(完成时),
+        "error": 错误信息(失败时),
+        "error_type": 错误分类 circuit_open / blocked / network / server(失败且可分类时)
+    }
+    """
+    payload, status = build_progress_payload(task_id, poll_task(task_id))
+    return json_response(payload, status)
+
+
+# SSE 检查任务变化的间隔（秒）
+PROGRESS_STREAM_INTERVAL = float(os.environ.get('PROGRESS_STREAM_INTERVAL', '0.5'))
+# 无变化时发送心跳的间隔（秒），防止 Cloudflare / 浏览器断开空闲连接
+PROGRESS_STREAM_HEARTBEAT = 15
+# 单个连接的最长时间（秒），到期后由浏览器 EventSource 自动重连，避免长期占用 worker 线程
+PROGRESS_STREAM_MAX_AGE = int(os.environ.get('PROGRESS_STREAM_MAX_AGE', '120'))
+
+# 终态：推送后关闭连接
+PROGRESS_FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+class ProgressStream:
+    """
+    SSE 进度流的状态（WSGI 和 ASGI 模式共用）
+    poll() 读取一次任务，返回 (需要发送的内容或 None, 是否结束)，调用方负责两次 poll 之间的等待
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.last_data = None
+        self.last_sent = time.time()
+        self.deadline = self.last_sent + PROGRESS_STREAM_MAX_AGE
+
+    def start(self):
+        # 告诉浏览器断线后 1 秒重连
+        return 'retry: 1000\n\n'
+
+    def poll(self):
+        payload, status = build_progress_payload(self.task_id, poll_task(self.task_id))
+        data = json.dumps(payload, ensure_ascii=False)
+
+        if data != self.last_data:
+            self.last_data = data
+            self.last_sent = time.time()
+            done = status != 200 or payload.get('status') in PROGRESS_FINAL_STATUSES
+            return f'event: progress\ndata: {data}\n\n', done or time.time() >= self.deadline
+
+        text = None
+        if time.time() - self.last_sent >= PROGRESS_STREAM_HEARTBEAT:
+            self.last_sent = time.time()
+            text = ': heartbeat\n\n'
+        return text, time.time() >= self.deadline
+
+# SSE 响应头
+PROGRESS_STREAM_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+
+@app.route('/api/progress/<task_id>/stream', methods=['GET'])
+def stream_progress(task_id):
+    """
+    以 Server-Sent Events 推送下载进度
+    仅在 /api/progress 的返回内容变化时推送一条 progress 事件，到达终态或任务不存在后结束
+    """
+    def generate():
+        stream = ProgressStream(task_id)
+        yield stream.start()
+
+        while True:
+            text, done = stream.poll()
+            if text:
+                yield text
+            if done:
+                return
+            time.sleep(PROGRESS_STREAM_INTERVAL)
+
+    return Response(generate(), mimetype='text/event-stream', headers=PROGRESS_STREAM_HEADERS)
+
+
+# ================ 取消任务 ================
+# DELETE /api/task/<task_id> 取消任务；开启 TASK_IDLE_TIMEOUT 后，正在下载的任务在客户端超过该秒数
+# 没有查询进度时由清理进程自动取消（只针对查询过进度的单个任务：批量任务和只在最后查询的客户端不受影响，
+# 计时从领取下载开始，排队时间不计入）
+# 相同请求共享同一个下载（见下载产物复用），只有没有任何任务还需要它时才真正中止下载：
+#   - 排队中：直接移出队列
+#   - 正在下载：在任务上标记 abort_requested，并删除产物记录（之后的相同请求重新下载）
+#   - 下载仍被其他任务跟随：只把本任务标记为已取消，下载继续，最后一个跟随者取消时再中止
+# 中止由执行下载的 worker 完成（调度线程每轮检查本进程的下载）：设置取消事件，
+# 进度回调随后抛出 DownloadCancelled，同时结束正在运行的 ffmpeg 子进程并立即删除临时目录
+
+# 客户端多久没有查询进度后自动取消正在下载的任务（秒），0 表示不自动取消
+TASK_IDLE_TIMEOUT = int(os.environ.get('TASK_IDLE_TIMEOUT', '0'))
+# 记录客户端查询时间的最小间隔（秒），避免每次轮询都写注册表
+TASK_SEEN_INTERVAL = 5
+
+# 可以取消的状态
+CANCELLABLE_STATUSES = ('pending', 'following') + ACTIVE_STATUSES
+
+def touch_task(task_id, task):
+    """记录客户端最近一次查询进度的时间（只对进行中的任务，按 TASK_SEEN_INTERVAL 合并写入）"""
+    now = time.time()
+    if task.get('status') not in CANCELLABLE_STATUSES or now - task.get('last_seen_at', 0) < TASK_SEEN_INTERVAL:
+        return
+    conn = get_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = _read_task(conn, task_id)
+            # 任务可能已被清理，不能用 update_task 重新写入
+            if current and current.get('status') in CANCELLABLE_STATUSES:
+                current['last_seen_at'] = now
+                _write_task(conn, task_id, current)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception as e:
+        logger.error(f'记录任务查询时间失败: {task_id}, 错误: {e}')
+
+def poll_task(task_id):
+    """客户端查询进度时读取任务，并记录查询时间"""
+    task = load_task(task_id)
+    if task:
+        touch_task(task_id, task)
+    return task
+
+def _stop_download(conn, task_id, task, artifact_key):
+    """在调用方的写事务中停止任务对应的下载：排队中直接取消，正在下载的请求执行它的 worker 中止"""
+    if artifact_key:
+        conn.execute('DELETE FROM artifacts WHERE artifact_key = ?', (artifact_key,))
+    if task['status'] == 'pending':
+        task['status'] = 'cancelled'
+    else:
+        task['abort_requested'] = True
+    _write_task(conn, task_id, task)
+
+def cancel_task(task_id, reason):
+    """
+    取消进行中的任务
+    返回取消前的状态；任务不存在返回 None；已结束或已取消的任务不做处理
+    """
+    now = time.time()
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        task = _read_task(conn, task_id)
+        if not task or task['status'] not in CANCELLABLE_STATUSES or task.get('cancelled_at'):
+            conn.execute('ROLLBACK')
+            return task and task['status']
+
+        status = task['status']
+        artifact_key = task.get('artifact_key')
+        artifact = _read_artifact(conn, artifact_key) if artifact_key else None
+        task.update({'cancelled_at': now, 'cancel_reason': reason})
+
+        if status == 'following':
+            task['status'] = 'cancelled'
+            _write_task(conn, task_id, task)
+            if artifact and task_id in artifact.get('followers', []):
+                artifact['followers'].remove(task_id)
+                _write_artifact(conn, artifact_key, artifact)
+                # 被跟随的任务已取消，最后一个跟随者也取消了：没有任务再需要这个下载
+                leader_id = artifact['leader_task_id']
+                leader = _read_task(conn, leader_id)
+                if (not artifact['followers'] and leader and leader.get('cancelled_at')
+                        and not leader.get('abort_requested') and leader['status'] in CANCELLABLE_STATUSES):
+                    _stop_download(conn, leader_id, leader, artifact_key)
+        elif artifact and artifact.get('leader_task_id') == task_id and artifact.get('followers'):
+            # 还有其他任务跟随这个下载，继续下载
+            _write_task(conn, task_id, task)
+        else:
+            owned = artifact and artifact.get('leader_task_id') == task_id
+            _stop_download(conn, task_id, task, artifact_key if owned else None)
+
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+    metrics_inc('download_tasks_cancelled_total', reason=reason)
+    logger.info(f'任务 {task_id} 已取消（{reason}），取消前状态: {status}')
+    # 下载可能就在本进程执行，立即检查；排队中的任务让出了队列位置
+    _dispatch_event.set()
+    return status
+
+def kill_child_processes(marker):
+    """结束本进程中命令行包含 marker 的子进程（下载时运行的 ffmpeg）及其所有后代进程，返回结束的进程数"""
+    children = {}   # 父进程 ID -> 子进程 ID 列表
+    try:
+        entries = [int(entry) for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return 0
+    for pid in entries:
+        try:
+            with open(f'/proc/{pid}/stat', 'rb') as f:
+                # 进程名可能包含空格和括号，从最后一个右括号之后解析：状态 父进程ID ...
+                ppid = int(f.read().rsplit(b')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(pid)
+
+    targets = []
+    for pid in children.get(os.getpid(), []):
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                if marker in f.read().decode('utf-8', 'replace'):
+                    targets.append(pid)
+        except OSError:
+            continue
+
+    killed = 0
+    while targets:
+        pid = targets.pop()
+        targets.extend(children.get(pid, []))
+        try:
+            os.kill(pid, signal.SIGKILL)
+            killed += 1
+        except OSError:
+            pass
+    return killed
+
+def abort_download(task_id, task):
+    """中止本进程正在执行的下载：通知进度回调、结束 ffmpeg 并立即删除临时目录"""
+    with _running_downloads_lock:
+        running = _running_downloads.get(task_id)
+    if running is None or running.cancelled.is_set():
+        return
+    running.cancelled.set()
+
+    temp_dir = task.get('temp_dir')
+    if temp_dir:
+        killed = kill_child_processes(temp_dir)
+        remove_task_files(None, temp_dir)
+        logger.info(f'已中止任务 {task_id} 的下载，结束子进程 {killed} 个')
+
+def check_cancelled_downloads():
+    """检查本进程正在执行的下载是否被要求中止（取消请求可能由其他 worker 处理）"""
+    with _running_downloads_lock:
+        task_ids = list(_running_downloads)
+    for task_id in task_ids:
+        task = load_task(task_id)
+        if task and task.get('abort_requested'):
+            abort_download(task_id, task)
+
+def cancel_idle_tasks(now):
+    """
+    自动取消客户端超过 TASK_IDLE_TIMEOUT 秒没有查询进度的下载任务
+    只处理正在下载、客户端至少查询过一次进度的非批量任务，计时从领取下载时开始
+    """
+    if TASK_IDLE_TIMEOUT <= 0:
+        return
+    for status in ACTIVE_STATUSES:
+        for task_id in get_task_ids_by_status(status):
+            task = load_task(task_id)
+            if not task or task.get('cancelled_at') or task.get('batch') or not task.get('last_seen_at'):
+                continue
+            last_seen = max(task['last_seen_at'], task.get('started_at') or 0)
+            if now - last_seen >= TASK_IDLE_TIMEOUT:
+                cancel_task(task_id, 'idle')
+
+@app.route('/api/task/<task_id>', methods=['DELETE'])
+def delete_download_task(task_id):
+    """
+    取消下载任务
+    进行中的任务: 停止下载并释放资源，返回 { "task_id": ..., "status": "cancelled" }
+    已结束的任务: 立即删除任务和文件（共享的下载产物只释放引用），返回 { "task_id": ..., "status": "deleted" }
+    """
+    try:
+        status = cancel_task(task_id, 'client')
+        if status is None:
+            return json_response({'error': '任务不存在或已过期'}, 404)
+        if status in CANCELLABLE_STATUSES:
+            return json_response({'task_id': task_id, 'status': 'cancelled'})
+
+        task = load_task(task_id)
+        if task:
+            if task.get('artifact_key'):
+                if task['status'] == 'completed':
+                    release_artifact(task['artifact_key'])
+            else:
+                remove_task_files(task.get('filepath'), task.get('temp_dir'))
+            delete_task(task_id)
+            logger.info(f'已删除任务: {task_id}')
+        return json_response({'task_id': task_id, 'status': 'deleted'})
+
+    except Exception as e:
+        logger.error(f'取消任务失败: {task_id}, 错误: {str(e)}')
+        return json_response({'error': f'取消任务失败: {str(e)}'}, 500)
+
+
+# ================ 文件下载（断点续传） ================
+# /api/file 支持 Range / If-Range 和 ETag，连接中断后可以从断点继续
+# 按实际送达的字节区间记录下载进度，所有区间覆盖整个文件后才算下载完成
+# 普通文件交给 wsgi.file_wrapper 发送，gunicorn 会使用 sendfile 零拷贝发送
+
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import http_date
+
+def merge_ranges(ranges):
+    """合并重叠或相邻的 [start, end) 区间"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def record_delivered_range(task_id, start, sent, started):
+    """记录已送达客户端的字节区间（并在时间线中追加这次发送），全部送达时把任务标记为已下载"""
+    if sent <= 0:
+        return
+    conn = get_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            task = _read_task(conn, task_id)
+            if not task:
+                conn.execute('ROLLBACK')
+                return
+
+            ranges = merge_ranges(task.get('delivered_ranges', []) + [[start, start + sent]])
+            task['delivered_ranges'] = ranges
+            task['delivered_bytes'] = sum(end - begin for begin, end in ranges)
+            append_transfer(task, start, sent, time.perf_counter() - started)
+
+            completed = (task.get('download_count', 0) == 0
+                         and ranges[0][0] == 0 and ranges[0][1] >= task.get('filesize', 0))
+            if completed:
+                task['download_count'] = 1
+                task['delivered_at'] = time.time()
+
+            _write_task(conn, task_id, task)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception as e:
+        logger.error(f'记录下载进度失败: {task_id}, 错误: {e}')
+        return
+
+    if completed:
+        logger.info(f'文件已完整送达: {task_id} - {task.get("filename")}')
+
+class TrackedFileRange:
+    """
+    只暴露文件中 [start, start + length) 部分的文件对象，关闭时记录实际送达的字节数
+
+    - 普通 WSGI 服务器通过 read() 读取，读取量不会超过 length
+    - gunicorn 通过 fileno() 和当前偏移调用 sendfile；socket.sendfile 结束（包括出错）时
+      会把文件位置 seek 到最后发送的字节之后，据此得到实际送达的字节数
+    """
+
+    def __init__(self, task_id, path, start, length):
+        self.task_id = task_id
+        self.start = start
+        self.end = start + length
+        self.position = start
+        self.started = time.perf_counter()
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._closed = False
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def read(self, size=-1):
+        remaining = self.end - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self._file.read(size) if size > 0 else b''
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.position = self._file.seek(offset, whence)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._file.close()
+        sent = min(self.position, self.end) - self.start
+        record_file_served('file', sent, self.started)
+        record_delivered_range(self.task_id, self.start, sent, self.started)
+
+def iter_tracked_bundle(task_id, bundle, start, end):
+    """产出 zip 的指定范围，结束或客户端断开时记录实际送达的字节数"""
+    started = time.perf_counter()
+    sent = 0
+    try:
+        for chunk in bundle.iter_range(start, end):
+            yield chunk
+            sent += len(chunk)
+    finally:
+        record_file_served('zip', sent, started)
+        record_delivered_range(task_id, start, sent, started)
+
+def get_file_etag(task):
+    """根据文件内容标识生成 ETag（zip 使用各条目的 CRC，普通文件使用大小和修改时间）"""
+    if task.get('bundle'):
+        parts = [(e['arcname'], e['size'], e['crc32']) for e in task['bundle']['entries']]
+    else:
+        stat = os.stat(task['filepath'])
+        parts = [task['filepath'], stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()[:20]
+
+def plan_file_download(task_id, req):
+    """
+    解析 /api/file 请求（WSGI 和 ASGI 模式共用），req 为 werkzeug Request
+    返回发送计划: {
+        "status": HTTP 状态码, "headers": 响应头, "mimetype": 类型,
+        "error": 错误信息（出错时，以 JSON 返回）,
+        "send_body": 是否发送内容, "start"/"end": 发送范围 [start, end),
+        "filepath": 文件路径, "bundle": StreamingZip 或 None
+    }
     """
     task = load_task(task_id)
 
     if not task:
-        return json_response({'error': '任务不存在或已过期'}, 404)
+        return {'status': 404, 'error': '任务不存在或已过期'}
 
     if task['status'] != 'completed':
-        return json_response({'error': '文件尚未准备好'}, 400)
+        return {'status': 400, 'error': '文件尚未准备好'}
 
-    # 检查是否已被下载过
-    if task.get('download_count', 0) > 0:
-        return json_response({'error': '文件已被下载，不可重复下载'}, 410)
+    # 已完整下载过的文件只在短暂的宽限期内允许续传
+    if task.get('download_count', 0) > 0 and time.time() > task.get('delivered_at', 0) + FILE_DELIVERY_GRACE:
+        return {'status': 410, 'error': '文件已被下载，不可重复下载'}
 
     filepath = task.get('filepath')
     filename = task.get('filename')
     mimetype = task.get('mimetype', 'application/octet-stream')
 
     if not filepath or not os.path.exists(filepath):
-        return json_response({'error': '文件不存在'}, 404)
+        return {'status': 404, 'error': '文件不存在'}
+
+    bundle = StreamingZip(task['bundle']) if task.get('bundle') else None
+    total = bundle.size if bundle else os.path.getsize(filepath)
+    etag = get_file_etag(task)
+    last_modified = int(os.path.getmtime(filepath))
+
+    headers = {
+        'Content-Disposition': content_disposition(filename),
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(last_modified),
+    }
+    plan = {'status': 200, 'headers': headers, 'mimetype': mimetype, 'error': None, 'send_body': False,
+            'start': 0, 'end': total, 'filepath': filepath, 'bundle': bundle}
+
+    # If-Range 不匹配时忽略 Range，返回完整文件
+    byte_range = req.range
+    if byte_range and 'If-Range' in req.headers:
+        if_range = req.if_range
+        if if_range.etag is not None:
+            if if_range.etag != etag:
+                byte_range = None
+        elif if_range.date is None or if_range.date.timestamp() < last_modified:
+            byte_range = None
+
+    if byte_range:
+        bounds = byte_range.range_for_length(total)
+        if bounds is None:
+            # 多段 Range 不支持时返回完整文件；单段越界返回 416
+            if len(byte_range.ranges) == 1:
+                headers['Content-Range'] = f'bytes */{total}'
+                plan['status'] = 416
+                return plan
+        else:
+            plan['start'], plan['end'] = bounds
+            plan['status'] = 206
+            headers['Content-Range'] = f'bytes {bounds[0]}-{bounds[1] - 1}/{total}'
 
-    # 标记为已下载
-    update_task(task_id, {
-        'download_count': task.get('download_count', 0) + 1
-    })
+    headers['Content-Length'] = str(plan['end'] - plan['start'])
 
-    logger.info(f'用户下载文件: {task_id} - {filename}')
+    if req.method == 'HEAD':
+        return plan
 
-    return send_file(
-        filepath,
-        as_attachment=True,
-        download_name=filename,
-        mimetype=mimetype
-    )
+    plan['send_body'] = True
+    if plan['start'] == 0:
+        logger.info(f'用户下载文件: {task_id} - {filename}')
+    else:
+        logger.info(f'用户续传文件: {task_id} - {filename}, 从 {plan["start"]} 字节开始')
+    return plan
+
+@app.route('/api/file/<task_id>', methods=['GET'])
+def download_file(task_id):
+    """
+    下载已完成的文件
+    支持 Range / If-Range 断点续传；全部字节送达后任务被标记为已下载，稍后自动清理
+    """
+    plan = plan_file_download(task_id, request)
+
+    if plan['error']:
+        return json_response({'error': plan['error']}, plan['status'])
+
+    if not plan['send_body']:
+        return Response(status=plan['status'], mimetype=plan['mimetype'], headers=plan['headers'])
+
+    start, end = plan['start'], plan['end']
+
+    # 视频 + 字幕：按清单实时生成 zip 的对应范围
+    if plan['bundle']:
+        body = iter_tracked_bundle(task_id, plan['bundle'], start, end)
+    else:
+        body = wrap_file(request.environ, TrackedFileRange(task_id, plan['filepath'], start, end - start),
+                         STREAM_CHUNK_SIZE)
+
+    return Response(body, status=plan['status'], mimetype=plan['mimetype'], headers=plan['headers'],
+                    direct_passthrough=True)
+
+
+# ================ 视频信息缓存 ================
+# /api/info 的处理结果缓存在任务数据库的 info_cache 表中，所有 worker 共享
+# 缓存键使用提取器给出的规范视频 ID（如 Youtube:dQw4w9WgXcQ），
+# 因此 youtu.be/x 和 watch?v=x 命中同一条缓存
+
+from urllib.parse import urlparse, parse_qs
+
+# 缓存有效期（秒），不会超过格式地址中签名的过期时间
+INFO_CACHE_TTL = int(os.environ.get('INFO_CACHE_TTL', '1800'))
+# 最大缓存条目数
+INFO_CACHE_MAX_ENTRIES = int(os.environ.get('INFO_CACHE_MAX_ENTRIES', '500'))
+# 最大缓存字节数
+INFO_CACHE_MAX_BYTES = int(os.environ.get('INFO_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# 签名地址过期前预留的时间（秒）
+INFO_CACHE_EXPIRE_MARGIN = 60
+# 最多记住多少个主机匹配到的提取器
+EXTRACTOR_HOSTS_MAX = 256
+# 没有专用提取器的主机多久后重新扫描（秒）
+EXTRACTOR_MISS_TTL = 600
+
+# 主机名 -> {'ies': 该主机上匹配过的提取器, 'miss_at': 最近一次没有任何专用提取器匹配的时间}
+# 逐个调用全部 1800 多个提取器的 suitable() 每次要几十毫秒，同一主机的 URL 先试已匹配过的提取器
+_extractor_hosts = OrderedDict()
+_extractor_hosts_lock = threading.Lock()
+
+def init_info_cache():
+    """初始化视频信息缓存表"""
+    conn = get_db()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS info_cache (
+            cache_key TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_info_cache_last_access ON info_cache (last_access)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_info_cache_expires_at ON info_cache (expires_at)')
+
+init_info_cache()
+
+def find_extractor(video_url):
+    """
+    返回能处理该 URL 的专用提取器（不含通用提取器），没有则返回 None
+    先试同一主机匹配过的提取器；没有专用提取器的主机在 EXTRACTOR_MISS_TTL 内不再扫描
+    """
+    host = urlparse(video_url).hostname or ''
+    now = time.time()
+    with _extractor_hosts_lock:
+        entry = _extractor_hosts.get(host)
+        if entry is not None:
+            _extractor_hosts.move_to_end(host)
+            known = list(entry['ies'])
+            if not known and entry['miss_at'] and now - entry['miss_at'] < EXTRACTOR_MISS_TTL:
+                return None
+        else:
+            known = []
+
+    for ie in known:
+        if ie.suitable(video_url):
+            return ie
+
+    found = None
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if ie.ie_key() != 'Generic' and ie not in known and ie.suitable(video_url):
+            found = ie
+            break
+
+    with _extractor_hosts_lock:
+        entry = _extractor_hosts.setdefault(host, {'ies': [], 'miss_at': None})
+        _extractor_hosts.move_to_end(host)
+        if found is not None:
+            if found not in entry['ies']:
+                entry['ies'].append(found)
+        else:
+            entry['miss_at'] = now
+        while len(_extractor_hosts) > EXTRACTOR_HOSTS_MAX:
+            _extractor_hosts.popitem(last=False)
+    return found
+
+def get_info_cache_key(video_url):
+    """
+    不联网地从 URL 推断规范缓存键：{提取器}:{视频ID}
+    无法识别的 URL（通用提取器）退回使用 URL 本身
+    """
+    try:
+        ie = find_extractor(video_url)
+        if ie is not None:
+            video_id = ie.get_temp_id(video_url)
+            if video_id:
+                return f'{ie.ie_key()}:{video_id}'
+    except Exception as e:
+        logger.warning(f'解析缓存键失败: {video_url}, 错误: {e}')
+    return f'url:{video_url}'
+
+def get_info_cache_ttl(info):
+    """计算缓存有效期：取 INFO_CACHE_TTL 与格式地址签名过期时间（expire 参数）中较早者"""
+    ttl = INFO_CACHE_TTL
+    now = time.time()
+    for fmt in info.get('formats') or []:
+        url = fmt.get('url')
+        if not url:
+            continue
+        expire = parse_qs(urlparse(url).query).get('expire')
+        if expire and expire[0].isdigit():
+            ttl = min(ttl, int(expire[0]) - now - INFO_CACHE_EXPIRE_MARGIN)
+    return max(ttl, 0)
+
+def info_cache_get(cache_key):
+    """读取缓存，过期或不存在返回 None"""
+    try:
+        conn = get_db()
+        now = time.time()
+        row = conn.execute(
+            'SELECT data FROM info_cache WHERE cache_key = ? AND expires_at > ?', (cache_key, now)
+        ).fetchone()
+        if not row:
+            increment_counter('info_cache.misses')
+            return None
+        conn.execute('UPDATE info_cache SET last_access = ? WHERE cache_key = ?', (now, cache_key))
+        increment_counter('info_cache.hits')
+        return json.loads(row[0])
+    except Exception as e:
+        logger.error(f'读取视频信息缓存失败: {cache_key}, 错误: {e}')
+        return None
+
+def info_cache_put(cache_keys, result, ttl):
+    """写入缓存（同一结果可对应多个键），并按条目数和字节数做 LRU 淘汰"""
+    if ttl <= 0:
+        return
+    data = json.dumps(result, ensure_ascii=False)
+    now = time.time()
+    conn = get_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for cache_key in cache_keys:
+                conn.execute(
+                    'INSERT OR REPLACE INTO info_cache (cache_key, data, size, expires_at, last_access) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (cache_key, data, len(data.encode('utf-8')), now + ttl, now)
+                )
+
+            # 先清理过期条目，再按最近访问时间淘汰
+            conn.execute('DELETE FROM info_cache WHERE expires_at <= ?', (now,))
+            count, total_bytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM info_cache').fetchone()
+            if count > INFO_CACHE_MAX_ENTRIES or total_bytes > INFO_CACHE_MAX_BYTES:
+                evicted = 0
+                for cache_key, size in conn.execute(
+                    'SELECT cache_key, size FROM info_cache ORDER BY last_access ASC'
+                ).fetchall():
+                    if count <= INFO_CACHE_MAX_ENTRIES and total_bytes <= INFO_CACHE_MAX_BYTES:
+                        break
+                    conn.execute('DELETE FROM info_cache WHERE cache_key = ?', (cache_key,))
+                    count -= 1
+                    total_bytes -= size
+                    evicted += 1
+                increment_counter('info_cache.evictions', evicted)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception as e:
+        logger.error(f'写入视频信息缓存失败: {cache_keys}, 错误: {e}')
+
+def get_info_cache_stats():
+    """缓存统计：命中/未命中次数、命中率、条目数和字节数"""
+    counters = get_counters('info_cache.')
+    hits = int(counters.get('info_cache.hits', 0))
+    misses = int(counters.get('info_cache.misses', 0))
+    entries, total_bytes = get_db().execute(
+        'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM info_cache WHERE expires_at > ?', (time.time(),)
+    ).fetchone()
+    return {
+        'hits': hits,
+        'misses': misses,
+        'evictions': int(counters.get('info_cache.evictions', 0)),
+        'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else None,
+        'entries': entries,
+        'bytes': total_bytes,
+        'max_entries': INFO_CACHE_MAX_ENTRIES,
+        'max_bytes': INFO_CACHE_MAX_BYTES,
+    }
+
+@app.route('/api/cache/info', methods=['GET'])
+def info_cache_stats():
+    """视频信息缓存统计"""
+    return json_response(get_info_cache_stats())
+
+
+def extract_video_info(video_url):
+    """
+    调用 yt-dlp 提取视频信息（不下载）
+    返回 (处理后的结果, 原始 info)
+    """
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': False,
+        'nocheckcertificate': True,
+        'writesubtitles': True,
+        'allsubtitles': True,
+    }
+
+    if COOKIES_FILE and os.path.exists(COOKIES_FILE):
+        ydl_opts['cookiefile'] = COOKIES_FILE
+
+    info = extract_with_proxy(ydl_opts, video_url, 'info')
+
+    # 提取可用的视频格式
+    formats = []
+    seen_resolutions = set()
+
+    for fmt in info.get('formats', []):
+        # 只处理包含视频的格式
+        if fmt.get('vcodec') == 'none':
+            continue
+
+        height = fmt.get('height')
+        if not height:
+            continue
+
+        format_id = fmt.get('format_id')
+        ext = fmt.get('ext', 'mp4')
+        filesize = fmt.get('filesize') or fmt.get('filesize_approx')
+        vcodec = fmt.get('vcodec', '')
+        acodec = fmt.get('acodec', '')
+        fps = fmt.get('fps')
+
+        # 构建分辨率标签
+        resolution_label = f"{height}p"
+        if fps and fps > 30:
+            resolution_label += f" {fps}fps"
+
+        # 判断是否包含音频
+        has_audio = acodec and acodec != 'none'
+
+        # 用于去重的 key（同分辨率+fps只保留一个）
+        dedup_key = f"{height}_{fps}_{has_audio}"
+        if dedup_key in seen_resolutions:
+            continue
+        seen_resolutions.add(dedup_key)
+
+        formats.append({
+            'format_id': format_id,
+            'height': height,
+            'resolution': resolution_label,
+            'ext': ext,
+            'filesize': filesize,
+            'has_audio': has_audio,
+            'vcodec': vcodec.split('.')[0] if vcodec else '',
+            'acodec': acodec.split('.')[0] if acodec else '',
+            'fps': fps,
+        })
+
+    # 按分辨率从高到低排序
+    formats.sort(key=lambda x: (x['height'], x.get('fps') or 0), reverse=True)
+
+    # 提取可用字幕
+    subtitles = []
+    subtitle_data = info.get('subtitles', {})
+    auto_captions = info.get('automatic_captions', {})
+
+    # 手动上传的字幕
+    for lang, subs in subtitle_data.items():
+        if subs:
+            subtitles.append({
+                'lang': lang,
+                'name': get_language_name(lang),
+                'auto': False,
+            })
+
+    # 自动生成的字幕
+    for lang, subs in auto_captions.items():
+        if subs and lang not in subtitle_data:
+            subtitles.append({
+                'lang': lang,
+                'name': get_language_name(lang) + ' (自动生成)',
+                'auto': True,
+            })
+
+    result = {
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'thumbnail': info.get('thumbnail'),
+        'uploader': info.get('uploader'),
+        'view_count': info.get('view_count'),
+        'description': info.get('description', '')[:200],
+        'formats': formats,
+        'subtitles': subtitles,
+    }
+
+    return result, info
+
+
+def get_video_info_cached(video_url):
+    """获取视频信息，优先读缓存；返回 (结果, 是否命中缓存)"""
+    cache_key = get_info_cache_key(video_url)
+
+    result = info_cache_get(cache_key)
+    if result is not None:
+        logger.info(f'获取视频信息（缓存命中）: {video_url}')
+        return result, True
+
+    logger.info(f'获取视频信息: {video_url}')
+    result, info = extract_video_info(video_url)
 
+    # 同时以提取结果中的规范 ID 缓存，保证不同写法的 URL 共享同一条缓存
+    cache_keys = {cache_key}
+    if info.get('extractor_key') and info.get('id'):
+        cache_keys.add(f"{info['extractor_key']}:{info['id']}")
+    info_cache_put(cache_keys, result, get_info_cache_ttl(info))
+    return result, False
 
 @app.route('/api/info', methods=['POST'])
 def get_video_info():
@@ -755,6 +4699,7 @@ def get_video_info():
     获取视频信息（不下载）
     请求体: {"url": "YouTube视频URL"}
     返回: 视频基本信息、可用格式列表、字幕列表
+    结果按规范视频 ID 缓存，响应头 X-Cache 标明是否命中
     """
     try:
         data = request.get_json()
@@ -762,119 +4707,207 @@ def get_video_info():
         if not data or 'url' not in data:
             return json_response({'error': '缺少 URL 参数'}, 400)
 
-        video_url = data['url']
-        logger.info(f'获取视频信息: {video_url}')
+        result, cache_hit = get_video_info_cached(data['url'])
+        response = json_response(result)
+        response.headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
+        return response
 
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'nocheckcertificate': True,
-            'writesubtitles': True,
-            'allsubtitles': True,
-        }
+    except Exception as e:
+        logger.error(f'获取视频信息失败: {str(e)}')
+        return upstream_error_response(e, '获取信息失败')
+
+
+# ================ 批量接口 ================
+# /api/batch/info 和 /api/batch/start-download 一次处理多个 URL，可以包含播放列表和频道：
+#   - 播放列表用 extract_flat 展开，只读取条目 URL，不解析每个视频
+#   - 各条目在有界线程池中并发处理（每个 worker 共用一个线程池）
+#   - 以 NDJSON 流式返回，哪个条目先完成就先返回一行，客户端断开后取消未开始的条目
+
+from concurrent.futures import wait, FIRST_COMPLETED
+
+# 批量接口的并发数（每个 worker）
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
+# 单次批量请求最多处理的条目数（包括播放列表展开后的条目）
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '200'))
+
+_batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch')
+
+def is_playlist_url(video_url):
+    """是否为播放列表或频道地址（只有 list 参数没有 v 参数、/playlist、/@频道 等）"""
+    parsed = urlparse(video_url)
+    query = parse_qs(parsed.query)
+    if 'list' in query and 'v' not in query:
+        return True
+    return parsed.path.startswith(('/playlist', '/@', '/channel/', '/c/', '/user/'))
+
+def expand_playlist(playlist_url, depth=1):
+    """用 extract_flat 展开播放列表，返回条目 URL 列表；频道首页的标签页再展开一层"""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'playlistend': BATCH_MAX_ITEMS,
+        'nocheckcertificate': True,
+    }
 
-        if COOKIES_FILE and os.path.exists(COOKIES_FILE):
-            ydl_opts['cookiefile'] = COOKIES_FILE
+    if COOKIES_FILE and os.path.exists(COOKIES_FILE):
+        ydl_opts['cookiefile'] = COOKIES_FILE
 
-        if PROXY_URL:
-            ydl_opts['proxy'] = PROXY_URL
+    info = extract_with_proxy(ydl_opts, playlist_url, 'playlist')
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=False)
+    urls = []
+    for entry in info.get('entries') or []:
+        entry_url = entry and (entry.get('webpage_url') or entry.get('url'))
+        if not entry_url:
+            continue
+        if depth > 0 and is_playlist_url(entry_url):
+            urls.extend(expand_playlist(entry_url, depth - 1))
+        else:
+            urls.append(entry_url)
+        if len(urls) >= BATCH_MAX_ITEMS:
+            break
+    return urls[:BATCH_MAX_ITEMS]
 
-            # 提取可用的视频格式
-            formats = []
-            seen_resolutions = set()
+def parse_batch_items(data):
+    """
+    解析批量请求体中的条目：urls 里每项可以是 URL 字符串，或 {"url": ..., 其他参数} 对象
+    返回 (条目列表, 错误信息)
+    """
+    items = data.get('urls') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return None, '缺少 urls 参数'
+    if len(items) > BATCH_MAX_ITEMS:
+        return None, f'单次最多 {BATCH_MAX_ITEMS} 个 URL'
+
+    parsed = []
+    for item in items:
+        if isinstance(item, str):
+            item = {'url': item}
+        if not isinstance(item, dict) or not item.get('url'):
+            return None, 'urls 中的每一项必须是 URL 或包含 url 的对象'
+        parsed.append(item)
+    return parsed, None
+
+def batch_response(items, process_item):
+    """
+    并发处理批量条目，按完成顺序逐行返回 NDJSON
+    process_item(item) 返回该条目的结果字段；抛出异常时该行带 error 字段
+    每行都带 url，播放列表展开出的条目还带 playlist（来源播放列表地址）
+    """
+    def generate():
+        pending = {}
+        submitted = 0
+        truncated = False
+
+        def submit_item(item):
+            nonlocal submitted, truncated
+            if submitted >= BATCH_MAX_ITEMS:
+                truncated = True
+                return
+            pending[_batch_executor.submit(process_item, item)] = ('item', item)
+            submitted += 1
 
-            for fmt in info.get('formats', []):
-                # 只处理包含视频的格式
-                if fmt.get('vcodec') == 'none':
-                    continue
+        try:
+            for item in items:
+                if is_playlist_url(item['url']):
+                    pending[_batch_executor.submit(expand_playlist, item['url'])] = ('playlist', item)
+                else:
+                    submit_item(item)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, item = pending.pop(future)
+                    line = {'url': item['url']}
+                    if item.get('playlist'):
+                        line['playlist'] = item['playlist']
+
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        line['error'] = str(e)
+                        error_type = get_upstream_error_type(e)
+                        if error_type:
+                            line['error_type'] = error_type
+                        yield json.dumps(line, ensure_ascii=False) + '\n'
+                        continue
+
+                    if kind == 'playlist':
+                        # 条目继承播放列表请求中的其他参数（字幕、优先级等）
+                        for entry_url in result:
+                            submit_item({**item, 'url': entry_url, 'playlist': item['url']})
+                        line.update({'type': 'playlist', 'entries': len(result)})
+                    else:
+                        line.update(result)
+                    yield json.dumps(line, ensure_ascii=False) + '\n'
+
+            if truncated:
+                yield json.dumps({'error': f'超过单次批量上限 {BATCH_MAX_ITEMS}，其余条目已忽略'},
+                                 ensure_ascii=False) + '\n'
+        finally:
+            # 客户端断开或处理完成：取消还没开始执行的条目
+            for future in pending:
+                future.cancel()
 
-                height = fmt.get('height')
-                if not height:
-                    continue
+    return Response(
+        generate(),
+        mimetype='application/x-ndjson',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        }
+    )
 
-                format_id = fmt.get('format_id')
-                ext = fmt.get('ext', 'mp4')
-                filesize = fmt.get('filesize') or fmt.get('filesize_approx')
-                vcodec = fmt.get('vcodec', '')
-                acodec = fmt.get('acodec', '')
-                fps = fmt.get('fps')
+@app.route('/api/batch/info', methods=['POST'])
+def batch_video_info():
+    """
+    批量获取视频信息
+    请求体: {"urls": ["视频或播放列表 URL", ...]}
+    返回: NDJSON，每行 {"url": ..., "info": {...}, "cached": 是否命中缓存} 或 {"url": ..., "error": ...}
+    """
+    items, error = parse_batch_items(request.get_json(silent=True))
+    if error:
+        return json_response({'error': error}, 400)
 
-                # 构建分辨率标签
-                resolution_label = f"{height}p"
-                if fps and fps > 30:
-                    resolution_label += f" {fps}fps"
+    def process_item(item):
+        result, cache_hit = get_video_info_cached(item['url'])
+        return {'info': result, 'cached': cache_hit}
 
-                # 判断是否包含音频
-                has_audio = acodec and acodec != 'none'
+    logger.info(f'批量获取视频信息: {len(items)} 个 URL')
+    return batch_response(items, process_item)
 
-                # 用于去重的 key（同分辨率+fps只保留一个）
-                dedup_key = f"{height}_{fps}_{has_audio}"
-                if dedup_key in seen_resolutions:
-                    continue
-                seen_resolutions.add(dedup_key)
-
-                formats.append({
-                    'format_id': format_id,
-                    'height': height,
-                    'resolution': resolution_label,
-                    'ext': ext,
-                    'filesize': filesize,
-                    'has_audio': has_audio,
-                    'vcodec': vcodec.split('.')[0] if vcodec else '',
-                    'acodec': acodec.split('.')[0] if acodec else '',
-                    'fps': fps,
-                })
+@app.route('/api/batch/start-download', methods=['POST'])
+def batch_start_download():
+    """
+    批量启动下载任务
+    请求体: {
+        "urls": ["URL", {"url": "URL", "format_id": ..., "subtitle": ..., "priority": ...}, ...],
+        "format_id" / "subtitle" / "priority": 所有条目的默认参数（可选）
+    }
+    返回: NDJSON，每行 {"url": ..., "task_id": ..., "queue_position": ...} 或 {"url": ..., "error": ...}
+    """
+    data = request.get_json(silent=True)
+    items, error = parse_batch_items(data)
+    if error:
+        return json_response({'error': error}, 400)
 
-            # 按分辨率从高到低排序
-            formats.sort(key=lambda x: (x['height'], x.get('fps') or 0), reverse=True)
-
-            # 提取可用字幕
-            subtitles = []
-            subtitle_data = info.get('subtitles', {})
-            auto_captions = info.get('automatic_captions', {})
-
-            # 手动上传的字幕
-            for lang, subs in subtitle_data.items():
-                if subs:
-                    subtitles.append({
-                        'lang': lang,
-                        'name': get_language_name(lang),
-                        'auto': False,
-                    })
-
-            # 自动生成的字幕
-            for lang, subs in auto_captions.items():
-                if subs and lang not in subtitle_data:
-                    subtitles.append({
-                        'lang': lang,
-                        'name': get_language_name(lang) + ' (自动生成)',
-                        'auto': True,
-                    })
-
-            result = {
-                'title': info.get('title'),
-                'duration': info.get('duration'),
-                'thumbnail': info.get('thumbnail'),
-                'uploader': info.get('uploader'),
-                'view_count': info.get('view_count'),
-                'description': info.get('description', '')[:200],
-                'formats': formats,
-                'subtitles': subtitles,
-            }
+    defaults = {key: data.get(key) for key in ('format_id', 'subtitle', 'priority')}
 
-            return Response(
-                json.dumps(result, ensure_ascii=False),
-                mimetype='application/json; charset=utf-8'
-            )
+    def process_item(item):
+        options = {**defaults, **{key: item[key] for key in defaults if key in item}}
+        try:
+            priority = int(options['priority'] or 0)
+        except (TypeError, ValueError):
+            raise ValueError('priority 参数必须是整数')
 
-    except Exception as e:
-        logger.error(f'获取视频信息失败: {str(e)}')
-        return json_response({'error': f'获取信息失败: {str(e)}'}, 400)
+        task_id, mode = create_download_task(item['url'], options['format_id'], options['subtitle'], priority,
+                                             batch=True)
+        if mode == 'rejected':
+            raise Exception('服务器繁忙，下载队列已满，请稍后重试')
+        return {'task_id': task_id, 'mode': mode, 'queue_position': get_queue_position(task_id)}
 
+    logger.info(f'批量启动下载任务: {len(items)} 个 URL')
+    return batch_response(items, process_item)
 
 def get_language_name(lang_code):
     """将语言代码转换为可读名称"""
@@ -917,6 +4950,295 @@ def get_language_name(lang_code):
     }
     return lang_map.get(lang_code, lang_code)
 
+# ================ ASGI 异步模式 ================
+# SERVER_MODE=asgi 时由 uvicorn 运行 asgi_app（见 entrypoint.sh），默认仍为 gunicorn + WSGI：
+#   - 健康检查、进度查询、SSE 进度流、文件下载和视频信息在事件循环中处理，
+#     慢速客户端只占用一个协程而不是一个线程，可以同时挂着数千个连接
+#   - 读写数据库、读文件等短小的阻塞操作放到默认线程池，yt-dlp 提取放到单独的有界线程池，
+#     不会因为 yt-dlp 占满线程而阻塞健康检查和文件下载
+#   - 其他接口交给 Flask 应用（asgiref 的 WsgiToAsgi，在线程中运行）
+
+import asyncio
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.wrappers import Request as WerkzeugRequest
+
+# 执行 yt-dlp 提取等耗时阻塞操作的线程数（每个 worker）
+ASGI_BLOCKING_THREADS = int(os.environ.get('ASGI_BLOCKING_THREADS', '8'))
+
+_asgi_blocking_executor = ThreadPoolExecutor(max_workers=ASGI_BLOCKING_THREADS, thread_name_prefix='asgi-blocking')
+_asgi_wsgi_app = WsgiToAsgi(app)
+
+async def run_io(func, *args):
+    """在默认线程池中执行短小的阻塞操作（数据库、文件读取）"""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+async def run_blocking(func, *args):
+    """在有界线程池中执行耗时的阻塞操作（yt-dlp）"""
+    return await asyncio.get_running_loop().run_in_executor(_asgi_blocking_executor, func, *args)
+
+def asgi_environ(scope):
+    """根据 ASGI scope 构造最小的 WSGI environ，用于 werkzeug 解析请求头（Range、If-Range 等）"""
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': 'asgi',
+        'SERVER_PORT': '0',
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+    }
+    for name, value in scope.get('headers', []):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+        environ[key] = value.decode('latin-1')
+    return environ
+
+async def asgi_send_start(send, status, headers, mimetype=None):
+    """发送响应状态和响应头（与 Flask-CORS 的默认配置一致，允许任意来源）"""
+    raw_headers = [(b'access-control-allow-origin', b'*')]
+    if mimetype:
+        raw_headers.append((b'content-type', mimetype.encode('latin-1')))
+    for name, value in headers.items():
+        raw_headers.append((name.lower().encode('latin-1'), str(value).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+
+async def asgi_json(send, data, status=200, headers=None):
+    """返回 JSON 响应，支持中文"""
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    await asgi_send_start(send, status, {**(headers or {}), 'Content-Length': len(body)},
+                          'application/json; charset=utf-8')
+    await send({'type': 'http.response.body', 'body': body})
+
+async def asgi_read_body(receive):
+    """读取完整的请求体"""
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+def watch_disconnect(receive):
+    """后台等待客户端断开，返回在断开时被设置的 Event 和对应的任务"""
+    disconnected = asyncio.Event()
+
+    async def watch():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    return disconnected, asyncio.create_task(watch())
+
+async def asgi_health(scope, receive, send):
+    """Koyeb 健康检查（不访问数据库，不会被阻塞操作拖慢），同 /health"""
+    await asgi_json(send, {'status': 'healthy', 'upstream': get_breaker_status()})
+
+async def asgi_progress(scope, receive, send, task_id):
+    """获取下载进度，同 /api/progress/<task_id>"""
+    payload, status = await run_io(lambda: build_progress_payload(task_id, poll_task(task_id)))
+    await asgi_json(send, payload, status)
+
+async def asgi_progress_stream(scope, receive, send, task_id):
+    """以 Server-Sent Events 推送下载进度，同 /api/progress/<task_id>/stream"""
+    stream = ProgressStream(task_id)
+    disconnected, watcher = watch_disconnect(receive)
+    try:
+        await asgi_send_start(send, 200, PROGRESS_STREAM_HEADERS, 'text/event-stream; charset=utf-8')
+        await send({'type': 'http.response.body', 'body': stream.start().encode('utf-8'), 'more_body': True})
+
+        while not disconnected.is_set():
+            text, done = await run_io(stream.poll)
+            if text:
+                await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+            if done:
+                break
+            try:
+                await asyncio.wait_for(disconnected.wait(), PROGRESS_STREAM_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+
+async def asgi_file(scope, receive, send, task_id):
+    """下载已完成的文件，同 /api/file/<task_id>（支持 Range / If-Range，记录实际送达的字节区间）"""
+    plan = await run_io(plan_file_download, task_id, WerkzeugRequest(asgi_environ(scope)))
+
+    if plan['error']:
+        await asgi_json(send, {'error': plan['error']}, plan['status'])
+        return
+
+    await asgi_send_start(send, plan['status'], plan['headers'], plan['mimetype'])
+    if not plan['send_body']:
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    start, end = plan['start'], plan['end']
+    chunks = file = None
+    position = start
+    # 读取在线程池中进行；关闭数据源时持有同一把锁，等正在进行的读取结束后再关闭
+    source_lock = threading.Lock()
+
+    def read_chunk():
+        nonlocal chunks, file, position
+        with source_lock:
+            if plan['bundle']:
+                if chunks is None:
+                    chunks = plan['bundle'].iter_range(start, end)
+                return next(chunks, b'')
+            if file is None:
+                file = open(plan['filepath'], 'rb')
+                file.seek(start)
+            data = file.read(min(STREAM_CHUNK_SIZE, end - position))
+            position += len(data)
+            return data
+
+    def close_source():
+        with source_lock:
+            # zip 生成器关闭时会关闭其中正在读取的文件
+            if chunks is not None:
+                chunks.close()
+            if file is not None:
+                file.close()
+
+    disconnected, watcher = watch_disconnect(receive)
+    started = time.perf_counter()
+    sent = 0
+    try:
+        # send 会等待发送缓冲区排空，慢速客户端只会让这个协程等待；客户端断开后立即停止
+        while sent < end - start and not disconnected.is_set():
+            chunk = await run_io(read_chunk)
+            if not chunk or disconnected.is_set():
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            sent += len(chunk)
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        # 客户端中途断开（包括协程被取消）时同样关闭文件和 zip 生成器，避免泄漏文件描述符；
+        # 读取可能仍在线程池中进行，关闭也交给线程池，不阻塞事件循环
+        asyncio.get_running_loop().run_in_executor(None, close_source)
+        record_file_served('zip' if plan['bundle'] else 'file', sent, started)
+        await run_io(record_delivered_range, task_id, start, sent, started)
+
+async def asgi_video_info(scope, receive, send):
+    """获取视频信息，同 /api/info（缓存未命中时在有界线程池中调用 yt-dlp）"""
+    body = await asgi_read_body(receive)
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = None
+
+    if not isinstance(data, dict) or 'url' not in data:
+        await asgi_json(send, {'error': '缺少 URL 参数'}, 400)
+        return
+
+    try:
+        result, cache_hit = await run_blocking(get_video_info_cached, data['url'])
+    except Exception as e:
+        logger.error(f'获取视频信息失败: {str(e)}')
+        payload, status, headers = describe_upstream_error(e, '获取信息失败')
+        await asgi_json(send, payload, status, headers)
+        return
+    await asgi_json(send, result, headers={'X-Cache': 'HIT' if cache_hit else 'MISS'})
+
+# 在事件循环中直接处理的接口: (路径, 允许的方法, 处理函数)，其余交给 Flask
+ASGI_ROUTES = [
+    (re.compile(r'/health'), ('GET', 'HEAD'), asgi_health),
+    (re.compile(r'/api/progress/([^/]+)'), ('GET',), asgi_progress),
+    (re.compile(r'/api/progress/([^/]+)/stream'), ('GET',), asgi_progress_stream),
+    (re.compile(r'/api/file/([^/]+)'), ('GET', 'HEAD'), asgi_file),
+    (re.compile(r'/api/info'), ('POST',), asgi_video_info),
+]
+
+async def asgi_app(scope, receive, send):
+    """ASGI 入口：uvicorn app:asgi_app"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] == 'http':
+        for pattern, methods, handler in ASGI_ROUTES:
+            match = pattern.fullmatch(scope['path'])
+            if match and scope['method'] in methods:
+                await handler(scope, receive, send, *match.groups())
+                return
+
+    await _asgi_wsgi_app(scope, receive, send)
+
+# ================ 后台线程与预热 ================
+# 后台线程（下载调度、过期清理、指标写入）在每个 worker 进程中启动一次：
+#   - 直接导入（python app.py、uvicorn、未预加载的 gunicorn）时在模块加载完成后启动，
+#     预热在后台线程中进行，worker 立即可以响应 /health
+#   - gunicorn 预加载时 master 进程只导入并预热，fork 出的 worker 在 post_worker_init 中调用 init_worker
+#     （线程和信号处理不会被 fork 继承）
+
+# 由 gunicorn.conf.py 设置，表示当前是 gunicorn master 进程在预加载
+APP_PRELOAD = os.environ.get('APP_PRELOAD') == '1'
+# 是否在启动时预热（导入 yt_dlp、解析 cookies）
+WARM_UP = os.environ.get('WARM_UP', '1') == '1'
+
+_worker_initialized = False
+
+def start_background_threads():
+    """启动本进程的后台线程"""
+    threading.Thread(target=download_dispatch_loop, daemon=True, name='dispatch').start()
+    logger.info(f'已启动下载调度线程，最大并发: {MAX_CONCURRENT_DOWNLOADS}，最大排队: {MAX_QUEUED_DOWNLOADS}')
+    # 每个 worker 都会启动清理线程，只有当选的 worker 会执行清理
+    threading.Thread(target=janitor_loop, daemon=True, name='janitor').start()
+    logger.info('已启动文件清理线程')
+    threading.Thread(target=metrics_flush_loop, daemon=True, name='metrics').start()
+
+def init_worker():
+    """初始化 worker 进程：注册信号处理并启动后台线程（重复调用无效）"""
+    global _worker_initialized
+    if _worker_initialized:
+        return
+    _worker_initialized = True
+    install_cookie_signal_handler()
+    start_background_threads()
+
+def warm_up():
+    """预热：导入 yt_dlp 和提取器列表、解析 cookies，首个请求不再承担这些开销"""
+    started = time.perf_counter()
+    try:
+        yt_dlp.load()
+        yt_dlp.extractor.gen_extractor_classes()
+        if os.path.exists(COOKIES_FILE):
+            get_cookie_jar(COOKIES_FILE)
+    except Exception as e:
+        logger.error(f'预热失败: {e}')
+        return
+    logger.info(f'预热完成, 耗时 {(time.perf_counter() - started) * 1000:.0f}ms')
+
+def report_boot():
+    """输出各启动阶段的耗时"""
+    phases = ', '.join(f'{name} {ms:.0f}ms' for name, ms in BOOT_PHASES)
+    total = (time.perf_counter() - _boot_started) * 1000
+    age = get_process_age()
+    age_text = f'，进程启动至今 {age * 1000:.0f}ms' if age is not None else ''
+    logger.info(f'启动耗时: {phases}，合计 {total:.0f}ms{age_text}')
+
+boot_phase('初始化')
+if APP_PRELOAD:
+    # master 进程在 fork 之前预热，worker 以写时复制的方式共享已导入的模块和 cookies
+    if WARM_UP:
+        warm_up()
+        boot_phase('预热')
+else:
+    init_worker()
+    if WARM_UP:
+        threading.Thread(target=warm_up, daemon=True, name='warm-up').start()
+report_boot()
+
 def parse_args():
     """解析命令行参数"""
     parser = argparse.ArgumentParser(description='YouTube Downloader API Server')
@@ -932,11 +5254,16 @@ def parse_args():
         default=None,
         help='服务器端口 (默认: 从环境变量 PORT 读取，或 8000)'
     )
+    parser.add_argument(
+        '--asgi',
+        action='store_true',
+        help='使用 ASGI 异步模式运行（uvicorn），长连接不占用线程'
+    )
     parser.add_argument(
         '--proxy',
         type=str,
         default=None,
-        help='代理服务器地址 (例如: socks5://127.0.0.1:1080 或 http://proxy.example.com:8080)'
+        help='代理服务器地址，多个用逗号分隔组成代理池，direct 表示直连 (例如: socks5://127.0.0.1:1080,http://proxy.example.com:8080)'
     )
     return parser.parse_args()
 
@@ -950,15 +5277,17 @@ if __name__ == '__main__':
     else:
         logger.warning(f'Cookies 文件不存在: {COOKIES_FILE}，将在没有 cookies 的情况下运行')
 
-    # 设置全局代理
+    # 设置代理池（命令行参数优先于环境变量）
     if args.proxy:
-        PROXY_URL = args.proxy
-        logger.info(f'已配置代理: {PROXY_URL}')
-    else:
-        logger.info('未配置代理，将直接连接')
+        PROXY_POOL = parse_proxy_list(args.proxy)
+        logger.info(f'已配置代理池: {", ".join(mask_proxy_url(proxy) for proxy in PROXY_POOL)}')
 
     # 确定端口
     port = args.port if args.port else int(os.environ.get('PORT', 8000))
     logger.info(f'启动服务器，监听端口: {port}')
 
-    app.run(host='0.0.0.0', port=port, debug=False)
+    if args.asgi:
+        import uvicorn
+        uvicorn.run(asgi_app, host='0.0.0.0', port=port)
+    else:
+        app.run(host='0.0.0.0', port=port, debug=False)
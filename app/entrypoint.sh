@@ -22,10 +22,30 @@ else
     echo "未配置代理，将直接连接"
 fi
 
-# 启动 gunicorn
-# 超时设置为 600 秒（10 分钟），支持下载较长的视频
-exec gunicorn --bind 0.0.0.0:8000 \
-    --workers 2 \
+# 启动耗时分析（可选）：输出 python -X importtime 格式的每个模块导入耗时
+if [ "${BOOT_IMPORT_PROFILE:-0}" = "1" ]; then
+    export PYTHONPROFILEIMPORTTIME=1
+fi
+
+# 启动服务
+# SERVER_MODE=asgi：uvicorn 运行 ASGI 入口，进度流、文件下载等长连接在事件循环中处理，不占用线程
+# 默认（wsgi）：gunicorn，超时设置为 600 秒（10 分钟），支持下载较长的视频；
+# 使用 gthread worker：SSE 进度流等长连接只占用一个线程，而不是整个 worker 进程
+if [ "${SERVER_MODE:-wsgi}" = "asgi" ]; then
+    echo "使用 ASGI 异步模式启动"
+    exec uvicorn app:asgi_app \
+        --host 0.0.0.0 \
+        --port 8000 \
+        --workers "${WEB_WORKERS:-2}" \
+        --timeout-keep-alive 75
+fi
+
+# gunicorn.conf.py：预加载 app.py，master 预热后再 fork worker
+exec gunicorn --config gunicorn.conf.py \
+    --bind 0.0.0.0:8000 \
+    --workers "${WEB_WORKERS:-2}" \
+    --worker-class gthread \
+    --threads "${GUNICORN_THREADS:-16}" \
     --timeout 600 \
     --access-logfile - \
     --error-logfile - \
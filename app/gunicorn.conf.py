@@ -0,0 +1,19 @@
+"""
+gunicorn 配置（监听地址、worker 数等命令行参数见 entrypoint.sh）
+
+预加载 app.py：master 进程完成导入和预热（yt_dlp、cookies）后再 fork，
+worker 以写时复制的方式共享这些内存，fork 后立即可以处理请求
+后台线程和信号处理不会被 fork 继承，在每个 worker 初始化完成后由 post_worker_init 启动
+"""
+
+import os
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+if preload_app:
+    os.environ['APP_PRELOAD'] = '1'
+
+
+def post_worker_init(worker):
+    import app
+    app.init_worker()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+带宽调度基准测试：平均分配（fair）vs 偏向剩余字节少的任务（srpt）
+
+在本地媒体替身服务器上同时下载 1 个大文件和若干个小文件（替身服务器不限速，
+瓶颈是 BANDWIDTH_LIMIT 设置的节点带宽上限），比较两种分配策略下各任务的完成时间。
+fair 相当于不做调度时多个连接平分瓶颈带宽的情况。
+
+用法:
+    python3 bench/bench_bandwidth.py [--limit-mbps 64] [--large-mb 40] [--small-mb 4] [--small 5]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+
+BENCH_DIR = tempfile.mkdtemp(prefix='bench-bandwidth-')
+os.environ['CACHE_DIR'] = BENCH_DIR
+# 所有任务同时下载，不排队；不自动取消（基准测试不轮询进度）
+os.environ['MAX_CONCURRENT_DOWNLOADS'] = '32'
+os.environ['MAX_QUEUED_DOWNLOADS'] = '64'
+os.environ['TASK_IDLE_TIMEOUT'] = '0'
+os.environ['WARM_UP'] = '0'
+BENCH_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_ROOT, '..', 'app'))
+sys.path.insert(0, BENCH_ROOT)
+
+import app  # noqa: E402
+from media_server import start_server  # noqa: E402
+
+app.logger.setLevel(logging.WARNING)
+
+
+def reset_registry():
+    """清空任务和下载产物，避免下一轮复用上一轮的文件"""
+    conn = app.get_db()
+    conn.execute('DELETE FROM tasks')
+    conn.execute('DELETE FROM artifacts')
+    for name in os.listdir(BENCH_DIR):
+        path = os.path.join(BENCH_DIR, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def run_round(policy, jobs, run):
+    """同时提交所有任务，返回 [(类别, 完成耗时)]"""
+    app.BANDWIDTH_POLICY = policy
+    reset_registry()
+
+    started = time.perf_counter()
+    pending = {}
+    for index, (kind, url) in enumerate(jobs):
+        # 每个任务使用不同的 URL，避免被合并为同一个下载
+        task_id, _ = app.create_download_task(f'{url}?run={run}&n={index}')
+        pending[task_id] = kind
+
+    results = []
+    while pending:
+        for task_id, kind in list(pending.items()):
+            task = app.load_task(task_id) or {}
+            if task.get('status') in ('completed', 'failed'):
+                if task['status'] == 'failed':
+                    raise RuntimeError(f'下载失败: {task.get("error")}')
+                results.append((kind, time.perf_counter() - started))
+                del pending[task_id]
+        time.sleep(0.05)
+    return results
+
+
+def summarize(results):
+    summary = {'mean_s': statistics.mean(t for _, t in results), 'makespan_s': max(t for _, t in results)}
+    for kind in ('small', 'large'):
+        times = [t for k, t in results if k == kind]
+        summary[f'{kind}_mean_s'] = statistics.mean(times)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='带宽调度基准测试')
+    parser.add_argument('--limit-mbps', type=float, default=64, help='节点带宽上限 Mbps (默认: 64)')
+    parser.add_argument('--large-mb', type=float, default=40, help='大文件大小 MB (默认: 40)')
+    parser.add_argument('--small-mb', type=float, default=4, help='小文件大小 MB (默认: 4)')
+    parser.add_argument('--small', type=int, default=5, help='小文件任务数 (默认: 5)')
+    parser.add_argument('--json', action='store_true', help='以 JSON 格式输出结果')
+    args = parser.parse_args()
+
+    app.BANDWIDTH_LIMIT = int(args.limit_mbps * 1024 * 1024 / 8)
+    large_server, large_url = start_server(0, args.large_mb, 10)
+    small_server, small_url = start_server(0, args.small_mb, 10)
+    jobs = [('large', large_url + '/progressive.mp4')] + [('small', small_url + '/progressive.mp4')] * args.small
+
+    app.init_worker()
+    report = {}
+    try:
+        for run, policy in enumerate(('fair', 'srpt')):
+            report[policy] = summarize(run_round(policy, jobs, run))
+    finally:
+        large_server.shutdown()
+        small_server.shutdown()
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f'带宽上限 {args.limit_mbps} Mbps，1 个 {args.large_mb} MB + {args.small} 个 {args.small_mb} MB 同时下载')
+    print(f'{"策略":<8}{"平均完成 s":>12}{"小文件平均 s":>14}{"大文件 s":>10}{"全部完成 s":>12}')
+    for policy, r in report.items():
+        print(f'{policy:<8}{r["mean_s"]:>12.2f}{r["small_mean_s"]:>14.2f}{r["large_mean_s"]:>10.2f}{r["makespan_s"]:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+上游熔断基准测试：视频源持续限流（所有请求返回 429）时，不熔断 vs 熔断
+
+经代理替身（对所有请求返回 429）提取 --requests 次视频信息，比较两种设置下
+实际打到上游的请求数（继续请求会延长封禁）和每个请求的平均响应时间（熔断时直接返回 503）。
+然后让上游恢复，统计熔断打开后多久第一个请求重新成功。
+
+用法:
+    python3 bench/bench_breaker.py [--requests 100] [--open-time 3]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+
+BENCH_DIR = tempfile.mkdtemp(prefix='bench-breaker-')
+os.environ['CACHE_DIR'] = BENCH_DIR
+os.environ['TASK_IDLE_TIMEOUT'] = '0'
+os.environ['WARM_UP'] = '0'
+BENCH_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_ROOT, '..', 'app'))
+sys.path.insert(0, BENCH_ROOT)
+
+import app  # noqa: E402
+from media_server import start_server  # noqa: E402
+from proxy_server import start_proxy  # noqa: E402
+
+app.logger.setLevel(logging.CRITICAL)
+
+
+def run_round(name, error_rate, media_url, requests, open_time):
+    """依次提取视频信息，返回上游请求数、平均响应时间和恢复耗时"""
+    app.get_db().execute('DELETE FROM breakers')
+    app.BREAKER_ERROR_RATE = error_rate
+    app.BREAKER_OPEN_TIME = open_time
+    limited, limited_url = start_proxy(0, status=429)
+    app.PROXY_POOL = [limited_url]
+
+    samples = []
+    rejected = 0
+    for i in range(requests):
+        started = time.perf_counter()
+        try:
+            app.extract_video_info(f'{media_url}/progressive.mp4?{name}={i}')
+        except app.CircuitOpenError:
+            rejected += 1
+        except Exception:
+            pass
+        samples.append(time.perf_counter() - started)
+    upstream_requests = limited.stand_in.stats['requests']
+    limited.shutdown()
+
+    # 上游恢复：直连媒体替身，统计第一个成功请求出现的时间
+    app.PROXY_POOL = []
+    started = time.perf_counter()
+    while True:
+        try:
+            app.extract_video_info(f'{media_url}/progressive.mp4?{name}-recovered')
+            break
+        except app.CircuitOpenError:
+            time.sleep(0.1)
+    return {
+        'upstream_requests': upstream_requests,
+        'rejected': rejected,
+        'mean_ms': statistics.mean(samples) * 1000,
+        'recovery_s': time.perf_counter() - started,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='上游熔断基准测试')
+    parser.add_argument('--requests', type=int, default=100, help='限流期间的提取次数 (默认: 100)')
+    parser.add_argument('--open-time', type=int, default=3, help='熔断时间秒数 (默认: 3)')
+    parser.add_argument('--json', action='store_true', help='以 JSON 格式输出结果')
+    args = parser.parse_args()
+
+    media_server, media_url = start_server(0, 1, 10)
+    report = {}
+    try:
+        for name, error_rate in (('off', 0), ('on', 0.5)):
+            report[name] = run_round(name, error_rate, media_url, args.requests, args.open_time)
+    finally:
+        media_server.shutdown()
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f'上游持续返回 429，提取 {args.requests} 次视频信息（熔断阈值: {app.BREAKER_MIN_REQUESTS} 个请求中'
+          f'错误率 50%，熔断 {args.open_time}s）')
+    print(f'{"熔断":<6}{"上游请求":>10}{"直接拒绝":>10}{"平均响应 ms":>14}{"恢复耗时 s":>12}')
+    for name, r in report.items():
+        print(f'{name:<6}{r["upstream_requests"]:>10}{r["rejected"]:>10}{r["mean_ms"]:>14.1f}{r["recovery_s"]:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
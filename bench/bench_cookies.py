@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+cookies 加载开销基准测试：每次请求解析 cookies 文件 vs 进程内共享的 cookie jar
+
+对不同大小的 cookies 文件（默认 1000 / 5000 / 20000 条）分别测量每次请求的 cookies 准备耗时：
+  - parse：每次请求解析一遍 Netscape 文件（新建 YoutubeDL 并传入 cookiefile 时的开销）
+  - fresh_ydl：新建 YoutubeDL(cookiefile=...) 并取得 cookiejar
+  - shared：app.get_cookie_jar 取得共享 jar（稳定状态下只检查修改时间）
+  - pooled：从实例池借出 YoutubeDL 并取得 cookiejar（实际请求路径）
+  - reload：cookies 文件变化后第一次取得 jar 的耗时（重新解析 + 清空实例池，每次变化只发生一次）
+
+用法:
+    python3 bench/bench_cookies.py [--sizes 1000,5000,20000] [--requests 50]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+
+BENCH_DIR = tempfile.mkdtemp(prefix='bench-cookies-')
+os.environ['CACHE_DIR'] = BENCH_DIR
+# 基准测试自己触发重新解析，不需要按间隔检查
+os.environ['COOKIES_CHECK_INTERVAL'] = '3600'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import yt_dlp  # noqa: E402
+import app  # noqa: E402
+
+app.logger.setLevel(logging.WARNING)
+
+
+def write_cookie_file(path, count):
+    """生成包含 count 条记录的 Netscape 格式 cookies 文件"""
+    expires = int(time.time()) + 86400 * 365
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('# Netscape HTTP Cookie File\n')
+        for i in range(count):
+            f.write(f'.example{i % 50}.com\tTRUE\t/\tTRUE\t{expires}\tcookie_{i}\t{"v" * 64}\n')
+
+
+def measure(fn, requests):
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return {
+        'requests': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'p50_ms': statistics.median(samples) * 1000,
+        'max_ms': max(samples) * 1000,
+    }
+
+
+def fresh_ydl(cookiefile):
+    with yt_dlp.YoutubeDL({'quiet': True, 'cookiefile': cookiefile}) as ydl:
+        ydl.cookiejar
+
+
+def pooled_ydl(cookiefile):
+    with app.pooled_youtube_dl({'quiet': True, 'cookiefile': cookiefile}) as ydl:
+        ydl.cookiejar
+
+
+def reload_jar(cookiefile):
+    app.request_cookie_reload()
+    app.get_cookie_jar(cookiefile)
+
+
+def bench(count, requests):
+    cookiefile = os.path.join(BENCH_DIR, f'cookies-{count}.txt')
+    write_cookie_file(cookiefile, count)
+    app.get_cookie_jar(cookiefile)
+
+    return {
+        'parse': measure(lambda: app.parse_cookie_file(cookiefile), requests),
+        'fresh_ydl': measure(lambda: fresh_ydl(cookiefile), requests),
+        'shared': measure(lambda: app.get_cookie_jar(cookiefile), requests),
+        'pooled': measure(lambda: pooled_ydl(cookiefile), requests),
+        'reload': measure(lambda: reload_jar(cookiefile), max(1, requests // 10)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cookies 加载开销基准测试')
+    parser.add_argument('--sizes', type=str, default='1000,5000,20000', help='cookies 条目数，逗号分隔 (默认: 1000,5000,20000)')
+    parser.add_argument('--requests', type=int, default=50, help='每种方式的请求次数 (默认: 50)')
+    parser.add_argument('--json', action='store_true', help='以 JSON 格式输出结果')
+    args = parser.parse_args()
+
+    try:
+        report = {int(size): bench(int(size), args.requests) for size in args.sizes.split(',')}
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f'每种方式请求数: {args.requests}')
+    print(f'{"cookies":>8}  {"方式":<10}{"平均 ms":>10}{"中位 ms":>10}{"最大 ms":>10}')
+    for size, modes in report.items():
+        for mode, r in modes.items():
+            print(f'{size:>8}  {mode:<10}{r["mean_ms"]:>10.3f}{r["p50_ms"]:>10.3f}{r["max_ms"]:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
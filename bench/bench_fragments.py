@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+分片并发下载基准测试：yt-dlp 默认参数 vs app.py 的下载调优参数
+
+在本地媒体替身服务器（bench/media_server.py）上分别下载单文件、HLS 和 DASH 格式，
+替身服务器为每个请求增加延迟并限制单连接带宽，模拟真实源站。
+
+用法:
+    python3 bench/bench_fragments.py [--size-mb 20] [--segments 40] [--latency 0.05] [--bandwidth-mbps 40] [--active 1]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+BENCH_DIR = tempfile.mkdtemp(prefix='bench-fragments-')
+os.environ['CACHE_DIR'] = BENCH_DIR
+BENCH_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_ROOT, '..', 'app'))
+sys.path.insert(0, BENCH_ROOT)
+
+import yt_dlp  # noqa: E402
+import app  # noqa: E402
+from media_server import start_server  # noqa: E402
+
+MEDIA_PATHS = {
+    'progressive': '/progressive.mp4',
+    'hls': '/hls/index.m3u8',
+    'dash': '/dash/manifest.mpd',
+}
+
+
+def download(url, tuned, active):
+    """下载一次，返回 (耗时, 格式类型, 使用的参数)"""
+    out_dir = tempfile.mkdtemp(dir=BENCH_DIR)
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'outtmpl': os.path.join(out_dir, '%(id)s.%(ext)s'),
+        'format': app.get_format_selector(),
+        'noprogress': True,
+        'fixup': 'never',
+    }
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            start = time.perf_counter()
+            info = ydl.extract_info(url, download=False)
+            format_type, params = app.get_download_profile(info, active_downloads=active)
+            if tuned:
+                ydl.params.update(params)
+            else:
+                params = {'concurrent_fragment_downloads': 1, 'http_chunk_size': None}
+            ydl.process_ie_result(info, download=True)
+            return time.perf_counter() - start, format_type, params
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='分片并发下载基准测试')
+    parser.add_argument('--size-mb', type=float, default=20, help='合成媒体大小 MB (默认: 20)')
+    parser.add_argument('--segments', type=int, default=40, help='分片数 (默认: 40)')
+    parser.add_argument('--latency', type=float, default=0.05, help='每个请求的延迟秒数 (默认: 0.05)')
+    parser.add_argument('--bandwidth-mbps', type=float, default=40, help='单连接带宽上限 Mbps (默认: 40)')
+    parser.add_argument('--active', type=int, default=1, help='假定同时进行的下载任务数 (默认: 1)')
+    parser.add_argument('--json', action='store_true', help='以 JSON 格式输出结果')
+    args = parser.parse_args()
+
+    server, base_url = start_server(0, args.size_mb, args.segments, args.latency, args.bandwidth_mbps)
+    size = args.size_mb * 1024 * 1024
+    report = {}
+    try:
+        for name, path in MEDIA_PATHS.items():
+            baseline, format_type, _ = download(base_url + path, False, args.active)
+            tuned, _, params = download(base_url + path, True, args.active)
+            report[name] = {
+                'format_type': format_type,
+                'baseline_seconds': baseline,
+                'tuned_seconds': tuned,
+                'baseline_mbps': size * 8 / baseline / 1e6,
+                'tuned_mbps': size * 8 / tuned / 1e6,
+                'tuned_params': params,
+            }
+    finally:
+        server.shutdown()
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f'媒体: {args.size_mb} MB / {args.segments} 分片, 延迟: {args.latency}s, '
+          f'单连接带宽: {args.bandwidth_mbps} Mbps, 同时下载: {args.active}')
+    print(f'{"格式":<12}{"默认 s":>10}{"调优 s":>10}{"默认 Mbps":>12}{"调优 Mbps":>12}  参数')
+    for name, r in report.items():
+        print(f'{name:<12}{r["baseline_seconds"]:>10.2f}{r["tuned_seconds"]:>10.2f}'
+              f'{r["baseline_mbps"]:>12.1f}{r["tuned_mbps"]:>12.1f}  {r["tuned_params"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+代理池基准测试：按健康度加权选择 vs 均匀随机选择，以及下载途中代理变慢时的换代理续传
+
+使用本地媒体替身服务器和三个代理替身：
+  fast     延迟 0.05s
+  slow     延迟 0.8s（远端代理）
+  limited  所有请求返回 429（被 YouTube 限流）
+1. 路由：依次提取 --requests 次视频信息，比较两种选择方式的平均 / p95 耗时和失败重试次数
+   （两种方式都会在 429 后换代理重试，区别在于是否按健康度和冷却期选择）
+2. 换代理续传：下载 --size-mb 的文件，第一个代理转发 --degrade-after-mb 后降到 16 KB/s，
+   比较换代理（PROXY_MAX_FAILOVERS=2）和不换代理（0，最多等待 --timeout 秒）的完成时间
+
+用法:
+    python3 bench/bench_proxy_pool.py [--requests 60] [--size-mb 20] [--degrade-after-mb 5] [--timeout 60]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+
+BENCH_DIR = tempfile.mkdtemp(prefix='bench-proxy-pool-')
+os.environ['CACHE_DIR'] = BENCH_DIR
+os.environ['TASK_IDLE_TIMEOUT'] = '0'
+os.environ['WARM_UP'] = '0'
+os.environ['PROXY_SLOW_TIME'] = '5'
+BENCH_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_ROOT, '..', 'app'))
+sys.path.insert(0, BENCH_ROOT)
+
+import app  # noqa: E402
+from media_server import start_server  # noqa: E402
+from proxy_server import start_proxy  # noqa: E402
+
+app.logger.setLevel(logging.ERROR)
+
+
+def reset_proxy_stats():
+    app.get_db().execute('DELETE FROM proxy_stats')
+    app.get_db().execute('DELETE FROM tasks')
+    app.get_db().execute('DELETE FROM artifacts')
+
+
+def run_routing(mode, proxies, media_url, requests):
+    """依次提取视频信息，返回耗时统计和各代理收到的请求数"""
+    reset_proxy_stats()
+    app.PROXY_POOL = [url for _, (_, url) in proxies.items()]
+    weights = app.get_proxy_weights
+    if mode == 'uniform':
+        app.get_proxy_weights = lambda candidates, all_stats, now: [1] * len(candidates)
+    before = {name: server.stand_in.stats['requests'] for name, (server, _) in proxies.items()}
+
+    samples = []
+    failed = 0
+    try:
+        for i in range(requests):
+            started = time.perf_counter()
+            try:
+                app.extract_video_info(f'{media_url}/progressive.mp4?mode={mode}&n={i}')
+            except Exception:
+                failed += 1
+            samples.append(time.perf_counter() - started)
+    finally:
+        app.get_proxy_weights = weights
+
+    report = app.get_proxy_report()['proxies']
+    return {
+        'mean_s': statistics.mean(samples),
+        'p95_s': sorted(samples)[int(len(samples) * 0.95) - 1],
+        'retries': sum(p['blocked'] + p['network'] for p in report),
+        'failed': failed,
+        'requests': {name: server.stand_in.stats['requests'] - before[name] for name, (server, _) in proxies.items()},
+    }
+
+
+def run_failover(max_failovers, media_url, degrade_after_mb, timeout, run):
+    """下载一个文件：第一个代理中途降速，返回完成耗时（超时则返回 None）和各代理转发的字节数"""
+    reset_proxy_stats()
+    degrading, degrading_url = start_proxy(0, degrade_after_mb=degrade_after_mb, degraded_kbps=16)
+    healthy, healthy_url = start_proxy(0)
+    app.PROXY_POOL = [degrading_url, healthy_url]
+    app.PROXY_MAX_FAILOVERS = max_failovers
+    # 让第一次选中会降速的代理：健康的代理先处于冷却期（只剩它一个候选时仍会被选中）
+    app.record_proxy_result(healthy_url, 'network', error='bench')
+
+    started = time.perf_counter()
+    task_id, _ = app.create_download_task(f'{media_url}/progressive.mp4?failover={run}')
+    elapsed = None
+    task = {}
+    while time.perf_counter() - started < timeout:
+        task = app.load_task(task_id) or {}
+        if task.get('status') in ('completed', 'failed'):
+            if task['status'] == 'failed':
+                raise RuntimeError(f'下载失败: {task.get("error")}')
+            elapsed = time.perf_counter() - started
+            break
+        time.sleep(0.1)
+    else:
+        app.cancel_task(task_id, 'bench')
+
+    result = {
+        'elapsed_s': elapsed,
+        'downloaded_mb': (task.get('filesize') or task.get('downloaded_bytes') or 0) / 1024 / 1024,
+        'degrading_mb': degrading.stand_in.stats['bytes'] / 1024 / 1024,
+        'healthy_mb': healthy.stand_in.stats['bytes'] / 1024 / 1024,
+    }
+    degrading.shutdown()
+    healthy.shutdown()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='代理池基准测试')
+    parser.add_argument('--requests', type=int, default=60, help='路由测试的提取次数 (默认: 60)')
+    parser.add_argument('--size-mb', type=float, default=20, help='换代理测试的文件大小 MB (默认: 20)')
+    parser.add_argument('--degrade-after-mb', type=float, default=5, help='第一个代理转发多少 MB 后降速 (默认: 5)')
+    parser.add_argument('--timeout', type=float, default=60, help='不换代理时最多等待的秒数 (默认: 60)')
+    parser.add_argument('--json', action='store_true', help='以 JSON 格式输出结果')
+    args = parser.parse_args()
+
+    media_server, media_url = start_server(0, args.size_mb, 10)
+    proxies = {
+        'fast': start_proxy(0, latency=0.05),
+        'slow': start_proxy(0, latency=0.8),
+        'limited': start_proxy(0, status=429),
+    }
+
+    app.init_worker()
+    report = {'routing': {}, 'failover': {}}
+    try:
+        for mode in ('uniform', 'scored'):
+            report['routing'][mode] = run_routing(mode, proxies, media_url, args.requests)
+        for run, (name, max_failovers) in enumerate((('off', 0), ('on', 2))):
+            report['failover'][name] = run_failover(max_failovers, media_url, args.degrade_after_mb, args.timeout, run)
+    finally:
+        media_server.shutdown()
+        for server, _ in proxies.values():
+            server.shutdown()
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f'路由: {args.requests} 次信息提取，代理 fast / slow / limited(429)')
+    print(f'{"选择方式":<10}{"平均 s":>8}{"p95 s":>8}{"重试":>6}{"失败":>6}  各代理请求数')
+    for mode, r in report['routing'].items():
+        shares = ', '.join(f'{name} {count}' for name, count in r['requests'].items())
+        print(f'{mode:<10}{r["mean_s"]:>8.3f}{r["p95_s"]:>8.3f}{r["retries"]:>6}{r["failed"]:>6}  {shares}')
+
+    print(f'\n换代理续传: {args.size_mb} MB，第一个代理转发 {args.degrade_after_mb} MB 后降到 16 KB/s')
+    print(f'{"换代理":<8}{"完成 s":>10}{"已下载 MB":>12}{"降速代理 MB":>14}{"健康代理 MB":>14}')
+    for name, r in report['failover'].items():
+        elapsed = f'{r["elapsed_s"]:.1f}' if r['elapsed_s'] is not None else f'>{args.timeout:.0f}'
+        print(f'{name:<8}{elapsed:>10}{r["downloaded_mb"]:>12.1f}{r["degrading_mb"]:>14.1f}{r["healthy_mb"]:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+服务整体基准测试：在本地媒体替身服务器（bench/media_server.py）上运行完整的 app.py 服务，
+不需要访问网络或 YouTube，yt-dlp 通过通用提取器解析合成的单文件 / HLS 媒体。
+
+按 1/10/100 个并发分别测量:
+  - info_cold / info_warm：/api/info 未命中 / 命中缓存
+  - download_progressive / download_hls：/api/start-download + 轮询 /api/progress + /api/file 完整流程
+  - task_store：任务注册表 save / update / load
+  - cleanup：清理进程清理到期任务（含删除文件）的单轮耗时
+
+每个 URL 带上不同的查询参数，避免命中视频信息缓存和下载产物复用（info_warm 除外）。
+结果可以写入 JSON 文件，并与之前的结果比较，吞吐下降或 p95 延迟上升超过阈值时以非 0 退出。
+
+用法:
+    python3 bench/bench_service.py [--concurrency 1,10,100] [--size-mb 2] [--server wsgi] \
+        [--output results.json] [--baseline old.json --tolerance 0.2]
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import logging
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# 在导入 app 之前指定独立的缓存目录，避免污染真实数据
+BENCH_DIR = tempfile.mkdtemp(prefix='bench-service-')
+STORE_DIR = os.path.join(BENCH_DIR, 'store')
+os.makedirs(STORE_DIR)
+os.environ['CACHE_DIR'] = STORE_DIR
+BENCH_ROOT = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_ROOT, '..', 'app')
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, BENCH_ROOT)
+
+# 先占住清理锁，本进程导入的 app 不会成为清理进程，清理由基准测试自己执行并计时
+_janitor_lock = open(os.path.join(STORE_DIR, 'janitor.lock'), 'a+')
+fcntl.flock(_janitor_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+import app  # noqa: E402
+from media_server import start_server  # noqa: E402
+
+app.logger.setLevel(logging.WARNING)
+
+MEDIA_PATHS = {
+    'progressive': '/progressive.mp4',
+    'hls': '/hls/index.m3u8',
+}
+
+# 比较结果时参与判断的指标: (名称, 越大越好)
+COMPARED_FIELDS = (('throughput', True), ('p95_ms', False))
+
+
+def percentile(values, p):
+    """最近秩百分位数"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def summarize(scenario, concurrency, latencies, elapsed, errors, unit='req', extra=None):
+    """汇总一个场景的结果（延迟单位为毫秒）"""
+    result = {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'count': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 4),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'unit': f'{unit}/s',
+        'p50_ms': None,
+        'p95_ms': None,
+        'p99_ms': None,
+        'max_ms': None,
+    }
+    if latencies:
+        result.update({
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'max_ms': round(max(latencies) * 1000, 2),
+        })
+    result.update(extra or {})
+    return result
+
+
+def run_concurrent(concurrency, rounds, fn):
+    """concurrency 个线程各执行 rounds 次 fn(线程号, 轮次)，返回 (成功耗时列表, 总耗时, 错误数, 返回值列表)"""
+    latencies, values = [], []
+    errors = 0
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency)
+
+    def worker(index):
+        nonlocal errors
+        barrier.wait()
+        for round_index in range(rounds):
+            started = time.perf_counter()
+            try:
+                value = fn(index, round_index)
+            except Exception:
+                with lock:
+                    errors += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                values.append(value)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        started = time.perf_counter()
+        list(pool.map(worker, range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, elapsed, errors, values
+
+
+# ================ 被测服务 ================
+
+def find_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_service(args, cache_dir, max_tasks):
+    """以子进程方式启动 app.py（与 entrypoint.sh 相同的 gunicorn / uvicorn 配置），返回 (进程, 地址)"""
+    port = find_free_port()
+    if args.server == 'asgi':
+        cmd = [sys.executable, '-m', 'uvicorn', 'app:asgi_app', '--host', '127.0.0.1', '--port', str(port),
+               '--workers', str(args.workers), '--log-level', 'warning']
+    else:
+        cmd = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(args.workers),
+               '--worker-class', 'gthread', '--threads', str(args.threads), '--timeout', '600', 'app:app']
+
+    env = dict(os.environ, CACHE_DIR=cache_dir, MAX_QUEUED_DOWNLOADS=str(max_tasks))
+    if args.max_downloads:
+        env['MAX_CONCURRENT_DOWNLOADS'] = str(args.max_downloads)
+    log = open(os.path.join(BENCH_DIR, 'service.log'), 'wb')
+    proc = subprocess.Popen(cmd, cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            with open(log.name, 'rb') as f:
+                raise RuntimeError(f'服务启动失败:\n{f.read()[-2000:].decode("utf-8", "replace")}')
+        try:
+            http_request(base_url + '/health')
+            return proc, base_url
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('等待服务启动超时')
+
+
+def http_request(url, body=None, timeout=600):
+    """发送请求，返回 (状态码, 响应体)；JSON 请求体自动编码"""
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'} if data else {})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def request_json(url, body=None):
+    status, data = http_request(url, body)
+    if status != 200:
+        raise RuntimeError(f'{url} 返回 {status}: {data[:200]!r}')
+    return json.loads(data)
+
+
+# ================ 场景 ================
+
+def bench_info(base_url, media_url, concurrency, rounds, warm):
+    """并发请求 /api/info；warm 时所有请求使用同一个已缓存的 URL"""
+    if warm:
+        request_json(base_url + '/api/info', {'url': f'{media_url}?warm={concurrency}'})
+
+    def fetch(index, round_index):
+        query = f'warm={concurrency}' if warm else f'cold={concurrency}-{index}-{round_index}'
+        request_json(base_url + '/api/info', {'url': f'{media_url}?{query}'})
+
+    latencies, elapsed, errors, _ = run_concurrent(concurrency, rounds, fetch)
+    return summarize('info_warm' if warm else 'info_cold', concurrency, latencies, elapsed, errors)
+
+
+def bench_download(base_url, name, media_url, concurrency, rounds, poll_interval):
+    """并发执行完整的下载流程，分别统计提交、等待完成和取文件的耗时"""
+    phases = {'start': [], 'wait': [], 'fetch': []}
+    lock = threading.Lock()
+
+    def download(index, round_index):
+        started = time.perf_counter()
+        task = request_json(base_url + '/api/start-download',
+                            {'url': f'{media_url}?task={concurrency}-{index}-{round_index}'})
+        submitted = time.perf_counter()
+
+        while True:
+            progress = request_json(f'{base_url}/api/progress/{task["task_id"]}')
+            if progress['status'] == 'completed':
+                break
+            if progress['status'] in ('failed', 'expired'):
+                raise RuntimeError(progress.get('error'))
+            time.sleep(poll_interval)
+        completed = time.perf_counter()
+
+        status, data = http_request(f'{base_url}/api/file/{task["task_id"]}')
+        if status != 200:
+            raise RuntimeError(f'/api/file 返回 {status}')
+        finished = time.perf_counter()
+
+        with lock:
+            phases['start'].append(submitted - started)
+            phases['wait'].append(completed - submitted)
+            phases['fetch'].append(finished - completed)
+        return len(data)
+
+    latencies, elapsed, errors, sizes = run_concurrent(concurrency, rounds, download)
+    extra = {f'{phase}_p95_ms': round(percentile(values, 95) * 1000, 2) if values else None
+             for phase, values in phases.items()}
+    extra['mb_per_sec'] = round(sum(sizes) / elapsed / 1024 / 1024, 2) if elapsed else None
+    return summarize(f'download_{name}', concurrency, latencies, elapsed, errors, 'task', extra)
+
+
+def new_task(i, expired=False):
+    now = time.time()
+    return {
+        'status': 'completed' if expired else 'downloading',
+        'progress': 0,
+        'created_at': now,
+        'downloaded_at': now - app.FILE_EXPIRE_TIME - 1 if expired else None,
+        'download_count': 0,
+        'filepath': None,
+        'temp_dir': None,
+    }
+
+
+def bench_task_store(concurrency, ops):
+    """并发执行任务注册表操作：每个线程 save 一次，update 和 load 各 ops 次"""
+    results = []
+    prefix = f'store-{concurrency}'
+    for op in ('save', 'update', 'load'):
+        rounds = 1 if op == 'save' else ops
+
+        def run(index, round_index):
+            task_id = f'{prefix}-{index}'
+            if op == 'save':
+                app.save_task(task_id, new_task(index))
+            elif op == 'update':
+                app.update_task(task_id, {'progress': round_index, 'downloaded_bytes': round_index * 1024})
+            else:
+                app.load_task(task_id)
+
+        latencies, elapsed, errors, _ = run_concurrent(concurrency, rounds, run)
+        results.append(summarize(f'task_store_{op}', concurrency, latencies, elapsed, errors, 'op'))
+    return results
+
+
+def bench_cleanup(tasks, file_size):
+    """清理 tasks 个到期任务（每个任务带一个临时目录和文件），测量单轮清理耗时"""
+    payload = b'\0' * file_size
+    for i in range(tasks):
+        temp_dir = tempfile.mkdtemp(dir=STORE_DIR)
+        filepath = os.path.join(temp_dir, 'video.mp4')
+        with open(filepath, 'wb') as f:
+            f.write(payload)
+        task = new_task(i, expired=True)
+        task.update(filepath=filepath, temp_dir=temp_dir)
+        app.save_task(f'cleanup-{tasks}-{i}', task)
+
+    started = time.perf_counter()
+    now = time.time()
+    expired = app.get_expired_task_ids(now)
+    for task_id in expired:
+        app.expire_task(task_id, now)
+    elapsed = time.perf_counter() - started
+
+    result = summarize('cleanup', tasks, [elapsed], elapsed, tasks - len(expired), 'pass')
+    result['per_task_ms'] = round(elapsed / tasks * 1000, 3) if tasks else None
+    return result
+
+
+# ================ 比较 ================
+
+def result_key(result):
+    return result['scenario'], result['concurrency']
+
+
+def compare(results, baseline, tolerance):
+    """与之前的结果比较，返回回退项列表"""
+    previous = {result_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if not old:
+            continue
+        for field, higher_is_better in COMPARED_FIELDS:
+            new_value, old_value = result.get(field), old.get(field)
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append({
+                    'scenario': result['scenario'],
+                    'concurrency': result['concurrency'],
+                    'field': field,
+                    'baseline': old_value,
+                    'current': new_value,
+                    'change': round(change, 4),
+                })
+    return regressions
+
+
+def print_results(results):
+    print(f'{"场景":<24}{"并发":>6}{"次数":>7}{"错误":>6}{"吞吐":>12}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for r in results:
+        throughput = f'{r["throughput"]:.1f}' if r['throughput'] is not None else '-'
+        p50, p95, p99 = (f'{r[k]:.1f}' if r[k] is not None else '-' for k in ('p50_ms', 'p95_ms', 'p99_ms'))
+        print(f'{r["scenario"]:<24}{r["concurrency"]:>6}{r["count"]:>7}{r["errors"]:>6}'
+              f'{throughput:>12}{p50:>10}{p95:>10}{p99:>10}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='服务整体基准测试（离线，使用本地媒体替身服务器）')
+    parser.add_argument('--concurrency', type=str, default='1,10,100', help='并发级别，逗号分隔 (默认: 1,10,100)')
+    parser.add_argument('--scenarios', type=str, default='info,download,task_store,cleanup',
+                        help='要运行的场景，逗号分隔 (默认: info,download,task_store,cleanup)')
+    parser.add_argument('--rounds', type=int, default=3, help='/api/info 每个并发连接的请求次数 (默认: 3)')
+    parser.add_argument('--download-rounds', type=int, default=1, help='每个并发连接的下载次数 (默认: 1)')
+    parser.add_argument('--store-ops', type=int, default=20, help='任务注册表每个线程的 update/load 次数 (默认: 20)')
+    parser.add_argument('--size-mb', type=float, default=2, help='合成媒体大小 MB (默认: 2)')
+    parser.add_argument('--segments', type=int, default=10, help='HLS 分片数 (默认: 10)')
+    parser.add_argument('--latency', type=float, default=0.0, help='替身服务器每个请求的延迟秒数 (默认: 0)')
+    parser.add_argument('--bandwidth-mbps', type=float, default=0, help='替身服务器单连接带宽上限 Mbps，0 表示不限 (默认: 0)')
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='wsgi', help='服务运行模式 (默认: wsgi)')
+    parser.add_argument('--workers', type=int, default=2, help='worker 进程数 (默认: 2)')
+    parser.add_argument('--threads', type=int, default=16, help='wsgi 模式每个 worker 的线程数 (默认: 16)')
+    parser.add_argument('--max-downloads', type=int, default=0,
+                        help='MAX_CONCURRENT_DOWNLOADS，0 表示使用服务默认值 (默认: 0)')
+    parser.add_argument('--poll-interval', type=float, default=0.2, help='轮询进度的间隔秒数 (默认: 0.2)')
+    parser.add_argument('--output', type=str, default=None, help='把结果写入 JSON 文件')
+    parser.add_argument('--baseline', type=str, default=None, help='与之前的 JSON 结果比较，出现回退时以 1 退出')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允许的相对变化 (默认: 0.2)')
+    parser.add_argument('--json', action='store_true', help='以 JSON 格式输出结果')
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(',')]
+    scenarios = set(args.scenarios.split(','))
+    results = []
+
+    media_server, media_base = start_server(0, args.size_mb, args.segments, args.latency, args.bandwidth_mbps)
+    service = None
+    try:
+        if scenarios & {'info', 'download'}:
+            max_tasks = max(levels) * max(args.rounds, args.download_rounds)
+            service, base_url = start_service(args, os.path.join(BENCH_DIR, 'service'), max_tasks)
+            for level in levels:
+                if 'info' in scenarios:
+                    progressive_url = media_base + MEDIA_PATHS['progressive']
+                    results.append(bench_info(base_url, progressive_url, level, args.rounds, warm=False))
+                    results.append(bench_info(base_url, progressive_url, level, args.rounds, warm=True))
+                if 'download' in scenarios:
+                    for name, path in MEDIA_PATHS.items():
+                        results.append(bench_download(base_url, name, media_base + path, level,
+                                                      args.download_rounds, args.poll_interval))
+
+        for level in levels:
+            if 'task_store' in scenarios:
+                results.extend(bench_task_store(level, args.store_ops))
+            if 'cleanup' in scenarios:
+                results.append(bench_cleanup(level, int(args.size_mb * 1024 * 1024)))
+    finally:
+        if service:
+            service.terminate()
+            service.wait(timeout=30)
+        media_server.shutdown()
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        report['regressions'] = regressions
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        print(f'媒体: {args.size_mb} MB, 服务: {args.server} x {args.workers}, 并发: {args.concurrency}')
+        print_results(results)
+        for r in regressions:
+            print(f'回退: {r["scenario"]} 并发 {r["concurrency"]} {r["field"]} '
+                  f'{r["baseline"]} -> {r["current"]} ({r["change"]:+.1%})')
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
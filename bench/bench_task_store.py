@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+任务存储基准测试：SQLite 任务注册表 vs 旧的 JSON 文件 + flock 存储
+
+模拟下载过程中的典型访问模式：
+  - save：创建任务
+  - update：进度回调更新字段
+  - load：/api/progress 轮询读取
+  - scan：清理线程查找过期任务
+
+用法:
+    python3 bench/bench_task_store.py [--tasks 300] [--updates 20] [--threads 8]
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import argparse
+import tempfile
+import threading
+
+# 在导入 app 之前指定独立的缓存目录，避免污染真实数据
+BENCH_DIR = tempfile.mkdtemp(prefix='bench-task-store-')
+os.environ['CACHE_DIR'] = BENCH_DIR
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import app  # noqa: E402
+
+
+class FileTaskStore:
+    """旧版实现：每个任务一个 JSON 文件，每次操作都打开锁文件加 flock"""
+
+    def __init__(self, root):
+        self.tasks_dir = os.path.join(root, 'tasks')
+        self.locks_dir = os.path.join(root, 'locks')
+        os.makedirs(self.tasks_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+
+    def _paths(self, task_id):
+        return (os.path.join(self.tasks_dir, f'{task_id}.json'),
+                os.path.join(self.locks_dir, f'{task_id}.lock'))
+
+    def save(self, task_id, task_data):
+        task_file, lock_file = self._paths(task_id)
+        with open(lock_file, 'w') as lf:
+            fcntl.flock(lf.fileno(), fcntl.LOCK_EX)
+            try:
+                with open(task_file, 'w', encoding='utf-8') as f:
+                    json.dump(task_data, f, ensure_ascii=False)
+            finally:
+                fcntl.flock(lf.fileno(), fcntl.LOCK_UN)
+
+    def load(self, task_id):
+        task_file, lock_file = self._paths(task_id)
+        if not os.path.exists(task_file):
+            return None
+        with open(lock_file, 'w') as lf:
+            fcntl.flock(lf.fileno(), fcntl.LOCK_SH)
+            try:
+                with open(task_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            finally:
+                fcntl.flock(lf.fileno(), fcntl.LOCK_UN)
+
+    def update(self, task_id, updates):
+        task_file, lock_file = self._paths(task_id)
+        with open(lock_file, 'w') as lf:
+            fcntl.flock(lf.fileno(), fcntl.LOCK_EX)
+            try:
+                task_data = {}
+                if os.path.exists(task_file):
+                    with open(task_file, 'r', encoding='utf-8') as f:
+                        task_data = json.load(f)
+                task_data.update(updates)
+                with open(task_file, 'w', encoding='utf-8') as f:
+                    json.dump(task_data, f, ensure_ascii=False)
+            finally:
+                fcntl.flock(lf.fileno(), fcntl.LOCK_UN)
+
+    def scan_expired(self, now):
+        expired = []
+        for name in os.listdir(self.tasks_dir):
+            if not name.endswith('.json'):
+                continue
+            task = self.load(name[:-5])
+            if task and app.get_task_expires_at(task) is not None and app.get_task_expires_at(task) <= now:
+                expired.append(name[:-5])
+        return expired
+
+
+class SqliteTaskStore:
+    """新版实现：直接调用 app.py 中的任务注册表函数"""
+
+    save = staticmethod(app.save_task)
+    load = staticmethod(app.load_task)
+    update = staticmethod(app.update_task)
+
+    @staticmethod
+    def scan_expired(now):
+        return app.get_expired_task_ids(now)
+
+
+def new_task(i):
+    now = time.time()
+    return {
+        'status': 'completed' if i % 3 == 0 else 'downloading',
+        'progress': 0,
+        'downloaded_bytes': 0,
+        'total_bytes': 0,
+        'speed': 0,
+        'eta': 0,
+        'filename': None,
+        'filepath': None,
+        'error': None,
+        'created_at': now,
+        'downloaded_at': now - app.FILE_EXPIRE_TIME - 1 if i % 3 == 0 else None,
+        'download_count': 0,
+        'temp_dir': None,
+    }
+
+
+def run_threads(n_threads, items, fn):
+    """把 items 平均分给 n_threads 个线程执行 fn，返回耗时"""
+    chunks = [items[i::n_threads] for i in range(n_threads)]
+
+    def worker(chunk):
+        for item in chunk:
+            fn(item)
+
+    threads = [threading.Thread(target=worker, args=(c,)) for c in chunks]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def bench(name, store, args):
+    task_ids = [f'{name}-{i}' for i in range(args.tasks)]
+    results = {}
+
+    elapsed = run_threads(args.threads, list(enumerate(task_ids)), lambda it: store.save(it[1], new_task(it[0])))
+    results['save'] = (args.tasks, elapsed)
+
+    updates = [(tid, j) for j in range(args.updates) for tid in task_ids]
+    elapsed = run_threads(args.threads, updates, lambda it: store.update(it[0], {
+        'progress': it[1], 'downloaded_bytes': it[1] * 1024, 'speed': 1024, 'eta': 10,
+    }))
+    results['update'] = (len(updates), elapsed)
+
+    loads = task_ids * args.updates
+    elapsed = run_threads(args.threads, loads, store.load)
+    results['load'] = (len(loads), elapsed)
+
+    start = time.perf_counter()
+    for _ in range(10):
+        store.scan_expired(time.time())
+    results['scan'] = (10, time.perf_counter() - start)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='任务存储基准测试')
+    parser.add_argument('--tasks', type=int, default=300, help='任务数量 (默认: 300)')
+    parser.add_argument('--updates', type=int, default=20, help='每个任务的更新次数 (默认: 20)')
+    parser.add_argument('--threads', type=int, default=8, help='并发线程数 (默认: 8)')
+    parser.add_argument('--json', action='store_true', help='以 JSON 格式输出结果')
+    args = parser.parse_args()
+
+    try:
+        report = {
+            'file': bench('file', FileTaskStore(os.path.join(BENCH_DIR, 'legacy')), args),
+            'sqlite': bench('sqlite', SqliteTaskStore, args),
+        }
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({
+            store: {op: {'ops': n, 'seconds': t, 'ops_per_sec': n / t if t else None}
+                    for op, (n, t) in ops.items()}
+            for store, ops in report.items()
+        }, indent=2))
+        return
+
+    print(f'任务数: {args.tasks}, 每任务更新: {args.updates}, 线程: {args.threads}')
+    print(f'{"操作":<8}{"file ops/s":>14}{"sqlite ops/s":>16}{"提升":>10}')
+    for op in ('save', 'update', 'load', 'scan'):
+        fn, ft = report['file'][op]
+        sn, st = report['sqlite'][op]
+        file_rate = fn / ft if ft else float('inf')
+        sqlite_rate = sn / st if st else float('inf')
+        print(f'{op:<8}{file_rate:>14.0f}{sqlite_rate:>16.0f}{sqlite_rate / file_rate:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+YoutubeDL 初始化开销基准测试：每次新建实例 vs 实例池
+
+每次请求的准备工作包括：创建 YoutubeDL、解析 cookies 文件、建立网络请求栈。
+可选地对本地 HTTP 地址执行一次完整的 extract_info（通用提取器，不访问外网）。
+
+用法:
+    python3 bench/bench_ydl_pool.py [--requests 50] [--cookies 2000] [--url http://127.0.0.1:8000/video.mp4]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+
+BENCH_DIR = tempfile.mkdtemp(prefix='bench-ydl-pool-')
+os.environ['CACHE_DIR'] = BENCH_DIR
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import yt_dlp  # noqa: E402
+import app  # noqa: E402
+
+
+def write_cookie_file(path, count):
+    """生成包含 count 条记录的 Netscape 格式 cookies 文件"""
+    expires = int(time.time()) + 86400 * 365
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('# Netscape HTTP Cookie File\n')
+        for i in range(count):
+            f.write(f'.example{i % 50}.com\tTRUE\t/\tTRUE\t{expires}\tcookie_{i}\t{"v" * 64}\n')
+
+
+def build_opts(cookiefile, request_index):
+    return {
+        'quiet': True,
+        'no_warnings': True,
+        'nocheckcertificate': True,
+        'cookiefile': cookiefile,
+        'outtmpl': os.path.join(BENCH_DIR, f'{request_index}', '%(title)s.%(ext)s'),
+        'format': app.get_format_selector(),
+    }
+
+
+def prepare(ydl, url):
+    """触发 cookies 解析和网络栈初始化；提供 url 时执行一次完整提取"""
+    ydl.cookiejar
+    ydl._request_director
+    if url:
+        ydl.extract_info(url, download=False)
+
+
+def run(name, factory, args, cookiefile):
+    samples = []
+    for i in range(args.requests):
+        start = time.perf_counter()
+        with factory(build_opts(cookiefile, i)) as ydl:
+            prepare(ydl, args.url)
+        samples.append(time.perf_counter() - start)
+    return {
+        'requests': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'p50_ms': statistics.median(samples) * 1000,
+        'max_ms': max(samples) * 1000,
+        'first_ms': samples[0] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='YoutubeDL 初始化开销基准测试')
+    parser.add_argument('--requests', type=int, default=50, help='请求次数 (默认: 50)')
+    parser.add_argument('--cookies', type=int, default=2000, help='cookies 条目数 (默认: 2000)')
+    parser.add_argument('--url', type=str, default=None, help='可选：每次请求对该地址执行 extract_info')
+    parser.add_argument('--json', action='store_true', help='以 JSON 格式输出结果')
+    args = parser.parse_args()
+
+    cookiefile = os.path.join(BENCH_DIR, 'cookies.txt')
+    write_cookie_file(cookiefile, args.cookies)
+
+    try:
+        report = {
+            'fresh': run('fresh', yt_dlp.YoutubeDL, args, cookiefile),
+            'pooled': run('pooled', app.pooled_youtube_dl, args, cookiefile),
+        }
+        report['pool_stats'] = dict(app.YDL_POOL_STATS)
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f'请求数: {args.requests}, cookies: {args.cookies}, URL: {args.url or "无"}')
+    print(f'{"模式":<8}{"平均 ms":>10}{"中位 ms":>10}{"最大 ms":>10}{"首次 ms":>10}')
+    for mode in ('fresh', 'pooled'):
+        r = report[mode]
+        print(f'{mode:<8}{r["mean_ms"]:>10.2f}{r["p50_ms"]:>10.2f}{r["max_ms"]:>10.2f}{r["first_ms"]:>10.2f}')
+    print(f'实例池: {report["pool_stats"]}')
+
+
+if __name__ == '__main__':
+    main()
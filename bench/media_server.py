@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+本地媒体替身服务器：为基准测试提供不依赖外网的合成媒体
+
+提供三种形式的同一段合成数据，yt-dlp 的通用提取器可以直接识别：
+  /progressive.mp4   单文件（支持 Range）
+  /hls/index.m3u8    HLS 分片
+  /dash/manifest.mpd DASH 分片（SegmentList）
+  /dash/split.mpd    DASH 分离的视频流 + 音频流（需要合并的格式，音频为视频的 1/4 大小）
+
+可以为每个请求设置固定延迟（模拟网络往返）和单连接带宽上限（模拟源站限速），
+这正是分片并发下载能发挥作用的场景。
+
+用法:
+    python3 bench/media_server.py [--port 8900] [--size-mb 20] [--segments 40] [--latency 0.05] [--bandwidth-mbps 40]
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MediaStandIn:
+    """合成媒体数据和对应的 HLS / DASH 清单"""
+
+    def __init__(self, size_mb=20, segments=40, segment_duration=2):
+        self.data = os.urandom(int(size_mb * 1024 * 1024))
+        self.segment_count = segments
+        self.segment_duration = segment_duration
+        self.segment_size = -(-len(self.data) // segments)
+
+    def segment(self, index):
+        start = index * self.segment_size
+        return self.data[start:start + self.segment_size]
+
+    def audio_segment(self, index):
+        segment = self.segment(index)
+        return segment[:len(segment) // 4]
+
+    def hls_playlist(self):
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{self.segment_duration}',
+                 '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD']
+        for i in range(self.segment_count):
+            lines += [f'#EXTINF:{self.segment_duration:.1f},', f'seg-{i}.ts']
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def _segment_list(self, prefix):
+        segments = '\n'.join(f'          <SegmentURL media="{prefix}-{i}.m4s"/>' for i in range(self.segment_count))
+        return f'''        <SegmentList timescale="1" duration="{self.segment_duration}">
+          <Initialization sourceURL="init.mp4"/>
+{segments}
+        </SegmentList>'''
+
+    def dash_split_manifest(self):
+        duration = self.segment_count * self.segment_duration
+        return f'''<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" minBufferTime="PT2S"
+     mediaPresentationDuration="PT{duration}S" profiles="urn:mpeg:dash:profile:isoff-main:2011">
+  <Period>
+    <AdaptationSet mimeType="video/mp4" contentType="video" segmentAlignment="true">
+      <Representation id="1080p" bandwidth="4000000" width="1920" height="1080" codecs="avc1.640028">
+{self._segment_list('seg')}
+      </Representation>
+    </AdaptationSet>
+    <AdaptationSet mimeType="audio/mp4" contentType="audio" segmentAlignment="true">
+      <Representation id="audio" bandwidth="128000" codecs="mp4a.40.2">
+{self._segment_list('audio')}
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>
+'''
+
+    def dash_manifest(self):
+        duration = self.segment_count * self.segment_duration
+        return f'''<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" minBufferTime="PT2S"
+     mediaPresentationDuration="PT{duration}S" profiles="urn:mpeg:dash:profile:isoff-main:2011">
+  <Period>
+    <AdaptationSet mimeType="video/mp4" segmentAlignment="true">
+      <Representation id="720p" bandwidth="2000000" width="1280" height="720" codecs="avc1.4d401f,mp4a.40.2">
+{self._segment_list('seg')}
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>
+'''
+
+
+def make_handler(media, latency, bandwidth):
+    """生成请求处理类；bandwidth 为单连接字节/秒，0 表示不限速"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, body, content_type, status=200, extra_headers=None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Accept-Ranges', 'bytes')
+            for key, value in (extra_headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            if self.command == 'HEAD':
+                return
+
+            chunk = 64 * 1024
+            for offset in range(0, len(body), chunk):
+                started = time.perf_counter()
+                try:
+                    self.wfile.write(body[offset:offset + chunk])
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端只探测了开头就断开（通用提取器常这样做）
+                    self.close_connection = True
+                    return
+                if bandwidth:
+                    delay = len(body[offset:offset + chunk]) / bandwidth - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+
+            path = self.path.split('?')[0]
+            if path == '/progressive.mp4':
+                self.send_range(media.data, 'video/mp4')
+            elif path == '/hls/index.m3u8':
+                self.send_body(media.hls_playlist().encode(), 'application/vnd.apple.mpegurl')
+            elif path == '/dash/manifest.mpd':
+                self.send_body(media.dash_manifest().encode(), 'application/dash+xml')
+            elif path == '/dash/split.mpd':
+                self.send_body(media.dash_split_manifest().encode(), 'application/dash+xml')
+            elif path == '/dash/init.mp4':
+                self.send_body(b'\x00' * 1024, 'video/mp4')
+            else:
+                match = re.fullmatch(r'/(hls|dash)/(seg|audio)-(\d+)\.(ts|m4s)', path)
+                if match and int(match.group(3)) < media.segment_count:
+                    index = int(match.group(3))
+                    body = media.segment(index) if match.group(2) == 'seg' else media.audio_segment(index)
+                    self.send_body(body, 'video/mp2t')
+                else:
+                    self.send_body(b'not found', 'text/plain', status=404)
+
+        def send_range(self, data, content_type):
+            match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if not match:
+                self.send_body(data, content_type)
+                return
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            if start >= len(data):
+                self.send_body(b'', content_type, status=416, extra_headers={'Content-Range': f'bytes */{len(data)}'})
+                return
+            self.send_body(data[start:end + 1], content_type, status=206,
+                           extra_headers={'Content-Range': f'bytes {start}-{end}/{len(data)}'})
+
+    return Handler
+
+
+def start_server(port=0, size_mb=20, segments=40, latency=0.0, bandwidth_mbps=0.0):
+    """在后台线程启动替身服务器，返回 (server, base_url)"""
+    media = MediaStandIn(size_mb=size_mb, segments=segments)
+    handler = make_handler(media, latency, bandwidth_mbps * 1024 * 1024 / 8)
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地媒体替身服务器')
+    parser.add_argument('--port', type=int, default=8900, help='监听端口 (默认: 8900)')
+    parser.add_argument('--size-mb', type=float, default=20, help='合成媒体大小 MB (默认: 20)')
+    parser.add_argument('--segments', type=int, default=40, help='HLS/DASH 分片数 (默认: 40)')
+    parser.add_argument('--latency', type=float, default=0.05, help='每个请求的延迟秒数 (默认: 0.05)')
+    parser.add_argument('--bandwidth-mbps', type=float, default=40, help='单连接带宽上限 Mbps，0 表示不限 (默认: 40)')
+    args = parser.parse_args()
+
+    server, base_url = start_server(args.port, args.size_mb, args.segments, args.latency, args.bandwidth_mbps)
+    print(f'替身服务器已启动: {base_url}')
+    for path in ('/progressive.mp4', '/hls/index.m3u8', '/dash/manifest.mpd', '/dash/split.mpd'):
+        print(f'  {base_url}{path}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
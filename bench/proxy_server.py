@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+本地代理替身服务器：为代理池的测试和基准测试提供行为可控的 HTTP 代理
+
+转发 http:// 地址的请求（绝对 URI 形式，yt-dlp 经 HTTP 代理访问 http 地址时就是这样发送的），
+可以模拟各种“不健康”的代理：
+  --latency        每个请求先等待的秒数（模拟远端代理的往返延迟）
+  --bandwidth-mbps 单连接带宽上限
+  --status         对所有请求直接返回该状态码（如 429 模拟被 YouTube 限流，403 模拟被封禁）
+  --degrade-after-mb / --degraded-kbps  累计转发这么多数据后速度降到 degraded-kbps（模拟下载途中变慢）
+
+用法:
+    python3 bench/proxy_server.py [--port 8901] [--latency 0.2] [--status 429] [--degrade-after-mb 5 --degraded-kbps 32]
+"""
+
+import sys
+import time
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 不转发的逐跳头
+HOP_HEADERS = {'connection', 'keep-alive', 'proxy-connection', 'proxy-authorization', 'te', 'trailers',
+               'transfer-encoding', 'upgrade'}
+
+STATUS_MESSAGES = {403: b'Forbidden', 429: b'Too Many Requests'}
+
+
+class ProxyStandIn:
+    """代理的行为设置和统计（请求数、转发字节数）"""
+
+    def __init__(self, latency=0.0, bandwidth=0.0, status=None, degrade_after=None, degraded_bandwidth=0.0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.status = status
+        self.degrade_after = degrade_after
+        self.degraded_bandwidth = degraded_bandwidth
+        self.stats = {'requests': 0, 'bytes': 0}
+        self._lock = threading.Lock()
+
+    def add(self, key, amount):
+        with self._lock:
+            self.stats[key] += amount
+            return self.stats[key]
+
+    def current_bandwidth(self):
+        if self.degrade_after is not None and self.stats['bytes'] >= self.degrade_after:
+            return self.degraded_bandwidth
+        return self.bandwidth
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端复用连接后直接关闭很常见，不打印异常
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def make_handler(proxy):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def do_GET(self):
+            proxy.add('requests', 1)
+            if proxy.latency:
+                time.sleep(proxy.latency)
+
+            if proxy.status:
+                body = STATUS_MESSAGES.get(proxy.status, b'error')
+                self.send_response(proxy.status)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+                return
+
+            target = urlsplit(self.path)
+            if target.scheme != 'http':
+                self.send_error(400, '只支持转发 http:// 地址')
+                return
+
+            headers = {key: value for key, value in self.headers.items() if key.lower() not in HOP_HEADERS}
+            upstream = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=30)
+            try:
+                path = target.path + (f'?{target.query}' if target.query else '')
+                upstream.request(self.command, path or '/', headers=headers)
+                response = upstream.getresponse()
+
+                self.send_response(response.status)
+                for key, value in response.getheaders():
+                    if key.lower() not in HOP_HEADERS:
+                        self.send_header(key, value)
+                self.end_headers()
+                if self.command == 'HEAD':
+                    return
+
+                while True:
+                    bandwidth = proxy.current_bandwidth()
+                    # 降速后用小块发送，客户端能持续收到数据（而不是长时间没有任何数据）
+                    chunk = response.read(64 * 1024 if not bandwidth or bandwidth >= 1024 * 1024 else 8 * 1024)
+                    if not chunk:
+                        break
+                    started = time.perf_counter()
+                    try:
+                        self.wfile.write(chunk)
+                    except (BrokenPipeError, ConnectionResetError):
+                        self.close_connection = True
+                        return
+                    proxy.add('bytes', len(chunk))
+                    if bandwidth:
+                        delay = len(chunk) / bandwidth - (time.perf_counter() - started)
+                        if delay > 0:
+                            time.sleep(delay)
+            except OSError as e:
+                self.close_connection = True
+                if not self.wfile.closed:
+                    try:
+                        self.send_error(502, f'上游连接失败: {e}')
+                    except OSError:
+                        pass
+            finally:
+                upstream.close()
+
+    return Handler
+
+
+def start_proxy(port=0, latency=0.0, bandwidth_mbps=0.0, status=None, degrade_after_mb=None, degraded_kbps=32):
+    """在后台线程启动代理替身，返回 (server, proxy_url)；server.stand_in.stats 为统计"""
+    stand_in = ProxyStandIn(
+        latency=latency,
+        bandwidth=bandwidth_mbps * 1024 * 1024 / 8,
+        status=status,
+        degrade_after=int(degrade_after_mb * 1024 * 1024) if degrade_after_mb is not None else None,
+        degraded_bandwidth=degraded_kbps * 1024,
+    )
+    server = QuietHTTPServer(('127.0.0.1', port), make_handler(stand_in))
+    server.stand_in = stand_in
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地代理替身服务器')
+    parser.add_argument('--port', type=int, default=8901, help='监听端口 (默认: 8901)')
+    parser.add_argument('--latency', type=float, default=0, help='每个请求的延迟秒数 (默认: 0)')
+    parser.add_argument('--bandwidth-mbps', type=float, default=0, help='单连接带宽上限 Mbps，0 表示不限 (默认: 0)')
+    parser.add_argument('--status', type=int, default=None, help='对所有请求返回该状态码，如 403 / 429')
+    parser.add_argument('--degrade-after-mb', type=float, default=None, help='累计转发多少 MB 后降速')
+    parser.add_argument('--degraded-kbps', type=float, default=32, help='降速后的速度 KB/s (默认: 32)')
+    args = parser.parse_args()
+
+    server, proxy_url = start_proxy(args.port, args.latency, args.bandwidth_mbps, args.status,
+                                    args.degrade_after_mb, args.degraded_kbps)
+    print(f'代理替身已启动: {proxy_url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,13 +6,28 @@ PROJECT_DIR="$(dirname $(readlink -f $0))"
 KOYEB_APP_NAME="grateful-meghan"
 KOYEB_SERVICE_NAME="yt-dlp-cloudflare"
 
+# 热更新（可选）：设置 COOKIES_ADMIN_URL（如 https://your-app.koyeb.app/api/admin/cookies）和 ADMIN_TOKEN 后，
+# 先把 cookies 推送给运行中的服务，无需重新部署；加 --hot-only 时只热更新，不修改 Koyeb 环境变量
+# （服务重启后会恢复为环境变量 COOKIES_BASE64 中的 cookies）
+HOT_ONLY=false
+if [ "$1" = "--hot-only" ]; then
+    HOT_ONLY=true
+fi
+
 echo "================================================================================"
 echo "Koyeb Cookies 自动更新脚本"
 echo "================================================================================"
 echo ""
 
+if [ "$HOT_ONLY" = true ] && { [ -z "$COOKIES_ADMIN_URL" ] || [ -z "$ADMIN_TOKEN" ]; }; then
+    echo "❌ --hot-only 需要设置 COOKIES_ADMIN_URL 和 ADMIN_TOKEN"
+    exit 1
+fi
+
 # 检查 Koyeb CLI 是否安装
-if ! command -v koyeb &> /dev/null; then
+if [ "$HOT_ONLY" = true ]; then
+    :
+elif ! command -v koyeb &> /dev/null; then
     echo "❌ Koyeb CLI 未安装"
     echo ""
     echo "请先安装 Koyeb CLI:"
@@ -26,7 +41,7 @@ if ! command -v koyeb &> /dev/null; then
 fi
 
 # 检查是否已登录
-if ! koyeb service list --app "$KOYEB_APP_NAME" &> /dev/null; then
+if [ "$HOT_ONLY" = false ] && ! koyeb service list --app "$KOYEB_APP_NAME" &> /dev/null; then
     echo "❌ 未登录 Koyeb 或应用不存在"
     echo ""
     echo "请先登录:"
@@ -67,6 +82,32 @@ fi
 echo "✅ 成功导出 $COOKIE_COUNT 个 cookies"
 echo ""
 
+if [ -n "$COOKIES_ADMIN_URL" ] && [ -n "$ADMIN_TOKEN" ]; then
+    echo "🔥 热更新运行中的服务..."
+    if curl -fsS -X POST "$COOKIES_ADMIN_URL" \
+        -H "Authorization: Bearer $ADMIN_TOKEN" \
+        -H "Content-Type: text/plain" \
+        --data-binary @/tmp/cookies_new.txt; then
+        echo ""
+        echo "✅ 服务已加载新的 cookies"
+    else
+        echo "❌ 热更新失败"
+        if [ "$HOT_ONLY" = true ]; then
+            rm /tmp/cookies_new.txt
+            exit 1
+        fi
+    fi
+    echo ""
+fi
+
+if [ "$HOT_ONLY" = true ]; then
+    rm /tmp/cookies_new.txt
+    echo "================================================================================"
+    echo "完成！（仅热更新，Koyeb 环境变量未修改）"
+    echo "================================================================================"
+    exit 0
+fi
+
 echo "🔐 编码 cookies 为 base64..."
 # macOS 的 base64 命令需要 -i 参数
 if [[ "$OSTYPE" == "darwin"* ]]; then
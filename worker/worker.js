@@ -6,7 +6,7 @@ function buildCorsHeaders(request) {
   const origin = request.headers.get('Origin') || new URL(request.url).origin;
   return {
     'Access-Control-Allow-Origin': origin,
-    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
     'Access-Control-Allow-Headers': 'Content-Type',
   };
 }
@@ -50,11 +50,13 @@ async function handleRequest(request) {
       const cleanedHeaders = sanitizeBackendHeaders(beRes.headers);
       Object.entries(corsHeaders).forEach(([k, v]) => cleanedHeaders.set(k, v));
 
-      // 文件流直传（视频、zip等）
+      // 文件流直传（视频、zip等）、SSE 进度流和批量接口的 NDJSON 流
       const contentType = beRes.headers.get('Content-Type') || '';
       if (contentType.startsWith('video/') ||
           contentType.startsWith('application/zip') ||
-          contentType.startsWith('application/octet-stream')) {
+          contentType.startsWith('application/octet-stream') ||
+          contentType.startsWith('text/event-stream') ||
+          contentType.startsWith('application/x-ndjson')) {
         return new Response(beRes.body, {
           status: beRes.status,
           statusText: beRes.statusText,